@@ -0,0 +1,254 @@
+'''Bulk pre-provisioning of ArcGIS users from a roster.
+
+Creates every user in a CSV or JSON roster and adds them to the
+group configured for a config table GlobalID, writing a CSV report with
+one result row per roster row. Uses the same environment variables as
+the function app (PORTAL_URL, MGR_USER, MGR_PWORD, CONFIG_LAYER_ID,
+CALLBACK_URL, TENANTS) and the same rate limits. --tenant provisions
+into one of the TENANTS portals instead of the default one.
+
+Roster columns (or JSON keys): username, password, given_name,
+family_name, email. firstname/lastname are accepted too.
+
+Usage:
+    python bulk_provision.py roster.csv --globalid <globalid> \\
+        --report results.csv
+    python bulk_provision.py --tenant <tenant> roster.csv \\
+        --globalid <globalid> --report results.csv
+'''
+import argparse
+import contextvars
+import csv
+import json
+import logging
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import function_app as app
+import tenants
+from manager_token import with_mgr_token
+from portal_session import PortalUnavailableError
+
+REPORT_FIELDS = ("row", "username", "created", "added_to_group", "message")
+
+
+def read_roster(path, roster_format=None):
+    '''Streams roster rows from a CSV, JSON Lines or JSON array file
+    :param path: file path, or - for stdin
+    :param roster_format: "csv", "jsonl" or "json", taken from the
+        file extension if not given
+    :return iterator of user dicts'''
+    if roster_format is None:
+        roster_format = path.rsplit(".", 1)[-1].lower()
+        roster_format = "jsonl" if roster_format == "ndjson" else roster_format
+    stream = sys.stdin if path == "-" else open(path, newline="",
+                                                encoding="utf-8-sig")
+    try:
+        if roster_format == "json":
+            # A JSON array has to be read whole
+            rows = json.load(stream)
+        elif roster_format == "jsonl":
+            rows = (json.loads(line) for line in stream if line.strip())
+        else:
+            rows = csv.DictReader(stream)
+        for row in rows:
+            yield {
+                "username": (row.get("username") or "").strip(),
+                "password": row.get("password"),
+                "firstname": row.get("given_name") or row.get("firstname") or "",
+                "lastname": row.get("family_name") or row.get("lastname") or "",
+                "email": row.get("email")
+            }
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def provision(roster, globalid, workers=8, batch_size=25):
+    '''Creates and adds the users in a roster to the configured group
+    :param roster: iterator of user dicts
+    :param globalid: GlobalID of the config record
+    :param workers: batches provisioned at the same time
+    :param batch_size: users per invite or addUsers call
+    :return iterator of report dicts'''
+    tenant = tenants.current()
+    app_details = with_mgr_token(
+        lambda token: app._get_app_details(tenant.portal,
+                            tenant.config_layer_id, globalid, token,
+                            tenant.redirect_uri))
+    for attr in ("group_id", "user_license_id", "user_role_id"):
+        if not app_details.get(attr):
+            raise SystemExit(f"Config record {globalid} has no {attr}")
+    identity = with_mgr_token(
+        lambda token: app._resolve_identity(tenant.portal, token))
+
+    # Run up to workers batches at a time, reporting in roster order
+    rows = enumerate(roster, start=1)
+    seen = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = deque()
+        while True:
+            batch = list(islice(rows, batch_size))
+            for _, user in batch:
+                user["duplicate"] = user["username"] in seen
+                seen.add(user["username"])
+            if batch:
+                # Copy the context so the batch runs for this tenant
+                running.append(pool.submit(contextvars.copy_context().run,
+                                _provision_batch, batch, app_details,
+                                identity.default_credits))
+            if running and (not batch or len(running) >= workers):
+                yield from running.popleft().result()
+            elif not batch:
+                return
+
+
+def _provision_batch(batch, app_details, credits):
+    '''Creates one batch of users, then on ArcGIS Enterprise adds the
+    created users to the group with a single addUsers call
+    :param batch: list of (row number, user dict)
+    :param app_details: config record attributes
+    :param credits: credits to assign each user
+    :return list of report dicts'''
+    reports = []
+    by_username = {}
+    users = []
+    for row, user in batch:
+        report = {"row": row, "username": user["username"], "created": False,
+                  "added_to_group": False, "message": ""}
+        reports.append(report)
+        missing = [k for k in ("username", "password", "email")
+                   if not user.get(k)]
+        if missing:
+            report["message"] = f"Missing {', '.join(missing)}"
+        elif user.get("duplicate"):
+            report["message"] = "Duplicate username in roster"
+        else:
+            by_username[user["username"]] = report
+            users.append(user)
+
+    try:
+        _create_and_add(users, by_username, app_details, credits)
+    except PortalUnavailableError as e:
+        for report in by_username.values():
+            if not report["added_to_group"]:
+                report["message"] = f"{e}, retry in {e.retry_after}s"
+    except Exception as e:
+        logging.exception("Batch starting at row %s failed", batch[0][0])
+        for report in by_username.values():
+            if not report["added_to_group"]:
+                report["message"] = str(e)
+    return reports
+
+
+def _create_and_add(users, by_username, app_details, credits):
+    '''Creates users then adds them to the group, recording
+    the outcome in each user's report. As in SignupPipeline, users
+    invited on ArcGIS Online are already in the group, unless
+    SIGNUP_VERIFY asks for it to be checked'''
+    tenant = tenants.current()
+    created = _create_users(users, app_details, credits)
+    for username, (success, message) in created.items():
+        by_username[username]["created"] = success
+        by_username[username]["message"] = "" if success else str(message)
+
+    new_users = [username for username, (success, _) in created.items()
+                 if success]
+    if app._is_arcgis_online(tenant.portal) and not app.SIGNUP_VERIFY:
+        for username in new_users:
+            by_username[username]["added_to_group"] = True
+        return
+    if new_users:
+        added = with_mgr_token(
+            lambda token: app._group_add_users(tenant.portal,
+                    app_details["group_id"], new_users, token,
+                    tenant.redirect_uri))
+        for username in new_users:
+            if added.get(username):
+                by_username[username]["added_to_group"] = True
+                continue
+            # Not added by the bulk call, e.g. the invite already
+            # made them a member, so check and add one at a time
+            message, status_code = with_mgr_token(
+                lambda token: app._add_user_to_group(tenant.portal, token,
+                    username, app_details["group_id"], tenant.redirect_uri))
+            by_username[username]["added_to_group"] = status_code == 200
+            by_username[username]["message"] = message
+
+
+def _create_users(users, app_details, credits):
+    '''Creates users with one invite call on ArcGIS Online,
+    or a createUser call each on ArcGIS Enterprise
+    :return dict of username -> (success, message)'''
+    if not users:
+        return {}
+    tenant = tenants.current()
+    role = app_details["user_role_id"]
+    user_type = app_details["user_license_id"]
+    if app._is_arcgis_online(tenant.portal):
+        return with_mgr_token(
+            lambda token: app._invite_portal_users(tenant.portal, token,
+                    users, role, user_type, tenant.redirect_uri,
+                    app_details["group_id"], credits))
+
+    results = {}
+    for user in users:
+        try:
+            results[user["username"]] = with_mgr_token(
+                lambda token: app._create_portal_user(
+                    portal_url=tenant.portal, token=token,
+                    username=user["username"], password=user["password"],
+                    firstname=user["firstname"], lastname=user["lastname"],
+                    email=user["email"], role=role, user_type=user_type,
+                    redirect_uri=tenant.redirect_uri,
+                    group_id=app_details["group_id"],
+                    default_credits=credits))
+        except PortalUnavailableError as e:
+            results[user["username"]] = (False,
+                                         f"{e}, retry in {e.retry_after}s")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenant", default=tenants.DEFAULT_TENANT,
+                        help="tenant to provision the users into")
+    parser.add_argument("roster",
+                        help="CSV, JSON Lines or JSON roster, - for stdin")
+    parser.add_argument("--format", choices=("csv", "jsonl", "json"),
+                        help="roster format if not clear from the extension")
+    parser.add_argument("--globalid", required=True,
+                        help="GlobalID of the config record to onboard into")
+    parser.add_argument("--report", default="-",
+                        help="CSV file for per-row results, - for stdout")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="batches provisioned at the same time")
+    parser.add_argument("--batch-size", type=int,
+                        default=app.GROUP_BATCH_MAX_USERS,
+                        help="users per invite or addUsers call")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    out = sys.stdout if args.report == "-" else open(args.report, "w",
+                                                     newline="")
+    failed = 0
+    try:
+        writer = csv.DictWriter(out, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        roster = read_roster(args.roster, args.format)
+        with tenants.use(args.tenant):
+            for report in provision(roster, args.globalid,
+                                    args.workers, args.batch_size):
+                failed += not report["added_to_group"]
+                writer.writerow(report)
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+'''Cache backends for manager tokens, config rows and other
+portal lookups.'''
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+
+from request_tracing import deadline_lock
+
+# Cache for manager tokens, config rows, the manager org and recent
+# members: "memory", "sqlite:<path>" to share between local worker
+# processes, or a redis:// URL to share between instances
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+# Most entries held by the in-memory cache
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+
+
+class MemoryCache:
+    '''
+    Least recently used cache with a TTL per entry, held in this
+    worker's memory. Each worker fills its own copy.
+    '''
+    shared = False
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Gets a cached value
+        :param key: str
+        :return value, or None if missing or expired'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        '''Caches a value
+        :param key: str
+        :param value: JSON serialisable value
+        :param ttl: seconds to keep it'''
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SqliteCache:
+    '''
+    Cache in a SQLite file, shared by the worker processes on one
+    machine. Suits testing scale-out locally without cloud services.
+    '''
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY, value TEXT, expires REAL)""")
+
+    def _connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def get(self, key):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM cache WHERE key = ? "
+                               "AND expires > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                         (key, json.dumps(value), now + ttl))
+
+    def delete(self, key):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCache:
+    '''
+    Cache in Redis (e.g. Azure Cache for Redis), shared by every
+    instance, so scaling out doesn't multiply the load on the portal.
+    Needs the redis package.
+    '''
+    shared = True
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("CACHE_BACKEND is a Redis URL but the redis "
+                              "package is not installed, uncomment it in "
+                              "requirements.txt") from None
+        self._redis = redis.Redis.from_url(url, socket_timeout=2)
+        self._errors = redis.RedisError
+
+    def get(self, key):
+        # An unreachable cache is treated as empty rather than
+        # failing the request
+        try:
+            value = self._redis.get(key)
+        except self._errors as e:
+            logging.warning("Cache unavailable: %s", e)
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self._redis.set(key, json.dumps(value),
+                            px=max(1, int(ttl * 1000)))
+        except self._errors as e:
+            logging.warning("Cache unavailable: %s", e)
+
+    def delete(self, key):
+        try:
+            self._redis.delete(key)
+        except self._errors as e:
+            logging.warning("Cache unavailable: %s", e)
+
+
+def create_cache(backend):
+    '''Creates the cache named by CACHE_BACKEND
+    :param backend: "memory", "sqlite:<path>" or a redis:// URL
+    :return MemoryCache, SqliteCache or RedisCache'''
+    if backend.startswith("sqlite:"):
+        return SqliteCache(backend[len("sqlite:"):])
+    if backend.startswith(("redis://", "rediss://")):
+        return RedisCache(backend)
+    return MemoryCache(CACHE_MAX_ENTRIES)
+
+
+class KeyedLocks:
+    '''
+    A lock per key, kept only while it is held or waited for, so
+    locking on keys from anonymous requests (e.g. usernames being
+    typed) doesn't grow memory.
+    '''
+
+    def __init__(self):
+        # key -> [lock, callers holding or waiting for it]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key, stage=None):
+        '''Holds key's lock, waiting for it no longer than the time left
+        :param stage: stage reported if the time runs out
+        :raises DeadlineExceededError'''
+        entry = self._check_out(key)
+        try:
+            with deadline_lock(entry[0], stage):
+                yield
+        finally:
+            self._check_in(key, entry)
+
+    def try_acquire(self, key):
+        '''Takes key's lock if it is free, e.g. for a background thread
+        to release when done
+        :return function releasing the lock, or None if it is held'''
+        entry = self._check_out(key)
+        if not entry[0].acquire(blocking=False):
+            self._check_in(key, entry)
+            return None
+
+        def release():
+            entry[0].release()
+            self._check_in(key, entry)
+        return release
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+    def _check_out(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry
+
+    def _check_in(self, key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
@@ -0,0 +1,137 @@
+'''Coalescing of the same or similar calls made by concurrent
+invocations.'''
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from request_tracing import wait_for
+
+
+class SingleFlight:
+    '''
+    Lets one call run per key at a time. Callers arriving while a
+    call for their key is running wait for it and share its result.
+    Results are (result, http_status_code) tuples, successful ones
+    are kept for result_ttl seconds to answer immediate retries.
+    '''
+
+    def __init__(self, result_ttl=0):
+        self.result_ttl = result_ttl
+        self._running = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call):
+        '''Runs call() unless a call for key is running or recently
+        succeeded, in which case its result is returned instead
+        :param key: hashable key, None disables deduplication
+        :param call: function taking no arguments
+        :return: result of call'''
+        if key is None:
+            return call()
+
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[1] > time.time():
+                logging.info("Answering repeated request from recent result")
+                return cached[0]
+            future = self._running.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._running[key] = future
+
+        if not is_leader:
+            logging.info("Waiting on identical request already running")
+            return wait_for(future)
+
+        try:
+            result = call()
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+                now = time.time()
+                for k in [k for k, v in self._results.items() if v[1] <= now]:
+                    del self._results[k]
+                if future.exception() is None and self.result_ttl > 0 \
+                        and future.result()[1] == 200:
+                    self._results[key] = (future.result(),
+                                          now + self.result_ttl)
+        return result
+
+
+class GroupBatcher:
+    '''
+    Coalesces calls for the same group made by concurrent
+    invocations into one bulk call.
+
+    The first caller for a group opens a batch and waits up to
+    GROUP_BATCH_WINDOW_MS for others to join, or until the batch holds
+    GROUP_BATCH_MAX_USERS users. It then sends one call for the whole
+    batch and each caller gets the result for its own user.
+    '''
+
+    def __init__(self, send_batch, window_ms, max_users):
+        '''
+        :param send_batch: function(base_url, group_id, users,
+            mgr_token, redirect_uri) returning a dict of username -> bool
+        :param window_ms: how long a batch stays open
+        :param max_users: most users sent in one call
+        '''
+        self.send_batch = send_batch
+        self.window = window_ms / 1000
+        self.max_users = max_users
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def submit(self, base_url, group_id, user, mgr_token, redirect_uri):
+        '''Adds a user to the open batch for the group and waits for it
+        :return: bool result for the user'''
+        if self.window <= 0 or self.max_users <= 1:
+            return self.send_batch(base_url, group_id, [user],
+                                   mgr_token, redirect_uri)[user]
+
+        key = (base_url, group_id, redirect_uri)
+        future = Future()
+        with self._lock:
+            batch = self._open.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = {"users": {}, "full": threading.Event()}
+                self._open[key] = batch
+            batch["users"].setdefault(user, []).append(future)
+            if len(batch["users"]) >= self.max_users:
+                # Close the batch so later callers start a new one
+                del self._open[key]
+                batch["full"].set()
+
+        if is_leader:
+            batch["full"].wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            self._send(batch["users"], base_url, group_id,
+                       mgr_token, redirect_uri)
+        return wait_for(future)
+
+    def _send(self, waiters, base_url, group_id, mgr_token, redirect_uri):
+        users = list(waiters)
+        try:
+            if len(users) > 1:
+                logging.info("Sending %s users to group %s in one call",
+                             len(users), group_id)
+            results = self.send_batch(base_url, group_id, users,
+                                      mgr_token, redirect_uri)
+        except BaseException as e:
+            for futures in waiters.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for user, futures in waiters.items():
+            for future in futures:
+                future.set_result(results.get(user, False))
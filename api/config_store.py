@@ -0,0 +1,389 @@
+'''Cached copy of each tenant's config table.'''
+import logging
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+import tenants
+from manager_token import with_mgr_token
+from portal_session import (InvalidTokenError, PortalUnavailableError,
+                            check_token_error, token_headers)
+from request_tracing import DeadlineExceededError, deadline_lock
+
+# Seconds before the cached config table is synced in the background
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", "30"))
+# Minimum seconds between reloads triggered by an unknown GlobalID
+CONFIG_MISS_RELOAD_INTERVAL = int(os.getenv("CONFIG_MISS_RELOAD_INTERVAL", "5"))
+# Seconds an unknown GlobalID is remembered as unknown
+CONFIG_NEGATIVE_TTL = int(os.getenv("CONFIG_NEGATIVE_TTL", "30"))
+# Config table field listing revoked link ids, or * for every link
+# made from that record
+LINK_REVOKED_FIELD = os.getenv("LINK_REVOKED_FIELD", "revoked_links")
+
+# Config tables cached per worker, keyed by (portal, config layer id)
+_config_stores = {}
+_config_stores_lock = threading.Lock()
+
+
+def get_config_store(base_url, config_layer_id, redirect_uri):
+    '''Gets the config store for a config layer, creating it on first use
+    :param base_url: base url for portal/agol
+    :param config_layer_id: Item ID of the config Feature Service
+    :param redirect_uri: used as referer header
+    :return ConfigStore'''
+    key = (base_url, config_layer_id)
+    with _config_stores_lock:
+        store = _config_stores.get(key)
+        if store is None:
+            store = ConfigStore(base_url, config_layer_id, redirect_uri)
+            _config_stores[key] = store
+        return store
+
+
+def normalise_globalid(globalid):
+    '''Normalises a GlobalID so "{abc-...}" and "ABC-..." match
+    :param globalid: GlobalID string
+    :return str'''
+    return str(globalid or "").strip().strip("{}").upper()
+
+
+class ConfigStore:
+    """
+    In-memory copy of the config table, indexed by GlobalID.
+
+    The whole table is loaded on first use and the feature service
+    url is resolved once. Once the copy is older than CONFIG_CACHE_TTL
+    it is synced in the background while the current rows are served.
+    A sync reads the layer's editingInfo.lastEditDate and, if the table
+    has changed, re-queries only the rows edited since the last sync
+    and evicts deleted rows. Layers without editor tracking fall back
+    to a full reload.
+    A lookup for an unknown GlobalID syncs at most once every
+    CONFIG_MISS_RELOAD_INTERVAL seconds, so newly added QR codes work
+    without hammering the layer with unknown ids. A GlobalID still
+    unknown after that is cached as unknown for CONFIG_NEGATIVE_TTL.
+    With a shared cache each sync publishes the rows, and a worker
+    adopts rows another worker synced recently instead of querying.
+    """
+
+    def __init__(self, base_url, config_layer_id, redirect_uri):
+        self.base_url = base_url
+        self.config_layer_id = config_layer_id
+        self.redirect_uri = redirect_uri
+        self.service_url = None
+        self._rows = {}
+        self._oids = {}
+        self._last_edit_date = None
+        self._loaded_at = None
+        self._last_miss_reload = 0
+        self._revoked = (None, {})
+        self._refreshing = False
+        self._load_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+
+    def get(self, globalid, token):
+        '''Looks up a config row
+        :param globalid: The GlobalID to match
+        :param token: A valid ArcGIS token, used if a sync is needed
+        :return arcgis feature attributes (dict), empty if not found'''
+        key = normalise_globalid(globalid)
+        if self._loaded_at is None:
+            self.sync(token)
+        elif time.time() - self._loaded_at > CONFIG_CACHE_TTL:
+            self._refresh_in_background()
+
+        details = self._rows.get(key)
+        if details is None and key:
+            details = self._sync_for_miss(key, token)
+        return dict(details) if details else {}
+
+    def revoked_links(self, token, globalid=None):
+        '''Gets the revoked signed link ids of every record, rebuilt
+        only when the rows change. Served from the cached rows like get
+        :param token: A valid ArcGIS token, used if a sync is needed
+        :param globalid: GlobalID of the record the caller checks. If
+            the cached rows don't have it, they are synced as in get
+        :return dict of normalised GlobalID -> set of revoked link ids,
+            or None if the table has never been loaded'''
+        if self._loaded_at is None:
+            self.sync(token)
+            if self._loaded_at is None:
+                return None
+        elif time.time() - self._loaded_at > CONFIG_CACHE_TTL:
+            self._refresh_in_background()
+
+        key = normalise_globalid(globalid)
+        if key and key not in self._rows:
+            # Maybe added since the last sync, rather than deleted
+            self._sync_for_miss(key, token)
+
+        rows, revoked = self._revoked
+        if rows is not self._rows:
+            rows = self._rows
+            field = LINK_REVOKED_FIELD.lower()
+            revoked = {}
+            for key, attributes in rows.items():
+                value = next((v for k, v in attributes.items()
+                              if k.lower() == field), None)
+                revoked[key] = {link_id.strip() for link_id
+                                in str(value or "").split(",")
+                                if link_id.strip()}
+            self._revoked = (rows, revoked)
+        return revoked
+
+    def _sync_for_miss(self, key, token):
+        '''Syncs for a GlobalID the cached rows don't have, at most once
+        every CONFIG_MISS_RELOAD_INTERVAL. One still missing after the
+        sync is remembered as unknown for CONFIG_NEGATIVE_TTL
+        :param key: normalised GlobalID
+        :param token: A valid ArcGIS token
+        :return the row's attributes (dict), or None if not found'''
+        miss_key = f"{self._cache_key}:missing:{key}"
+        if tenants.cache.get(miss_key) is not None \
+                or not self._miss_reload_allowed():
+            return None
+        logging.info("GlobalID %s not cached, syncing config", key)
+        self.sync(token, max_age=0)
+        details = self._rows.get(key)
+        if details is None:
+            tenants.cache.set(miss_key, True, CONFIG_NEGATIVE_TTL)
+        return details
+
+    @property
+    def loaded(self):
+        '''Whether the table has been loaded at least once'''
+        return self._loaded_at is not None
+
+    @property
+    def _cache_key(self):
+        return f"config:{self.base_url}:{self.config_layer_id}"
+
+    def sync(self, token, max_age=CONFIG_CACHE_TTL):
+        '''Brings the cached rows up to date with the config table.
+        Concurrent callers wait for a single sync rather than each
+        querying the layer
+        :param token: A valid ArcGIS token
+        :param max_age: age in seconds of rows synced by another worker
+            that can be used instead
+        :return None'''
+        requested = time.time()
+        with deadline_lock(self._load_lock, "config"):
+            if self._loaded_at is not None and self._loaded_at >= requested:
+                return
+            if self._adopt_shared_rows(requested - max_age):
+                return
+            try:
+                if self._loaded_at is None:
+                    self._full_load(token)
+                else:
+                    self._incremental_load(token)
+                self._loaded_at = time.time()
+                self._publish_rows()
+            except (InvalidTokenError, PortalUnavailableError,
+                    DeadlineExceededError):
+                raise
+            except Exception:
+                logging.error("Could not load config table: %s",
+                              traceback.format_exc())
+
+    def _adopt_shared_rows(self, synced_after):
+        '''Uses rows another worker published to the shared cache
+        :param synced_after: oldest acceptable sync time
+        :return bool, whether rows were adopted'''
+        if not tenants.cache.shared:
+            return False
+        snapshot = tenants.cache.get(self._cache_key)
+        if snapshot is None or snapshot["loaded_at"] < synced_after \
+                or snapshot["loaded_at"] <= (self._loaded_at or 0):
+            return False
+        self._rows = snapshot["rows"]
+        self._oids = dict(snapshot["oids"])
+        self._last_edit_date = snapshot["last_edit_date"]
+        self.service_url = self.service_url or snapshot["service_url"]
+        self._loaded_at = snapshot["loaded_at"]
+        return True
+
+    def _publish_rows(self):
+        '''Shares the synced rows with other workers'''
+        if not tenants.cache.shared:
+            return
+        tenants.cache.set(self._cache_key, {
+            "rows": self._rows,
+            # JSON keys are strings, so keep ObjectIDs as pairs
+            "oids": list(self._oids.items()),
+            "last_edit_date": self._last_edit_date,
+            "service_url": self.service_url,
+            "loaded_at": self._loaded_at
+        }, CONFIG_CACHE_TTL)
+
+    def _miss_reload_allowed(self):
+        with self._state_lock:
+            now = time.time()
+            if now - self._last_miss_reload < CONFIG_MISS_RELOAD_INTERVAL:
+                return False
+            self._last_miss_reload = now
+            return True
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with_mgr_token(self.sync)
+            except Exception:
+                logging.error("Background config refresh failed: %s",
+                              traceback.format_exc())
+            finally:
+                with self._state_lock:
+                    self._refreshing = False
+
+        tenants.start_background(refresh)
+
+    def _full_load(self, token):
+        '''Replaces the cached rows with every row of the table
+        :param token: A valid ArcGIS token
+        :return None'''
+        # Read the edit date first so edits made during the
+        # query are picked up by the next sync
+        layer_info = self._fetch_layer_info(token)
+        rows, oids = self._query_rows(token, "1=1",
+                        layer_info.get("objectIdField"))
+        self._rows, self._oids = rows, oids
+        self._last_edit_date = _layer_last_edit_date(layer_info)
+
+    def _incremental_load(self, token):
+        '''Applies rows edited since the last sync and evicts
+        deleted rows. Does nothing if the table is unchanged
+        :param token: A valid ArcGIS token
+        :return None'''
+        layer_info = self._fetch_layer_info(token)
+        last_edit_date = _layer_last_edit_date(layer_info)
+        if last_edit_date is not None and last_edit_date == self._last_edit_date:
+            return
+
+        edit_field = (layer_info.get("editFieldsInfo") or {}).get("editDateField")
+        if last_edit_date is None or self._last_edit_date is None \
+                or not edit_field:
+            self._full_load(token)
+            return
+
+        since = datetime.fromtimestamp(self._last_edit_date / 1000,
+                                       tz=timezone.utc)
+        where = f"{edit_field} >= timestamp '{since:%Y-%m-%d %H:%M:%S}'"
+        changed, changed_oids = self._query_rows(token, where,
+                                    layer_info.get("objectIdField"))
+        current_oids = self._query_object_ids(token)
+
+        # Build new indexes and swap them in so readers never
+        # see a half-applied sync
+        oids = {oid: key for oid, key in self._oids.items()
+                if oid in current_oids and oid not in changed_oids}
+        oids.update(changed_oids)
+        rows = {key: self._rows[key] for key in oids.values()
+                if key in self._rows and key not in changed}
+        rows.update(changed)
+        removed = [oid for oid in self._oids if oid not in current_oids]
+        logging.info("Config sync: %s changed, %s removed",
+                     len(changed), len(removed))
+        self._rows, self._oids = rows, oids
+        self._last_edit_date = last_edit_date
+
+    def _resolve_service_url(self, token):
+        '''Gets the feature service url from the config item
+        :param token: A valid ArcGIS token
+        :return str'''
+        if self.service_url is None:
+            url = f"{self.base_url}/sharing/rest/content/items/{self.config_layer_id}"
+            item_info = tenants.http.get(url, params={"f": "json"},
+                                         headers=token_headers(token),
+                                         timeout=10).json()
+            check_token_error(item_info)
+            if "error" in item_info:
+                raise RuntimeError(f"Error fetching config item: {item_info['error']}")
+            self.service_url = item_info["url"]
+        return self.service_url
+
+    def _fetch_layer_info(self, token):
+        '''Gets the config table's layer metadata
+        :param token: A valid ArcGIS token
+        :return dict'''
+        # assuming config is table 0
+        layer_url = self._resolve_service_url(token) + "/0"
+        response = tenants.http.get(layer_url,
+                                    params={"f": "json"},
+                                    headers=token_headers(
+                                        token,
+                                        {"referer": self.redirect_uri}),
+                                    timeout=10)
+        response.raise_for_status()
+        layer_info = response.json()
+        check_token_error(layer_info)
+        if "error" in layer_info:
+            raise RuntimeError(f"Error fetching config layer: {layer_info['error']}")
+        return layer_info
+
+    def _query(self, token, params):
+        query_url = self._resolve_service_url(token) + "/0/query"
+        params = dict(params, f="json", token=token)
+        response = tenants.http.post(query_url,
+                                     data=params,
+                                     headers={"referer": self.redirect_uri},
+                                     timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        check_token_error(data)
+        if "error" in data:
+            raise RuntimeError(f"Error querying config table: {data['error']}")
+        return data
+
+    def _query_rows(self, token, where, oid_field=None):
+        '''Queries the rows matching where, following paging
+        :param token: A valid ArcGIS token
+        :param where: SQL where clause
+        :param oid_field: name of the ObjectID field
+        :return (normalised GlobalID -> attributes,
+                 ObjectID -> normalised GlobalID)'''
+        oid_field = (oid_field or "OBJECTID").lower()
+        rows = {}
+        oids = {}
+        offset = 0
+        while True:
+            data = self._query(token, {
+                "where": where,
+                "outFields": "*",
+                "resultOffset": offset
+            })
+            features = data.get("features", [])
+            for feature in features:
+                attributes = feature["attributes"]
+                lowered = {k.lower(): v for k, v in attributes.items()}
+                globalid = lowered.get("globalid")
+                if globalid:
+                    key = normalise_globalid(globalid)
+                    rows[key] = attributes
+                    oids[lowered.get(oid_field)] = key
+
+            if not data.get("exceededTransferLimit") or not features:
+                return rows, oids
+            offset += len(features)
+
+    def _query_object_ids(self, token):
+        '''Gets the ObjectIDs of every row, used to detect deletes
+        :param token: A valid ArcGIS token
+        :return set'''
+        data = self._query(token, {"where": "1=1", "returnIdsOnly": "true"})
+        return set(data.get("objectIds") or [])
+
+
+def _layer_last_edit_date(layer_info):
+    '''Reads the data last edit date from layer metadata
+    :param layer_info: layer json
+    :return epoch milliseconds or None'''
+    editing_info = layer_info.get("editingInfo") or {}
+    return editing_info.get("dataLastEditDate") or \
+        editing_info.get("lastEditDate")
@@ -1,112 +1,223 @@
 import logging
 import os
 import json
+import threading
+import time
 import traceback
-from copy import deepcopy
+from concurrent.futures import FIRST_EXCEPTION, wait
+import contextvars
+import functools
 import azure.functions as func
-import requests
 
-PORTAL = os.getenv("PORTAL_URL")
-MGR_USER = os.getenv("MGR_USER")
-MGR_PWORD = os.getenv("MGR_PWORD")
-CONFIG_LAYER_ID = os.getenv("CONFIG_LAYER_ID")
-CLIENT_ID = os.getenv("CLIENT_ID")
-REDIRECT_URI = os.getenv("CALLBACK_URL")
+import tenants
+from coalescing import GroupBatcher, SingleFlight
+from config_store import get_config_store
+from manager_token import get_grp_mgr_token, with_mgr_token
+from portal_session import (InvalidTokenError, PortalUnavailableError,
+                            UserTokenError, check_token_error, token_headers)
+from request_profiler import profiled, profiling_thread
+from request_tracing import (DeadlineExceededError, RequestTrace, deadline,
+                             instrumented, remaining_time)
+from signed_links import link_revoked, verify_link
+from signup_jobs import create_job_store
+from tenants import InvalidTenantError, UnknownTenantError
+
+# Seconds to keep the manager's org and portal defaults
+IDENTITY_CACHE_TTL = int(os.getenv("IDENTITY_CACHE_TTL", "3600"))
+# Seconds an expired manager org lookup is still served while refreshed
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "300"))
+
+# How long concurrent group adds/invites are collected into one call
+GROUP_BATCH_WINDOW_MS = int(os.getenv("GROUP_BATCH_WINDOW_MS", "50"))
+# Most users sent in one addUsers/invite call
+GROUP_BATCH_MAX_USERS = int(os.getenv("GROUP_BATCH_MAX_USERS", "25"))
+
+# Seconds a successful onboarding answers repeats without portal calls
+ONBOARDING_RESULT_TTL = int(os.getenv("ONBOARDING_RESULT_TTL", "120"))
+# Seconds a pending group invitation is remembered, so a retry
+# accepts it instead of inviting the user again
+INVITATION_CACHE_TTL = int(os.getenv("INVITATION_CACHE_TTL", "600"))
+# Extra lookups for an invitation not yet visible after inviting,
+# and the seconds before the first, doubling each time
+INVITATION_LOOKUP_RETRIES = int(os.getenv("INVITATION_LOOKUP_RETRIES", "3"))
+INVITATION_LOOKUP_BACKOFF = float(os.getenv("INVITATION_LOOKUP_BACKOFF", "0.25"))
+
+# Queue signups and answer 202 with a job id instead of waiting
+SIGNUP_ASYNC = os.getenv("SIGNUP_ASYNC", "false").lower() == "true"
+# Seconds a username check is cached: free names briefly as someone
+# may take them, taken names for longer
+USERNAME_FREE_TTL = int(os.getenv("USERNAME_FREE_TTL", "30"))
+USERNAME_TAKEN_TTL = int(os.getenv("USERNAME_TAKEN_TTL", "3600"))
+# Check the shortcuts the signup pipeline takes against the portal
+SIGNUP_VERIFY = os.getenv("SIGNUP_VERIFY", "false").lower() == "true"
+# Fields a signup request must have
+SIGNUP_FIELDS = ("username", "password", "given_name",
+                 "family_name", "email", "globalid")
+
+# Seconds each route has to answer. Portal call timeouts are cut to
+# the time left and remaining work is skipped once it runs out
+ROUTE_DEADLINES = {
+    "check-permissions": float(os.getenv("DEADLINE_CHECK_PERMISSIONS", "20")),
+    "signup": float(os.getenv("DEADLINE_SIGNUP", "30")),
+    "warmup": float(os.getenv("DEADLINE_WARMUP", "10")),
+    "check-username": float(os.getenv("DEADLINE_CHECK_USERNAME", "5")),
+}
+
+# Warm the caches in the background when a worker starts
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() == "true"
+
+
+def _traced(route):
+    '''Traces each request to an HTTP handler and gives it the
+    route's deadline
+    :param route: name the request metrics are reported under
+    :return decorator'''
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(req):
+            with RequestTrace(route) as trace, \
+                    deadline(ROUTE_DEADLINES.get(route)):
+                response = handler(req)
+                trace.status_code = response.status_code
+                return response
+        return wrapper
+    return decorator
+
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 @app.route(route="check-permissions", methods=[func.HttpMethod.POST])
+@_traced("check-permissions")
+@profiled
 def add_existing_user(req: func.HttpRequest) -> func.HttpResponse:
     '''Adds an existing ArcGIS user to the group 
     and redirects them to the app'''
-    logging.info(PORTAL)
-    logging.info(MGR_USER)
-    logging.info(CONFIG_LAYER_ID)
-    logging.info(CLIENT_ID)
-    logging.info(REDIRECT_URI)
-
     logging.info('Python HTTP trigger function ' \
     'processed a request to add a user to a group.')
     try:
         body = req.get_json()
-        logging.info(body)
         code = body.get("code")
         verifier = body.get("verifier")
         globalid = body.get("globalid")
+        link = body.get("link")
 
-        # Get tokens for the admin and the user
-        user_token = _get_user_token(PORTAL, CLIENT_ID, code,
-                                    REDIRECT_URI, verifier)
-        mgr_token = _get_grp_mgr_token(MGR_USER,
-                                      MGR_PWORD, REDIRECT_URI)
-
-        if user_token is None:
-            result = {"message": "Could not get user token"}
-            logging.info(result)
-            return func.HttpResponse(json.dumps(result),
-                                status_code=500)
-        if mgr_token is None:
-            result = {"message": "Could not get admin token"}
-            logging.info(result)
-            return func.HttpResponse(json.dumps(result),
-                                status_code=500)
-
-        # Get the app details so we know which group to add them to
-        app_details = _get_app_details(PORTAL, CONFIG_LAYER_ID,
-                            globalid, mgr_token, REDIRECT_URI)
-        if "group_id" not in app_details or \
-              'redirect_uri' not in app_details:
-            result = {"message": "Couldn't get group id or \
-                      redirect uri from config. \
-                      Field is missing from config table."}
-            logging.error("Couldn't get group id or \
-                          redirect uri from config.")
-            return func.HttpResponse(json.dumps(result),
-                                     status_code=500)
-        group_id = app_details["group_id"]
-
-        # Check if user in same or different org
-        username = _get_username_from_token(PORTAL, user_token)
-        group_org = _get_user_org(PORTAL, mgr_token)
-        user_org = _get_user_org(PORTAL, user_token)
-        logging.info(username)
-        logging.info(group_org)
-        logging.info(user_org)
-
-        # If not in same org, invite and accept on their behalf
-        invite = False
-        if user_org is None or user_org != group_org:
-            invite = True
-        message, status_code = _add_user_to_group(PORTAL,
-                        mgr_token, username, group_id,
-                        REDIRECT_URI, invite, user_token)
+        if not code or not isinstance(code, str):
+            return func.HttpResponse(json.dumps({"message": "Missing code"}),
+                                     status_code=400)
 
-        result = {
-            "message": message,
-            "redirect_uri": app_details["redirect_uri"]
-        }
-    except Exception as e:
+        # A reload of callback.html posts the same single-use code
+        # again, so share the first request's result
+        with tenants.use(body.get("tenant")) as tenant:
+            result, status_code = _code_flights.do((tenant.name, code),
+                lambda: _check_permissions(code, verifier, globalid, link))
+    except InvalidTenantError as e:
+        return _invalid_tenant_response(e)
+    except UserTokenError as e:
+        logging.info("User token rejected: %s", e)
+        result = {"message": "Your ArcGIS sign in has expired. "
+                             "Please sign in again."}
+        status_code = 401
+    except UnknownTenantError as e:
+        return _unknown_tenant_response(e)
+    except PortalUnavailableError as e:
+        return _portal_unavailable_response(e)
+    except DeadlineExceededError as e:
+        return _deadline_exceeded_response(e)
+    except Exception:
         logging.error(traceback.format_exc())
-        result = {
-            "message": e
-        }
+        result = _unexpected_error_result()
         status_code = 500
 
     return func.HttpResponse(json.dumps(result),
                              status_code=status_code)
 
 
+def _check_permissions(code, verifier, globalid, link=None):
+    '''Signs the user in, then adds them to the group
+    configured for globalid, or carried by a signed link
+    :param code: authorization code
+    :param verifier: pkce verifier
+    :param globalid: GlobalID of the config record
+    :param link: signed onboarding link, used instead of globalid
+    :return: (result:dict, http_status_code:int)'''
+    claims = None
+    if link:
+        claims, error = verify_link(link)
+        if claims is None:
+            return {"message": error}, 403
+
+    # Get tokens for the admin and the user
+    tenant = tenants.current()
+    tokens = _run_concurrently({
+        "user": lambda: _get_user_token(tenant.portal, tenant.client_id,
+                                code, tenant.redirect_uri, verifier),
+        "mgr": lambda: get_grp_mgr_token(tenant.mgr_user,
+                                  tenant.mgr_pword, tenant.redirect_uri)
+    })
+    user_token = tokens["user"]
+    mgr_token = tokens["mgr"]
+
+    if user_token is None:
+        result = {"message": "Could not get user token"}
+        logging.info(result)
+        return result, 500
+    if mgr_token is None:
+        result = {"message": "Could not get admin token"}
+        logging.info(result)
+        return result, 500
+
+    # Get the app details so we know which group to add them to,
+    # and who the user is and which org they're in. These only
+    # depend on the tokens so run them at the same time
+    lookups = _run_concurrently({
+        "app_details": lambda: with_mgr_token(
+            lambda token: _get_onboarding_details(globalid, claims, token)),
+        "identity": lambda: with_mgr_token(
+            lambda token: _resolve_identity(tenant.portal, token,
+                                            user_token))
+    })
+    app_details = lookups["app_details"]
+    if app_details is None:
+        return _revoked_link_result(), 403
+    if not app_details:
+        return _unknown_link_result(), 404
+    if "group_id" not in app_details or \
+          'redirect_uri' not in app_details:
+        result = {"message": "Couldn't get group id or \
+                  redirect uri from config. \
+                  Field is missing from config table."}
+        logging.error("Couldn't get group id or \
+                      redirect uri from config.")
+        return result, 500
+    group_id = app_details["group_id"]
+
+    identity = lookups["identity"]
+
+    # If not in same org, invite and accept on their behalf.
+    # Concurrent requests for the same user and group share one attempt
+    message, status_code = _group_flights.do(
+        (tenant.portal, identity.username, group_id),
+        lambda: with_mgr_token(
+            lambda token: _add_user_to_group(tenant.portal,
+                    token, identity.username, group_id,
+                    tenant.redirect_uri, identity.invite_required,
+                    user_token, identity.group_ids)))
+
+    result = {
+        "message": message,
+        "redirect_uri": app_details["redirect_uri"]
+    }
+    return result, status_code
+
+
 @app.route(route="signup", methods=[func.HttpMethod.POST])
+@_traced("signup")
+@profiled
 def user_signup(req: func.HttpRequest) -> func.HttpResponse:
     '''Creates a new user account, adds user to 
     group and redirects them to the app'''
     logging.info('Python HTTP trigger function \
                  processed a request to create a user.')
-    logging.info(PORTAL)
-    logging.info(MGR_USER)
-    logging.info(CONFIG_LAYER_ID)
-    logging.info(CLIENT_ID)
-    logging.info(REDIRECT_URI)
     try:
         try:
             data = req.get_json()
@@ -117,90 +228,616 @@ def user_signup(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps(result),
                                      status_code=400)
 
-        logging.info(deepcopy(data).pop("password", None))
-        username = data.get("username")
-        password = data.get("password")
-        given_name = data.get("given_name")
-        family_name = data.get("family_name")
-        email = data.get("email")
-        globalid = data.get("globalid")
-
-        # Get a token for the manager
-        mgr_token = _get_grp_mgr_token(MGR_USER,
-                        MGR_PWORD, REDIRECT_URI)
-        if mgr_token is None:
-            result = {"message": "Could not get admin token"}
-            return func.HttpResponse(json.dumps(result),
-                                status_code=500)
-
-        # Get the licence id for new user and group details
-        app_details = _get_app_details(PORTAL,
-                    CONFIG_LAYER_ID, globalid, mgr_token,
-                    REDIRECT_URI)
-
-        for attr in ('group_id', 'user_license_id',
-                     'user_role_id', 'redirect_uri'):
-            if attr not in app_details:
-                result = {"message": f"Couldn't get {attr}. \
-                          Field is missing from config table."}
-                logging.error("Could not get required details from layer.")
-                return func.HttpResponse(json.dumps(result),
-                                         status_code=500)
-        group_id = app_details["group_id"]
-
-        if app_details["user_license_id"] in (None, '') or \
-            app_details["user_role_id"] in (None, ''):
-            result = {"message": "Signup is not enabled. \
-                      Sign in with an existing account \
-                      or contact an administrator."}
-            logging.error(result)
-            return func.HttpResponse(json.dumps(result),
+        with tenants.use(data.get("tenant")):
+            if SIGNUP_ASYNC:
+                return _enqueue_signup(data)
+
+            result, status_code = _run_signup(data)
+        return func.HttpResponse(json.dumps(result),
+                                 status_code=status_code)
+
+    except InvalidTenantError as e:
+        return _invalid_tenant_response(e)
+    except UnknownTenantError as e:
+        return _unknown_tenant_response(e)
+    except PortalUnavailableError as e:
+        return _portal_unavailable_response(e)
+    except DeadlineExceededError as e:
+        return _deadline_exceeded_response(e)
+    except Exception:
+        logging.error("General error: %s",
+                          traceback.format_exc())
+        return func.HttpResponse(json.dumps(_unexpected_error_result()),
+                                 status_code=500)
+
+
+@app.route(route="signup-status/{job_id}", methods=[func.HttpMethod.GET])
+def signup_status(req: func.HttpRequest) -> func.HttpResponse:
+    '''Reports the progress of a queued signup. Makes no portal calls
+    so signup.html can poll it cheaply'''
+    job = _signup_jobs.get(req.route_params.get("job_id"))
+    if job is None:
+        result = {"message": "Signup job not found"}
+        return func.HttpResponse(json.dumps(result),
+                                 status_code=404)
+    return func.HttpResponse(json.dumps(job), status_code=200)
+
+
+@app.route(route="check-username", methods=[func.HttpMethod.GET])
+@_traced("check-username")
+def check_username(req: func.HttpRequest) -> func.HttpResponse:
+    '''Checks if a username is free, for signup.html to call as the
+    user types'''
+    username = (req.params.get("username") or "").strip()
+    if not username:
+        result = {"message": "Missing username"}
+        return func.HttpResponse(json.dumps(result), status_code=400)
+    try:
+        with tenants.use(req.params.get("tenant")):
+            check = _check_username(username)
+    except UnknownTenantError as e:
+        return _unknown_tenant_response(e)
+    except PortalUnavailableError as e:
+        return _portal_unavailable_response(e)
+    except DeadlineExceededError as e:
+        return _deadline_exceeded_response(e)
+    except Exception:
+        logging.error("Username check failed: %s", traceback.format_exc())
+        result = {"message": "Could not check username"}
+        return func.HttpResponse(json.dumps(result), status_code=500)
+    result = dict(check, username=username)
+    return func.HttpResponse(json.dumps(result), status_code=200)
+
+
+@app.route(route="tenant", methods=[func.HttpMethod.GET])
+def tenant_info(req: func.HttpRequest) -> func.HttpResponse:
+    '''Tells index.html which portal and OAuth client to sign a
+    tenant's users in with. Makes no portal calls'''
+    tenant = tenants.configured.get(req.params.get("tenant")
+                                    or tenants.DEFAULT_TENANT)
+    if tenant is None:
+        return _unknown_tenant_response(
+            UnknownTenantError(f"Unknown tenant {req.params.get('tenant')}"))
+    result = {
+        "tenant": tenant.name,
+        "portal_url": tenant.portal,
+        "client_id": tenant.client_id
+    }
+    return func.HttpResponse(json.dumps(result), status_code=200,
+                             headers={"Cache-Control": "max-age=300"})
+
+
+@app.route(route="warmup", methods=[func.HttpMethod.GET])
+@_traced("warmup")
+def warmup(req: func.HttpRequest) -> func.HttpResponse:
+    '''Warms this worker so the next onboarding doesn't pay for a
+    cold start. index.html and signup.html call it when they load,
+    while the user is still signing in or filling in the form'''
+    try:
+        with tenants.use(req.params.get("tenant")):
+            result = _warm_up()
+    except UnknownTenantError as e:
+        return _unknown_tenant_response(e)
+    except PortalUnavailableError as e:
+        return _portal_unavailable_response(e)
+    except DeadlineExceededError as e:
+        return _deadline_exceeded_response(e)
+    except Exception:
+        logging.error("Warm-up failed: %s", traceback.format_exc())
+        result = {"message": "Warm-up failed"}
+        return func.HttpResponse(json.dumps(result), status_code=500)
+    return func.HttpResponse(json.dumps(result), status_code=200)
+
+
+def _warm_up():
+    '''Opens connections to the portal and fills the manager token,
+    config table and manager org caches. Each step is a no-op while
+    its cache is fresh, so calling this often is cheap
+    :return dict of step -> milliseconds taken'''
+    timings = {}
+
+    def timed(name, call):
+        start = time.perf_counter()
+        result = call()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    # Needed by everything else, and opens the first portal connection
+    tenant = tenants.current()
+    timed("manager_token", lambda: get_grp_mgr_token(tenant.mgr_user,
+                            tenant.mgr_pword, tenant.redirect_uri))
+    store = get_config_store(tenant.portal, tenant.config_layer_id,
+                             tenant.redirect_uri)
+    _run_concurrently({
+        # Loads the table on first use and refreshes it once stale.
+        # An empty GlobalID never triggers a reload for a miss
+        "config": lambda: timed("config", lambda: with_mgr_token(
+            lambda token: store.get("", token))),
+        "identity": lambda: timed("identity", lambda: with_mgr_token(
+            lambda token: _resolve_identity(tenant.portal, token)))
+    })
+    return timings
+
+
+def _warm_up_on_start():
+    '''Warms the worker in the background as it starts, so a request
+    arriving soon after waits on the warm-up rather than repeating it'''
+    def warm():
+        try:
+            timings = _warm_up()
+            logging.info("Worker warmed up for %s: %s",
+                         tenants.current().name, timings)
+        except Exception:
+            logging.warning("Warm-up on start failed: %s",
+                            traceback.format_exc())
+
+    if not WARMUP_ON_START:
+        return
+    for tenant in tenants.configured.values():
+        if tenant.mgr_user and tenant.config_layer_id:
+            tenants.start_background(warm, tenant)
+
+
+def _run_signup(data):
+    '''Runs a signup request
+    :param data: signup request body
+    :return: (result:dict, http_status_code:int)'''
+    # Checked before the flight, so malformed requests never share one
+    invalid = _invalid_signup_result(data)
+    if invalid:
+        return invalid, 400
+    username = data.get("username")
+    globalid = data.get("globalid")
+    link = data.get("link")
+
+    # A double tap on "Sign up" waits for the first attempt
+    return _signup_flights.do((tenants.current().name, username, link or globalid),
+        lambda: _signup(username, data.get("password"),
+                        data.get("given_name"), data.get("family_name"),
+                        data.get("email"), globalid, link))
+
+
+def _invalid_signup_result(data):
+    '''Checks a signup request has every field, as text
+    :param data: signup request body
+    :return dict with a message, or None if the request is valid'''
+    missing = [field for field in SIGNUP_FIELDS if not data.get(field)
+               and not (field == "globalid" and data.get("link"))]
+    if missing:
+        return {"message": f"Missing {', '.join(missing)}"}
+    wrong = [field for field in SIGNUP_FIELDS + ("link",)
+             if data.get(field) and not isinstance(data[field], str)]
+    if wrong:
+        return {"message": f"{', '.join(wrong)} must be text"}
+    return None
+
+
+def _enqueue_signup(data):
+    '''Validates a signup request and queues it for a signup worker
+    :param data: signup request body
+    :return func.HttpResponse, 202 with the job id'''
+    invalid = _invalid_signup_result(data)
+    if invalid:
+        return func.HttpResponse(json.dumps(invalid), status_code=400)
+    if data.get("link"):
+        claims, error = verify_link(data["link"])
+        if claims is None:
+            return func.HttpResponse(json.dumps({"message": error}),
                                      status_code=403)
+    taken = _username_taken_result(data["username"])
+    if taken:
+        return func.HttpResponse(json.dumps(taken), status_code=409)
+
+    job_id = os.urandom(16).hex()
+    job = {field: data.get(field) for field in SIGNUP_FIELDS + ("link",)
+           if field != "password"}
+    job["tenant"] = tenants.current().name
+    # The password stays in this worker's memory, never in the job
+    # store, and the job is run here so it can pick it up
+    with _signup_passwords_lock:
+        _signup_passwords[job_id] = data["password"]
+    _signup_jobs.enqueue(job_id, job)
+    tenants.current().signup_workers.submit(_process_signup_job, job_id)
+    result = {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/api/signup-status/{job_id}"
+    }
+    return func.HttpResponse(json.dumps(result), status_code=202)
+
+
+def _process_signup_job(job_id):
+    '''Claims a queued signup job and runs it
+    :param job_id: id of the job'''
+    data = _signup_jobs.claim(job_id)
+    with _signup_passwords_lock:
+        password = _signup_passwords.pop(job_id, None)
+    if data is None:
+        return
+    if password is None:
+        _signup_jobs.complete(job_id, {"message": "The signup was lost, "
+                                       "please sign up again"}, 500)
+        return
+    data["password"] = password
+    with RequestTrace("signup-job") as trace, \
+            deadline(ROUTE_DEADLINES["signup"]):
+        result, status_code = _run_signup_job(job_id, data)
+        trace.status_code = status_code
+    _signup_jobs.complete(job_id, result, status_code)
+
+
+def _run_signup_job(job_id, data):
+    '''Runs a queued signup, turning errors into a job result
+    :return: (result:dict, http_status_code:int)'''
+    try:
+        with tenants.use(data.get("tenant")):
+            result, status_code = _run_signup(data)
+    except UnknownTenantError as e:
+        result = {"message": str(e)}
+        status_code = 404
+    except PortalUnavailableError as e:
+        result = {"message": f"ArcGIS is busy right now. \
+            Please try again in {e.retry_after} seconds.",
+                  "retry_after": e.retry_after}
+        status_code = 503
+    except DeadlineExceededError as e:
+        result = _deadline_exceeded_result(e)
+        status_code = 504
+    except Exception:
+        logging.error("Signup job %s failed: %s", job_id,
+                      traceback.format_exc())
+        result = _unexpected_error_result()
+        status_code = 500
+    return result, status_code
 
-        new_user, message = _create_portal_user(
-            portal_url=PORTAL,
-            token=mgr_token,
-            username=username,
-            password = password,
-            firstname = given_name,
-            lastname = family_name,
-            email = email,
-            role = app_details["user_role_id"],
-            user_type= app_details["user_license_id"],
-            redirect_uri=REDIRECT_URI,
-            group_id = group_id
-        )
-        if new_user:
-            logging.info(new_user)
-            # Add the user to the group
-            message, status_code = _add_user_to_group(
-                PORTAL, mgr_token, username,
-                group_id, REDIRECT_URI, False)
 
-            result = {
-                "message": message,
-                "redirect_uri": app_details["redirect_uri"]
-            }
-            return func.HttpResponse(json.dumps(result),
-                                    status_code=status_code)
-        else:
-            result = {
-                "message": f"Could not create new user. \
-                    {message}. Please contact an administrator.",
-            }
-            logging.error(result)
-            return func.HttpResponse(json.dumps(result),
-                                    status_code=500)
+_signup_jobs = create_job_store()
+# Passwords of queued signups by job id, dropped when the job starts
+_signup_passwords = {}
+_signup_passwords_lock = threading.Lock()
 
-    except Exception as e:
-        logging.error("General error: %s",
-                          traceback.format_exc())
+
+def _portal_unavailable_response(error):
+    '''Builds the 503 returned while ArcGIS is throttling or failing
+    :param error: PortalUnavailableError
+    :return func.HttpResponse'''
+    logging.warning("Portal unavailable: %s", error)
+    result = {
+        "message": f"ArcGIS is busy right now. \
+            Please try again in {error.retry_after} seconds.",
+        "retry_after": error.retry_after
+    }
+    return func.HttpResponse(json.dumps(result),
+                             status_code=503,
+                             headers={"Retry-After": str(error.retry_after)})
+
+
+def _unknown_tenant_response(error):
+    '''Builds the 404 returned for a tenant that isn't configured
+    :param error: UnknownTenantError
+    :return func.HttpResponse'''
+    logging.warning("%s", error)
+    return func.HttpResponse(json.dumps({"message": str(error)}),
+                             status_code=404)
+
+
+def _invalid_tenant_response(error):
+    '''Builds the 400 returned for a tenant that isn't a name
+    :param error: InvalidTenantError
+    :return func.HttpResponse'''
+    return func.HttpResponse(json.dumps({"message": str(error)}),
+                             status_code=400)
+
+
+def _deadline_exceeded_response(error):
+    '''Builds the 504 returned when a request runs out of time
+    :param error: DeadlineExceededError
+    :return func.HttpResponse'''
+    return func.HttpResponse(json.dumps(_deadline_exceeded_result(error)),
+                             status_code=504)
+
+
+def _unexpected_error_result():
+    '''Builds the body returned for an unexpected error. The details
+    are only logged: exception text can hold portal urls and tokens
+    :return dict'''
+    return {"message": "An unexpected error occurred. Please try again "
+                       "or contact an administrator."}
+
+
+def _deadline_exceeded_result(error):
+    logging.warning("Request timed out: %s", error)
+    return {
+        "message": f"ArcGIS took too long to respond \
+            ({error.stage}). Please try again.",
+        "stage": error.stage
+    }
+
+
+def _signup(username, password, given_name, family_name, email, globalid,
+            link=None):
+    '''Creates a new user account and adds them to the group
+    configured for globalid, or carried by a signed link
+    :param username: username for new user
+    :param password: password
+    :param given_name: first name
+    :param family_name: last name
+    :param email: email address
+    :param globalid: GlobalID of the config record
+    :param link: signed onboarding link, used instead of globalid
+    :return: (result:dict, http_status_code:int)'''
+    claims = None
+    if link:
+        claims, error = verify_link(link)
+        if claims is None:
+            return {"message": error}, 403
+
+    # Names already known to be taken fail before any portal calls
+    taken = _username_taken_result(username)
+    if taken:
+        return taken, 409
+
+    # Get a token for the manager
+    tenant = tenants.current()
+    mgr_token = get_grp_mgr_token(tenant.mgr_user,
+                    tenant.mgr_pword, tenant.redirect_uri)
+    if mgr_token is None:
+        result = {"message": "Could not get admin token"}
+        return result, 500
+
+    # Get the licence id for new user and group details, and on
+    # ArcGIS Online the default credits for new users
+    online = _is_arcgis_online(tenant.portal)
+    calls = {
+        "app_details": lambda: with_mgr_token(
+            lambda token: _get_onboarding_details(globalid, claims, token))
+    }
+    if online:
+        calls["identity"] = lambda: with_mgr_token(
+            lambda token: _resolve_identity(tenant.portal, token))
+    lookups = _run_concurrently(calls)
+    app_details = lookups["app_details"]
+    if app_details is None:
+        return _revoked_link_result(), 403
+    if not app_details:
+        return _unknown_link_result(), 404
+
+    for attr in ('group_id', 'user_license_id',
+                 'user_role_id', 'redirect_uri'):
+        if attr not in app_details:
+            result = {"message": f"Couldn't get {attr}. \
+                      Field is missing from config table."}
+            logging.error("Could not get required details from layer.")
+            return result, 500
+
+    if app_details["user_license_id"] in (None, '') or \
+        app_details["user_role_id"] in (None, ''):
+        result = {"message": "Signup is not enabled. \
+                  Sign in with an existing account \
+                  or contact an administrator."}
+        logging.error(result)
+        return result, 403
+
+    pipeline = SignupPipeline(tenant.portal, app_details["group_id"],
+                              tenant.redirect_uri, online, SIGNUP_VERIFY)
+    created, message = pipeline.create_user(
+        username=username, password=password,
+        firstname=given_name, lastname=family_name, email=email,
+        role=app_details["user_role_id"],
+        user_type=app_details["user_license_id"],
+        default_credits=lookups["identity"].default_credits
+            if online else None)
+    if not created:
+        # Often a taken name, so check it afresh next time
+        tenants.username_cache.delete(_username_key(username))
         result = {
-                "message": f"An unexpected error occurred: {e}",
-            }
-        return func.HttpResponse(json.dumps(result),
-                                    status_code=500)
+            "message": f"Could not create new user. \
+                {message}. Please contact an administrator.",
+        }
+        logging.error(result)
+        return result, 500
+
+    tenants.username_cache.set(_username_key(username),
+                               {"available": False, "suggested": None},
+                               USERNAME_TAKEN_TTL)
+    message, status_code = pipeline.add_to_group(username)
+    result = {
+        "message": message,
+        "redirect_uri": app_details["redirect_uri"]
+    }
+    return result, status_code
 
+
+class SignupPipeline:
+    '''
+    Provisions a new user with as few portal calls as the platform
+    allows. Each step records the facts its response confirmed and
+    a later step is skipped when the fact it would establish, or
+    check, is already confirmed.
+
+    ArcGIS Online: portals/self/invite creates the user with the group
+    already in their invitation, so they are a member and no membership
+    check or addUsers call follows.
+    ArcGIS Enterprise: createUser can't add groups, but a user created
+    a moment ago can't be a member yet, so addUsers follows without a
+    membership check.
+
+    With verify set (SIGNUP_VERIFY) the skipped membership check is
+    made anyway. A fact that doesn't hold is logged and repaired, so
+    tests can check the shortcuts against a real or fake portal.
+    '''
+    CREATED = "created"
+    IN_GROUP = "in group"
+    NOT_IN_GROUP = "not in group"
+
+    def __init__(self, portal_url, group_id, redirect_uri, online,
+                 verify=False):
+        self.portal_url = portal_url
+        self.group_id = group_id
+        self.redirect_uri = redirect_uri
+        self.online = online
+        self.verify = verify
+        self.facts = set()
+
+    def create_user(self, username, password, firstname, lastname,
+                    email, role, user_type, default_credits=None):
+        '''Creates the user
+        :return (success:bool, message)'''
+        created, message = with_mgr_token(
+            lambda token: _create_portal_user(
+                portal_url=self.portal_url, token=token,
+                username=username, password=password,
+                firstname=firstname, lastname=lastname,
+                email=email, role=role, user_type=user_type,
+                redirect_uri=self.redirect_uri,
+                group_id=self.group_id,
+                default_credits=default_credits))
+        if created:
+            self.facts.add(self.CREATED)
+            self.facts.add(self.IN_GROUP if self.online
+                           else self.NOT_IN_GROUP)
+        return created, message
+
+    def add_to_group(self, username):
+        '''Makes sure the created user is in the group, calling the
+        portal only for what creating the user didn't already do
+        :return (message:str, http_status_code:int)'''
+        if self.verify:
+            self._verify_membership(username)
+
+        if self.IN_GROUP not in self.facts:
+            if self.NOT_IN_GROUP not in self.facts:
+                # Nothing known, so take the checked path
+                return with_mgr_token(
+                    lambda token: _add_user_to_group(self.portal_url,
+                        token, username, self.group_id,
+                        self.redirect_uri, False))
+            added = with_mgr_token(
+                lambda token: _group_add_user(self.portal_url,
+                    self.group_id, username, token, self.redirect_uri))
+            if not added:
+                return "User could not be added to the group. \
+                    Contact an administrator.", 400
+            self.facts.add(self.IN_GROUP)
+
+        _remember_member(_member_key(self.portal_url, self.group_id,
+                                     username))
+        return "User added to group", 200
+
+    def _verify_membership(self, username):
+        '''Checks the membership facts against the portal, replacing
+        any that don't hold'''
+        expected = self.IN_GROUP in self.facts
+        if not expected and self.NOT_IN_GROUP not in self.facts:
+            return
+        is_member, error = with_mgr_token(
+            lambda token: _is_group_member(self.portal_url, self.group_id,
+                                username, token, self.redirect_uri))
+        if error:
+            logging.warning("Could not verify signup of %s: %s",
+                            username, error)
+            self.facts -= {self.IN_GROUP, self.NOT_IN_GROUP}
+        elif is_member != expected:
+            logging.error("Signup shortcut for %s was wrong: expected "
+                          "member=%s but portal says %s",
+                          username, expected, is_member)
+            self.facts -= {self.IN_GROUP, self.NOT_IN_GROUP}
+            self.facts.add(self.IN_GROUP if is_member
+                           else self.NOT_IN_GROUP)
+
+
+def _is_arcgis_online(portal_url):
+    return "arcgis.com" in portal_url
+
+def _check_username(username):
+    '''Checks if a username is free with the portal's checkUsernames,
+    caching the answer (see USERNAME_FREE_TTL and USERNAME_TAKEN_TTL)
+    :param username: requested username
+    :return {"available": bool, "suggested": str or None}'''
+    key = _username_key(username)
+    check = tenants.username_cache.get(key)
+    if check is not None:
+        return check
+
+    with tenants.cache_load_locks.hold(key, "username check"):
+        check = tenants.username_cache.get(key)
+        if check is not None:
+            return check
+        check = with_mgr_token(
+            lambda token: _request_username_check(tenants.current().portal, token,
+                                                  username))
+        tenants.username_cache.set(key, check, USERNAME_FREE_TTL
+                                   if check["available"] else USERNAME_TAKEN_TTL)
+        return check
+
+@instrumented("username check")
+def _request_username_check(portal_url, token, username):
+    '''Asks the portal if a username is free
+    :param portal_url: base url for portal/agol
+    :param token: Valid ArcGIS token
+    :param username: requested username
+    :return {"available": bool, "suggested": str or None}'''
+    response = tenants.http.post(f"{portal_url}/sharing/rest/community/checkUsernames",
+                                 data={"usernames": username, "f": "json",
+                                       "token": token},
+                                 timeout=10)
+    response.raise_for_status()
+    result = response.json()
+    check_token_error(result)
+    if "error" in result:
+        raise RuntimeError(f"Error checking username: {result['error']}")
+    # The portal suggests the requested name back if it is free
+    for check in result.get("usernames", []):
+        if check.get("requested", "").lower() == username.lower():
+            available = check.get("suggested", "").lower() == username.lower()
+            return {"available": available,
+                    "suggested": None if available else check.get("suggested")}
+    raise RuntimeError("Username check returned no answer")
+
+def _username_taken_result(username):
+    '''Builds the 409 result for a username known to be taken
+    :param username: requested username
+    :return dict, or None if the name isn't known to be taken'''
+    check = tenants.username_cache.get(_username_key(username or ""))
+    if check is None or check["available"]:
+        return None
+    result = {"message": "That username is taken, please choose another."}
+    if check["suggested"]:
+        result["suggested"] = check["suggested"]
+    return result
+
+def _username_key(username):
+    return f"username:{tenants.current().portal}:{username.lower()}"
+
+def _run_concurrently(calls):
+    '''Runs independent calls at the same time on the tenant's pool.
+    If any call raises, calls that haven't started are cancelled
+    and the first exception is raised
+    :param calls: dict of name -> callable taking no arguments
+    :return dict of name -> result'''
+    # Copy the context so stages still belong to this request's trace
+    pool = tenants.current().fanout
+    futures = {name: pool.submit(contextvars.copy_context().run,
+                                 _run_profiled, call)
+               for name, call in calls.items()}
+    done, pending = wait(futures.values(), return_when=FIRST_EXCEPTION)
+    for future in pending:
+        future.cancel()
+    for future in done:
+        if future.exception() is not None:
+            raise future.exception()
+    return {name: future.result() for name, future in futures.items()}
+
+def _run_profiled(call):
+    with profiling_thread():
+        return call()
+
+
+_code_flights = SingleFlight(result_ttl=ONBOARDING_RESULT_TTL)
+_group_flights = SingleFlight()
+_signup_flights = SingleFlight()
+
+@instrumented("user token")
 def _get_user_token(portal, client_id, code, redirect_uri, verifier):
     '''Gets a token using authorization code with pkce
     :param portal: base url for portal/agol
@@ -218,7 +855,7 @@ def _get_user_token(portal, client_id, code, redirect_uri, verifier):
         "code_verifier": verifier
     }
 
-    reqs = requests.post(token_url, data=data, timeout=10)
+    reqs = tenants.http.post(token_url, data=data, timeout=10)
     try:
         data = reqs.json()
         return data["access_token"]
@@ -226,55 +863,46 @@ def _get_user_token(portal, client_id, code, redirect_uri, verifier):
         logging.error(traceback.format_exc())
         return None
 
-def _get_grp_mgr_token(user, pword, referer):
-    '''Gets a token for the group manager/user creator
-    using legacy generateToken as oauth requires user
-    auth for adding users to groups
-    :param user: username
-    :param pword: password
-    :param referer: referer header
-    :return token:str'''
-    url = f"{PORTAL}/sharing/rest/generateToken"
-    data = {
-        "username": user,
-        "password": pword,
-        "client": "referer",
-        "referer": referer,
-        "expiration": 60,
-        "f": "json"
+
+def _get_onboarding_details(globalid, claims, token):
+    '''Gets the group, redirect uri, licence and role to onboard with,
+    from a signed link's claims or else the config record
+    :param globalid: GlobalID of the config record
+    :param claims: verified signed link claims, or None
+    :param token: A valid ArcGIS token
+    :return dict of config attributes, empty if the record is unknown,
+        None if the link is revoked'''
+    if claims is None:
+        tenant = tenants.current()
+        return _get_app_details(tenant.portal, tenant.config_layer_id,
+                                globalid, token, tenant.redirect_uri)
+    if link_revoked(claims, token):
+        logging.info("Signed link %s from %s is revoked",
+                     claims["i"], claims["c"])
+        return None
+    return {
+        "group_id": claims["g"],
+        "redirect_uri": claims["r"],
+        "user_license_id": claims.get("l"),
+        "user_role_id": claims.get("o")
     }
-    try:
-        response = requests.post(url, data=data, timeout=10)
-        response.raise_for_status()
-        token_info = response.json()
-        return token_info["token"]
-    except:
-        logging.error(traceback.format_exc())
-        return None    
 
-def _get_username_from_token(portal, user_token):
-    '''Gets the username of the user from the token
-    :param portal: base url
-    :param user_token: user's token
-    return username: str'''
-    try:
-        reqs = requests.get(
-            f"{portal}/sharing/rest/portals/self?f=json&token={user_token}",
-            timeout=10)
-        data = reqs.json()
 
-        username = data["user"]["username"]
-        logging.info(username)
-        return username
-    except:
-        logging.error(traceback.format_exc())
-        return None
+def _revoked_link_result():
+    return {"message": "This link has been withdrawn, "
+                       "please ask the event organiser for a new one."}
+
 
+def _unknown_link_result():
+    return {"message": "Unknown link, please check it or "
+                       "ask the event organiser for a new one."}
 
+@instrumented("config")
 def _get_app_details(base_url, config_layer_id, globalid, token, redirect_uri):
     """
     Gets the record from the config feature 
     layer and returns the attributes.
+    Served from the worker's cached copy of the config table.
     
     :param base_url: Base URL of your ArcGIS portal 
         (e.g. "https://organization.example.com/<context>")
@@ -282,45 +910,22 @@ def _get_app_details(base_url, config_layer_id, globalid, token, redirect_uri):
     :param globalid: The GlobalID to match
     :param token: A valid ArcGIS token
     :param redirect_uri: used as referer header
-    :return arcgis feature attributes (dict)
+    :return arcgis feature attributes (dict), empty if not found
     """
-
-    # Get the feature service url
-    url = f"{base_url}/sharing/rest/content/items/{config_layer_id}"
-    headers = {"referer": redirect_uri}
-    item_info = requests.get(url, params={"token": token, "f": "json"},
-                             timeout=10).json()
-
-    # create the url, assuming config is table 0
-    query_url = item_info["url"]+"/0/query"
-
-    params = {
-        "where": f"GlobalID = '{globalid}'",
-        "outFields": "*",
-        "f": "json",
-        "token": token
-    }
-
-    try:
-        response = requests.post(query_url,
-                                 data=params,
-                                 headers=headers,
-                                 timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        if not data.get("features"):
-            raise ValueError(f"No features found for GlobalID {globalid}")
-
-        details = data["features"][0]["attributes"]
-        return details
-    except:
-        logging.error(traceback.format_exc())
-        return {}
+    store = get_config_store(base_url, config_layer_id, redirect_uri)
+    details = store.get(globalid, token)
+    if not details:
+        # Not an unknown record if the table couldn't be read at all
+        if not store.loaded:
+            raise RuntimeError("Config table could not be loaded")
+        logging.warning("No config found for GlobalID %s", globalid)
+    return details
 
 
+@instrumented("add to group")
 def _add_user_to_group(base_url, mgr_token, user, group_id,
-                      redirect_uri, invite=False, user_token=None):
+                      redirect_uri, invite=False, user_token=None,
+                      user_groups=None):
     """
     Adds a user to a group (or invites them) using ArcGIS REST API.
     
@@ -330,42 +935,40 @@ def _add_user_to_group(base_url, mgr_token, user, group_id,
     :param user: Username to add
     :param group_id: Group ID
     :param invite: Whether to send an invitation instead of direct add
+    :param user_groups: ids of the user's groups if already known,
+        e.g. from community/self, which avoids a membership lookup
     :return: (message:str, http_status_code:int)
     """
 
     try:
-        # --- Step 1: Get current group membership
-        members_url = f"{base_url}/sharing/rest/community/groups/{group_id}/users"
-        params = {"f": "json", "token": mgr_token}
-        headers = {"referer": redirect_uri}
-        r = requests.get(members_url,
-                         params=params,
-                         headers=headers,
-                         timeout=10)
-        r.raise_for_status()
-        members = r.json()
+        # --- Step 1: Check current group membership
+        member_key = _member_key(base_url, group_id, user)
+        if tenants.cache.get(member_key):
+            logging.info("User recently added to group")
+            return "User already in group", 200
 
-        if "error" in members:
-            return f"Error getting group members: \
-                {members['error']['message']}", 400
+        if user_groups is not None:
+            is_member = group_id in user_groups
+        else:
+            is_member, error = _is_group_member(base_url, group_id,
+                                    user, mgr_token, redirect_uri)
+            if error:
+                return f"Error getting group members: {error}", 400
 
-        if user == members.get("owner") or \
-           user in members.get("admins", []) or \
-           user in members.get("users", []):
+        if is_member:
             logging.info("User already in group")
             return "User already in group", 200
 
         # --- Step 2: Add or invite user
         if invite:
-            success = _group_invite_user(base_url, group_id,
-                        user, mgr_token, redirect_uri)
-            if not success:
+            invited, success = _join_by_invitation(base_url, group_id,
+                        user, mgr_token, user_token, redirect_uri)
+            if not invited:
                 return "User could not be invited to group", 500
-            success = _group_accept_invite(base_url,
-                        user, user_token, group_id, redirect_uri)
             if not success:
                 return "Please sign in to ArcGIS and manually \
                     accept the group invite.", 500
+            _remember_member(member_key)
             return "User invited to group", 200
         else:
             success = _group_add_user(base_url, group_id,
@@ -373,17 +976,89 @@ def _add_user_to_group(base_url, mgr_token, user, group_id,
             if not success:
                 return "User could not be added to the group. \
                     Contact an administrator.", 400
+            _remember_member(member_key)
             return "User added to group", 200
 
-    except Exception as e:
+    except (InvalidTokenError, PortalUnavailableError,
+            DeadlineExceededError):
+        raise
+    except Exception:
         logging.error("An error occurred adding the user\
                        to the group: %s", traceback.format_exc())
-        return f"An error occurred adding the user to \
-            the group: {e}. Contact an administrator.", 500
+        return "An error occurred adding the user to \
+            the group. Contact an administrator.", 500
+
+def _member_key(base_url, group_id, user):
+    return f"member:{base_url}:{group_id}:{user.lower()}"
 
+def _remember_member(member_key):
+    '''Records that a user was just added to a group so immediate
+    retries don't need another membership check
+    :param member_key: cache key for the portal, group and user
+    :return None'''
+    tenants.cache.set(member_key, True, ONBOARDING_RESULT_TTL)
+
+@instrumented("membership check")
+def _is_group_member(base_url, group_id, user, mgr_token, redirect_uri):
+    '''
+    Checks if a user is in a group by searching the group's
+    members for the username, so the cost doesn't grow with the
+    size of the group. Falls back to the full member list on
+    portals without the userList endpoint
+    :param base_url: Base URL of your ArcGIS Portal 
+        (e.g. https://organization.example.com/<context>)
+    :param group_id: Group ID
+    :param user: Username to look for
+    :param mgr_token: Valid ArcGIS token for group manager
+    :param redirect_uri: Referer header
+    :return: (is_member:bool, error message:str or None)
+    '''
+    headers = {"referer": redirect_uri}
+    username = user.lower()
+    search_url = f"{base_url}/sharing/rest/community/groups/{group_id}/userList"
+    params = {"name": user, "num": 100, "start": 1, "f": "json"}
+    while True:
+        resp = tenants.http.get(search_url, params=params,
+                                headers=token_headers(mgr_token, headers),
+                                timeout=10)
+        resp.raise_for_status()
+        result = resp.json()
+        check_token_error(result)
+        if "error" in result:
+            break
+        # name also matches partial usernames and full names
+        if any(member.get("username", "").lower() == username
+               for member in result.get("users", [])):
+            return True, None
+        next_start = result.get("nextStart", -1)
+        if next_start in (-1, None) or next_start <= params["start"]:
+            return False, None
+        params["start"] = next_start
+
+    logging.info("Group user search unavailable, "
+                 "falling back to the member list")
+    members_url = f"{base_url}/sharing/rest/community/groups/{group_id}/users"
+    r = tenants.http.get(members_url,
+                         params={"f": "json"},
+                         headers=token_headers(mgr_token, headers),
+                         timeout=10)
+    r.raise_for_status()
+    members = r.json()
+    check_token_error(members)
+
+    if "error" in members:
+        return False, members["error"]["message"]
+
+    member_names = {members.get("owner")}
+    member_names.update(members.get("admins", []))
+    member_names.update(members.get("users", []))
+    return user in member_names, None
+
+@instrumented("group invite")
 def _group_invite_user(base_url, group_id, user, mgr_token, redirect_uri):
     '''
-    Invites a user to a group
+    Invites a user to a group. Concurrent invites to the same
+    group are batched into a single call
     :param base_url: Base URL of your ArcGIS Portal 
         (e.g. https://organization.example.com/<context>)
     :param group_id: Group ID
@@ -392,63 +1067,153 @@ def _group_invite_user(base_url, group_id, user, mgr_token, redirect_uri):
     :param redirect_url: Referer header
     :return: bool
     '''
+    return _invite_batcher.submit(base_url, group_id, user,
+                                  mgr_token, redirect_uri)
+
+def _group_invite_users(base_url, group_id, users, mgr_token, redirect_uri):
+    '''
+    Invites up to GROUP_BATCH_MAX_USERS users to a group in one call
+    :param base_url: Base URL of your ArcGIS Portal 
+        (e.g. https://organization.example.com/<context>)
+    :param group_id: Group ID
+    :param users: Usernames to invite
+    :param mgr_token: Valid ArcGIS token for group manager
+    :param redirect_url: Referer header
+    :return: dict of username -> bool
+    '''
     headers = {"referer": redirect_uri}
     invite_url = f"{base_url}/sharing/rest/community/groups/{group_id}/invite"
     data = {
-        "users": user,
+        "users": ",".join(users),
         "f": "json",
         "token": mgr_token
     }
-    resp = requests.post(invite_url, data=data,
-                         headers=headers, timeout=10)
+    resp = tenants.http.post(invite_url, data=data,
+                             headers=headers, timeout=10)
     resp.raise_for_status()
     result = resp.json()
+    check_token_error(result)
 
     if not result.get("success"):
-        return False
-    return True
+        return {user: False for user in users}
+    not_invited = set(result.get("notInvited", []))
+    return {user: user not in not_invited for user in users}
+
+def _join_by_invitation(base_url, group_id, user, mgr_token,
+                        user_token, redirect_uri):
+    '''
+    Invites a user from another org to a group and accepts the
+    invitation on their behalf. The invitation is remembered for
+    INVITATION_CACHE_TTL, so a retry after a failed or timed out
+    accept accepts the same invitation without inviting again or,
+    once its id is known, listing the user's invitations.
+    :param base_url: Base URL of your ArcGIS Portal
+        (e.g. https://organization.example.com/<context>)
+    :param group_id: Group ID
+    :param user: Username to add
+    :param mgr_token: Valid ArcGIS token for group manager
+    :param user_token: Valid ArcGIS token for the user
+    :param redirect_uri: Referer header
+    :return: (invited:bool, joined:bool)
+    '''
+    key = f"invitation:{base_url}:{group_id}:{user.lower()}"
+    invitation = tenants.cache.get(key)
+    if invitation is None:
+        if not _group_invite_user(base_url, group_id, user,
+                                  mgr_token, redirect_uri):
+            return False, False
+        invitation = {"id": None}
+        tenants.cache.set(key, invitation, INVITATION_CACHE_TTL)
+
+    if invitation["id"] is not None:
+        if _group_accept_invite(base_url, user, user_token,
+                                invitation["id"], redirect_uri):
+            tenants.cache.delete(key)
+            return True, True
+        logging.info("Remembered invitation could not be accepted, "
+                     "looking it up again")
+
+    # groups/invite doesn't return the invitation id,
+    # so find it among the user's invitations
+    invite_id = _find_group_invitation(base_url, user, user_token,
+                                       group_id, redirect_uri)
+    if invite_id is None:
+        return True, False
+    tenants.cache.set(key, {"id": invite_id}, INVITATION_CACHE_TTL)
+    if not _group_accept_invite(base_url, user, user_token,
+                                invite_id, redirect_uri):
+        return True, False
+    tenants.cache.delete(key)
+    return True, True
+
+@instrumented("find invitation")
+def _find_group_invitation(base_url, user, user_token, group_id,
+                           redirect_uri):
+    '''
+    Finds the user's invitation to a group. A new invitation can take
+    a moment to be listed, so the lookup is retried up to
+    INVITATION_LOOKUP_RETRIES times with a growing wait
+    :param base_url: Base URL of your ArcGIS Portal
+        (e.g. https://organization.example.com/<context>)
+    :param user: Username
+    :param user_token: Valid ArcGIS token for the user
+    :param group_id: Group ID
+    :param redirect_uri: Referer header
+    :return: invitation id, or None if not found
+    '''
+    headers = {"referer": redirect_uri}
+    url = f"{base_url}/sharing/rest/community/users/{user}/invitations"
+    for attempt in range(INVITATION_LOOKUP_RETRIES + 1):
+        resp = tenants.http.get(url, params={"f": "json"},
+                                headers=token_headers(user_token, headers),
+                                timeout=10)
+        resp.raise_for_status()
+        result = resp.json()
+        matches = [invite for invite in result.get("userInvitations", [])
+                   if invite.get("groupId") == group_id]
+        if matches:
+            # The newest, if the user was invited more than once
+            return max(matches, key=lambda invite:
+                       invite.get("created") or 0)["id"]
+
+        delay = INVITATION_LOOKUP_BACKOFF * 2 ** attempt
+        remaining = remaining_time()
+        if attempt == INVITATION_LOOKUP_RETRIES or \
+                (remaining is not None and delay >= remaining):
+            break
+        logging.info("Invitation not listed yet, looking again in %ss",
+                     delay)
+        time.sleep(delay)
+    return None
 
-def _group_accept_invite(base_url, user, user_token, group_id, redirect_uri):
+@instrumented("accept invite")
+def _group_accept_invite(base_url, user, user_token, invite_id, redirect_uri):
     '''
     Accepts invite on behalf of user
     :param base_url: Base URL of your ArcGIS Portal 
         (e.g. https://organization.example.com/<context>)
     :param user: Username to add
     :param user_token: Valid ArcGIS token for new group user
-    :param group_id: Group ID
+    :param invite_id: id of the invitation
     :param redirect_url: Referer header
     :return: bool
     '''
     headers = {"referer": redirect_uri}
-    user_invites_url = f"{base_url}/sharing/rest/community/users/{user}/invitations"
-    params = {"f": "json", "token": user_token}
-    resp = requests.get(user_invites_url,
-                        params=params,
-                        headers=headers,
-                        timeout=10)
+    accept_url = f"{base_url}/sharing/rest/community/users/{user}/invitations/{invite_id}/accept"
+    data = {
+        "f": "json",
+        "token": user_token
+    }
+    resp = tenants.http.post(accept_url, data=data,
+                             headers=headers, timeout=10)
     resp.raise_for_status()
     result = resp.json()
-    found = False
-    for invite in result["userInvitations"]:
-        if invite["groupId"] == group_id:
-            user_invites_url = f"{base_url}/sharing/rest/community/users/{user}/invitations/{invite['id']}/accept"
-            data = {
-                "f": "json",
-                "token": user_token
-            }
-            resp = requests.post(user_invites_url, data=data,
-                                 headers=headers, timeout=10)
-            resp.raise_for_status()
-            result = resp.json()
-            if "success" not in result or result["success"] is False:
-                return False
-            found = True
-            break
-
-    return found
+    return result.get("success") is True
 
+@instrumented("group add")
 def _group_add_user(base_url, group_id, user, mgr_token, redirect_uri):
-    '''Adds a user to the group
+    '''Adds a user to the group. Concurrent adds to the same
+    group are batched into a single call
     :param base_url: Base URL of your ArcGIS Portal 
         (e.g. https://organization.example.com/<context>)
     :param group_id: Group ID
@@ -457,70 +1222,148 @@ def _group_add_user(base_url, group_id, user, mgr_token, redirect_uri):
     :param redirect_url: Referer header
     :return: bool
     '''
+    added = _add_batcher.submit(base_url, group_id, user,
+                                mgr_token, redirect_uri)
+    if not added:
+        logging.info("User could not be added to group")
+        return False
+
+    logging.info("User added to group")
+    return True
+
+def _group_add_users(base_url, group_id, users, mgr_token, redirect_uri):
+    '''Adds up to GROUP_BATCH_MAX_USERS users to the group in one call
+    :param base_url: Base URL of your ArcGIS Portal 
+        (e.g. https://organization.example.com/<context>)
+    :param group_id: Group ID
+    :param users: Usernames to add
+    :param mgr_token: Valid ArcGIS token for group manager
+    :param redirect_url: Referer header
+    :return: dict of username -> bool
+    '''
     headers = {"referer": redirect_uri}
     add_url = f"{base_url}/sharing/rest/community/groups/{group_id}/addUsers"
     data = {
-        "users": user,
+        "users": ",".join(users),
         "f": "json",
         "token": mgr_token
     }
-    resp = requests.post(add_url, data=data,
-                         headers=headers, timeout=10)
+    resp = tenants.http.post(add_url, data=data,
+                             headers=headers, timeout=10)
     resp.raise_for_status()
     result = resp.json()
+    check_token_error(result)
+    if "error" in result:
+        raise RuntimeError(f"Error adding users to group: {result['error']}")
 
-    not_added = result.get("notAdded", [])
-    if user in not_added:
-        logging.info("User could not be added to group")
-        return False
+    not_added = set(result.get("notAdded", []))
+    return {user: user not in not_added for user in users}
 
-    logging.info("User added to group")
-    return True
 
-def _get_user_org(portal_url: str, token: str) -> str:
-    """
-    Determines what org the user is a member of using their token
+_add_batcher = GroupBatcher(_group_add_users, GROUP_BATCH_WINDOW_MS,
+                            GROUP_BATCH_MAX_USERS)
+_invite_batcher = GroupBatcher(_group_invite_users, GROUP_BATCH_WINDOW_MS,
+                               GROUP_BATCH_MAX_USERS)
 
-    Args:
-        portal_url (str): Base portal URL, e.g. 
-            "https://myorg.maps.arcgis.com" 
-            or "https://portal.domain.com/portal"
-        token (str): User's token
+class Identity:
+    '''Everything the handlers need to know about who is being onboarded
+    and the organisation they are joining, resolved once per request'''
 
-    Returns:
-        str: orgId of the user
-    """
-    # Query current user info
-    url = f"{portal_url}/sharing/rest/community/self"
-    params = {
-        "token": token,
-        "f": "json"
-    }
+    def __init__(self, username=None, org_id=None, group_ids=(),
+                 mgr_org_id=None, default_credits=-1):
+        self.username = username
+        self.org_id = org_id
+        self.group_ids = frozenset(group_ids)
+        self.mgr_org_id = mgr_org_id
+        self.default_credits = default_credits
 
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-
-        user_info = response.json()
+    @property
+    def invite_required(self):
+        '''Users outside the manager's org must be invited to groups'''
+        return self.org_id is None or self.org_id != self.mgr_org_id
 
-        if "error" in user_info:
-            raise RuntimeError(f"Error fetching user info: {user_info['error']}")
 
-        cur_user_org = user_info.get("orgId")
-        logging.info(f"User org: {cur_user_org}")
-
-        return cur_user_org
-    except Exception as e:
-        logging.error("An error occurred getting the \
-                      org id: %s", traceback.format_exc())
-        return None      
+@instrumented("identity")
+def _resolve_identity(portal_url, mgr_token, user_token=None):
+    """
+    Resolves the identity of the user and the manager's organisation.
+    The user's username, orgId and groups come from a single
+    community/self call. The manager's org and the portal's default
+    credit assignment are cached for IDENTITY_CACHE_TTL.
+
+    :param portal_url: Base portal URL, e.g. 
+        "https://myorg.maps.arcgis.com" 
+        or "https://portal.domain.com/portal"
+    :param mgr_token: Valid ArcGIS token for group manager
+    :param user_token: User's token, if a user has signed in
+    :return Identity
+    """
+    portal_info = _get_mgr_portal_info(portal_url, mgr_token)
+    _credits = portal_info.get("defaultUserCreditAssignment")
+    identity = Identity(
+        mgr_org_id=(portal_info.get("user") or {}).get("orgId"),
+        default_credits=-1 if _credits is None else _credits)
+
+    if user_token is not None:
+        user_info = _get_community_self(portal_url, user_token)
+        identity.username = user_info.get("username")
+        identity.org_id = user_info.get("orgId")
+        identity.group_ids = frozenset(group["id"] for group in
+                                       user_info.get("groups") or [])
+        logging.info("User %s in org %s", identity.username, identity.org_id)
+    return identity
+
+
+def _get_mgr_portal_info(portal_url, mgr_token):
+    '''Gets portals/self as the manager, cached for IDENTITY_CACHE_TTL
+    as the manager's org and the portal defaults rarely change
+    :param portal_url: base url for portal/agol
+    :param mgr_token: Valid ArcGIS token for group manager
+    :return dict'''
+    def load():
+        response = tenants.http.get(f"{portal_url}/sharing/rest/portals/self",
+                                    params={"f": "json"},
+                                    headers=token_headers(mgr_token),
+                                    timeout=10)
+        response.raise_for_status()
+        portal_info = response.json()
+        check_token_error(portal_info)
+        if "error" in portal_info:
+            raise RuntimeError(f"Error fetching portal info: {portal_info['error']}")
+        return portal_info
+
+    return tenants.cached(f"portal-info:{portal_url}", IDENTITY_CACHE_TTL, load,
+                          CACHE_STALE_TTL)
+
+
+def _get_community_self(portal_url, token):
+    '''Gets the signed in user's details, including their groups
+    :param portal_url: base url for portal/agol
+    :param token: User's token
+    :return dict
+    :raises UserTokenError: if the user's token is rejected'''
+    response = tenants.http.get(f"{portal_url}/sharing/rest/community/self",
+                                params={"f": "json"},
+                                headers=token_headers(token),
+                                timeout=10)
+    response.raise_for_status()
+    user_info = response.json()
+    try:
+        check_token_error(user_info)
+    except InvalidTokenError as e:
+        raise UserTokenError(str(e)) from e
+    if "error" in user_info:
+        raise RuntimeError(f"Error fetching user info: {user_info['error']}")
+    return user_info
 
 
+@instrumented("create user")
 def _create_portal_user(portal_url: str, token: str,
                 username: str, password: str,
                 firstname: str, lastname: str,
                 email: str, role: str, user_type: str,
-                redirect_uri: str, group_id: str):
+                redirect_uri: str, group_id: str,
+                default_credits=None):
     """
     Creates a new user in ArcGIS using the REST API.
 
@@ -537,57 +1380,27 @@ def _create_portal_user(portal_url: str, token: str,
         user_type (str): License type, e.g., 'creatorUT', 'viewerUT', etc.
         redirect_uri: redirect uri used for token referer
         group_id: group to be added to
-
+        default_credits: the portal's default credit assignment,
+            looked up if not given
 
     Returns:
         bool: success
     """
 
-    # Get default credit assignment
-    reqs = requests.get(f"{portal_url}/sharing/rest/portals/self?f=json&token={token}",
-                        timeout=10)
-    data = reqs.json()
-    _credits = data.get("defaultUserCreditAssignment")
-    if _credits is None:
-        _credits = -1
-
     headers = {"referer": redirect_uri}
-    if "arcgis.com" in portal_url:
-        params = {
-            "f": "json",
-            "token": token,
-            "invitationList": json.dumps({
-                "invitations": [
-                    {
-                        "username": username,
-                        "firstname": firstname,
-                        "lastname": lastname,
-                        "fullname": firstname + " " + lastname,
-                        "email": email,
-                        "password": password,
-                        "role": role,
-                        "userLicenseType": user_type,
-                        "groups": group_id,
-                        "userCreditAssignment": _credits,
-                        "userType": "arcgisonly"
-                    }
-                ],
-                "apps": [],
-                "appBundles": [],
-            })
-        }
-        res = requests.post(f"{portal_url}/sharing/rest/portals/self/invite",
-                            data=params, headers=headers, timeout=10)
-        resp = res.json()
-        logging.info(resp)
-        if not resp.get("error"):
-            if username in resp["notInvited"]:
-                logging.error("Unable to create " + username)
-                return False, "Username may already exist."
-        else:
-            logging.error("Can't create " + username)
-            return False, resp["error"]["details"]
-        return True, None  
+    if _is_arcgis_online(portal_url):
+        # Get default credit assignment
+        _credits = default_credits
+        if _credits is None:
+            _credits = _resolve_identity(portal_url, token).default_credits
+        results = _invite_portal_users(portal_url, token, [{
+            "username": username,
+            "password": password,
+            "firstname": firstname,
+            "lastname": lastname,
+            "email": email
+        }], role, user_type, redirect_uri, group_id, _credits)
+        return results[username]
 
     else:
         url = f"{portal_url}/portaladmin/security/users/createUser"
@@ -604,18 +1417,89 @@ def _create_portal_user(portal_url: str, token: str,
         }
 
         try:
-            response = requests.post(url, data=data, 
-                                     headers=headers, timeout=10)
+            response = tenants.http.post(url, data=data, 
+                                         headers=headers, timeout=10)
             response.raise_for_status()
             result = response.json()
+            check_token_error(result)
 
             if "error" in result:
                 logging.error(f"Error creating user: \
                               {result['error']['details']}")
-                raise RuntimeError(result)
+                return False, result["error"].get("details")
             return True, None
 
-        except Exception as e:
+        except (InvalidTokenError, PortalUnavailableError,
+                DeadlineExceededError):
+            raise
+        except Exception:
             logging.error("An error occurred creating the \
                           user: %s", traceback.format_exc())
-            return False, e
+            return False, "An unexpected error occurred"
+
+
+def _invite_portal_users(portal_url: str, token: str, users: list,
+                role: str, user_type: str, redirect_uri: str,
+                group_id: str, credits: int):
+    """
+    Creates ArcGIS Online users with one portals/self/invite call.
+
+    Args:
+        portal_url (str): Base portal URL, e.g. https://myorg.maps.arcgis.com
+        token (str): Admin token
+        users (list): dicts with username, password, firstname,
+            lastname and email for each new user
+        role (str): Role, e.g., 'iAAAAAAAAA', 'iBBBBBBBB'
+        user_type (str): License type, e.g., 'creatorUT', 'viewerUT', etc.
+        redirect_uri: redirect uri used for token referer
+        group_id: group to be added to
+        credits (int): credits to assign each user, -1 for unlimited
+
+    Returns:
+        dict: username -> (success: bool, message)
+    """
+    headers = {"referer": redirect_uri}
+    params = {
+        "f": "json",
+        "token": token,
+        "invitationList": json.dumps({
+            "invitations": [
+                {
+                    "username": user["username"],
+                    "firstname": user["firstname"],
+                    "lastname": user["lastname"],
+                    "fullname": user["firstname"] + " " + user["lastname"],
+                    "email": user["email"],
+                    "password": user["password"],
+                    "role": role,
+                    "userLicenseType": user_type,
+                    "groups": group_id,
+                    "userCreditAssignment": credits,
+                    "userType": "arcgisonly"
+                } for user in users
+            ],
+            "apps": [],
+            "appBundles": [],
+        })
+    }
+    res = tenants.http.post(f"{portal_url}/sharing/rest/portals/self/invite",
+                            data=params, headers=headers, timeout=10)
+    resp = res.json()
+    logging.info(resp)
+    check_token_error(resp)
+    if resp.get("error"):
+        logging.error("Can't create %s users", len(users))
+        return {user["username"]: (False, resp["error"]["details"])
+                for user in users}
+
+    not_invited = set(resp.get("notInvited", []))
+    results = {}
+    for user in users:
+        if user["username"] in not_invited:
+            logging.error("Unable to create " + user["username"])
+            results[user["username"]] = (False, "Username may already exist.")
+        else:
+            results[user["username"]] = (True, None)
+    return results
+
+_warm_up_on_start()
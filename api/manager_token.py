@@ -0,0 +1,120 @@
+'''The group manager's token, cached per tenant and shared by
+the requests it serves.'''
+import logging
+import os
+import time
+import traceback
+
+import tenants
+from portal_session import InvalidTokenError, PortalUnavailableError
+from request_tracing import DeadlineExceededError, instrumented
+
+# Seconds before expiry at which a cached manager token is refreshed
+MGR_TOKEN_REFRESH_MARGIN = int(os.getenv("MGR_TOKEN_REFRESH_MARGIN", "300"))
+
+
+def get_grp_mgr_token(user, pword, referer):
+    '''Gets a token for the group manager/user creator,
+    reusing a cached token until it is close to expiry.
+    Only one refresh runs at a time per worker
+    :param user: username
+    :param pword: password
+    :param referer: referer header
+    :return token:str'''
+    key = _mgr_token_key(user, referer)
+    cached = tenants.cache.get(key)
+    if _mgr_token_is_fresh(cached):
+        return cached["token"]
+
+    with tenants.cache_load_locks.hold(key, "manager token"):
+        # Another invocation or instance may have refreshed
+        # while we waited
+        cached = tenants.cache.get(key)
+        if _mgr_token_is_fresh(cached):
+            return cached["token"]
+
+        token_info = _request_grp_mgr_token(user, pword, referer)
+        if token_info is None:
+            return None
+        tenants.cache.set(key, token_info, token_info["expires"] - time.time())
+        return token_info["token"]
+
+
+def _mgr_token_key(user, referer):
+    return f"mgr-token:{tenants.current().portal}:{user}:{referer}"
+
+
+def _mgr_token_is_fresh(token_info):
+    '''Checks a cached token is outside the refresh margin
+    :param token_info: cached {"token", "expires"} dict or None
+    :return bool'''
+    if not token_info:
+        return False
+    return token_info["expires"] - MGR_TOKEN_REFRESH_MARGIN > time.time()
+
+
+def invalidate_grp_mgr_token(user, referer, token):
+    '''Drops a manager token from the cache, e.g. after
+    the portal rejects it
+    :param user: username
+    :param referer: referer header
+    :param token: the rejected token
+    :return None'''
+    key = _mgr_token_key(user, referer)
+    with tenants.cache_load_locks.hold(key, "manager token"):
+        cached = tenants.cache.get(key)
+        # Keep a newer token another invocation has fetched
+        if cached and cached["token"] == token:
+            tenants.cache.delete(key)
+
+
+@instrumented("manager token")
+def _request_grp_mgr_token(user, pword, referer):
+    '''Requests a token for the group manager/user creator
+    using legacy generateToken as oauth requires user
+    auth for adding users to groups
+    :param user: username
+    :param pword: password
+    :param referer: referer header
+    :return {"token": str, "expires": epoch seconds} or None'''
+    url = f"{tenants.current().portal}/sharing/rest/generateToken"
+    data = {
+        "username": user,
+        "password": pword,
+        "client": "referer",
+        "referer": referer,
+        "expiration": 60,
+        "f": "json"
+    }
+    try:
+        response = tenants.http.post(url, data=data, timeout=10)
+        response.raise_for_status()
+        token_info = response.json()
+        # expires is in epoch milliseconds
+        expires = token_info.get("expires")
+        expires = expires / 1000 if expires else time.time() + 60 * 60
+        return {"token": token_info["token"], "expires": expires}
+    except (PortalUnavailableError, DeadlineExceededError):
+        raise
+    except:
+        logging.error(traceback.format_exc())
+        return None
+
+
+def with_mgr_token(call):
+    '''Runs call(mgr_token) with the cached manager token.
+    If the portal rejects the token it is dropped, a new one
+    is fetched and the call is retried once
+    :param call: function taking the manager token
+    :return: result of call'''
+    tenant = tenants.current()
+    token = get_grp_mgr_token(tenant.mgr_user, tenant.mgr_pword,
+                              tenant.redirect_uri)
+    try:
+        return call(token)
+    except InvalidTokenError:
+        logging.warning("Manager token rejected, requesting a new one")
+        invalidate_grp_mgr_token(tenant.mgr_user, tenant.redirect_uri, token)
+        token = get_grp_mgr_token(tenant.mgr_user, tenant.mgr_pword,
+                                  tenant.redirect_uri)
+        return call(token)
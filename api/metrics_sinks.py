@@ -0,0 +1,114 @@
+'''Where the per-request metrics of RequestTrace are sent.'''
+import json
+import logging
+import os
+
+# Where per-request metrics go: "log", "opentelemetry" or "none"
+METRICS_SINK = os.getenv("METRICS_SINK", "log")
+
+
+class LogMetricsSink:
+    '''Logs each request summary as one JSON line, which shows up in
+    Application Insights traces and can be parsed with parse_json'''
+
+    def emit(self, summary):
+        logging.info("Request metrics: %s", json.dumps(summary))
+
+
+class InMemoryMetricsSink:
+    '''Keeps request summaries in memory, e.g. for tests'''
+
+    def __init__(self):
+        self.summaries = []
+
+    def emit(self, summary):
+        self.summaries.append(summary)
+
+
+class NullMetricsSink:
+    def emit(self, summary):
+        pass
+
+
+class OpenTelemetryMetricsSink:
+    '''
+    Sends each request as a span with a client (dependency) span per
+    stage, and records stage durations in a histogram. Exported to
+    Application Insights when azure-monitor-opentelemetry is installed
+    and APPLICATIONINSIGHTS_CONNECTION_STRING is set.
+    '''
+
+    def __init__(self):
+        from opentelemetry import metrics, trace
+        if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+            from azure.monitor.opentelemetry import configure_azure_monitor
+            configure_azure_monitor()
+        self._trace = trace
+        self._tracer = trace.get_tracer("arcgis-onboarding")
+        meter = metrics.get_meter("arcgis-onboarding")
+        self._stage_duration = meter.create_histogram(
+            "onboarding.stage.duration", unit="ms",
+            description="Wall time of each onboarding stage")
+        self._request_duration = meter.create_histogram(
+            "onboarding.request.duration", unit="ms",
+            description="Wall time of each onboarding request")
+
+    def emit(self, summary):
+        start_ns = int(summary["started_at"] * 1e9)
+        root = self._tracer.start_span(
+            summary["route"], start_time=start_ns,
+            kind=self._trace.SpanKind.SERVER,
+            attributes={"http.status_code": summary["status_code"] or 0,
+                        "onboarding.tenant": summary["tenant"] or "",
+                        "onboarding.critical_path":
+                            " > ".join(summary["critical_path"])})
+        context = self._trace.set_span_in_context(root)
+        for stage in summary["stages"]:
+            span = self._tracer.start_span(
+                stage["name"], context=context,
+                start_time=start_ns + int(stage["start_ms"] * 1e6),
+                kind=self._trace.SpanKind.CLIENT,
+                attributes={key: stage[key] for key in
+                            ("status", "calls", "retries", "bytes")})
+            span.end(end_time=start_ns + int(
+                (stage["start_ms"] + stage["duration_ms"]) * 1e6))
+            self._stage_duration.record(stage["duration_ms"], {
+                "route": summary["route"], "stage": stage["name"],
+                "status": stage["status"]})
+        root.end(end_time=start_ns + int(summary["duration_ms"] * 1e6))
+        self._request_duration.record(summary["duration_ms"], {
+            "route": summary["route"],
+            "tenant": summary["tenant"] or "",
+            "status_code": summary["status_code"] or 0})
+
+
+def _create_metrics_sink(name):
+    '''Creates the metrics sink named by METRICS_SINK
+    :param name: "log", "opentelemetry" or "none"
+    :return sink with an emit(summary) method'''
+    if name == "opentelemetry":
+        try:
+            return OpenTelemetryMetricsSink()
+        except ImportError:
+            logging.warning("opentelemetry is not installed, "
+                            "logging request metrics instead")
+    elif name == "none":
+        return NullMetricsSink()
+    return LogMetricsSink()
+
+
+def set_metrics_sink(sink):
+    '''Replaces the metrics sink, e.g. with an InMemoryMetricsSink
+    :param sink: object with an emit(summary) method
+    :return the previous sink'''
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def emit(summary):
+    '''Sends a request summary to the current sink'''
+    _sink.emit(summary)
+
+
+_sink = _create_metrics_sink(METRICS_SINK)
@@ -0,0 +1,127 @@
+'''Signed onboarding links.
+
+Makes links that carry the group, redirect uri, licence and role of a
+config record, signed with the first of LINK_SIGNING_KEYS, so the API
+can onboard from them without looking the record up. Uses the same
+environment variables as the function app (PORTAL_URL, MGR_USER,
+MGR_PWORD, CONFIG_LAYER_ID, CALLBACK_URL, TENANTS, LINK_SIGNING_KEYS).
+
+A link stops working when it expires, when its record is deleted from
+the config table, or when its id (or *) is added to the record's
+revoked_links field (see LINK_REVOKED_FIELD).
+
+Usage:
+    python onboarding_links.py create --globalid <globalid> \\
+        --expires 3d --app-url https://<app>/index.html
+    python onboarding_links.py --tenant <tenant> create \\
+        --globalid <globalid> --expires 2w
+    python onboarding_links.py inspect <link>
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+import function_app as app
+import signed_links
+import tenants
+from config_store import normalise_globalid
+from manager_token import with_mgr_token
+
+DURATION_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_expiry(value, now=None):
+    '''Reads an expiry as a duration (90m, 12h, 3d, 2w) or an ISO date
+    :param value: duration or ISO 8601 date/time, UTC if no zone given
+    :param now: epoch seconds durations count from
+    :return epoch seconds'''
+    match = re.fullmatch(r"(\d+)([mhdw])", value.strip())
+    if match:
+        now = time.time() if now is None else now
+        return int(now + int(match.group(1)) * DURATION_UNITS[match.group(2)])
+    try:
+        expires = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not a duration like 3d or an ISO date")
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return int(expires.timestamp())
+
+
+def create_link(globalid, expires):
+    '''Signs a link for a config record of the current tenant
+    :param globalid: GlobalID of the config record
+    :param expires: expiry, epoch seconds
+    :return (link, claims)'''
+    app_details = with_mgr_token(
+        lambda token: app._get_onboarding_details(globalid, None, token))
+    for attr in ("group_id", "redirect_uri"):
+        if not app_details.get(attr):
+            raise SystemExit(f"Config record {globalid} has no {attr}")
+    claims = {
+        "c": normalise_globalid(globalid),
+        # Short random id, listed in revoked_links to withdraw the link
+        "i": signed_links.b64url_encode(os.urandom(6)),
+        "g": app_details["group_id"],
+        "r": app_details["redirect_uri"],
+        "l": app_details.get("user_license_id") or None,
+        "o": app_details.get("user_role_id") or None,
+        "e": expires
+    }
+    if tenants.current().name != tenants.DEFAULT_TENANT:
+        claims["t"] = tenants.current().name
+    return signed_links.sign_link(claims), claims
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenant", default=tenants.DEFAULT_TENANT,
+                        help="tenant the link onboards into")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="sign a link for a record")
+    create.add_argument("--globalid", required=True,
+                        help="GlobalID of the config record to onboard into")
+    create.add_argument("--expires", required=True, type=parse_expiry,
+                        help="duration like 12h or 3d, or an ISO date")
+    create.add_argument("--app-url",
+                        help="index.html url to print a full link for")
+    inspect = commands.add_parser("inspect",
+                                  help="check a link and show its claims")
+    inspect.add_argument("link")
+    args = parser.parse_args(argv)
+
+    if not signed_links.LINK_SIGNING_KEYS:
+        raise SystemExit("LINK_SIGNING_KEYS is not set")
+
+    with tenants.use(args.tenant):
+        if args.command == "create":
+            link, claims = create_link(args.globalid, args.expires)
+            print(json.dumps({
+                "link": link,
+                "link_id": claims["i"],
+                "expires": datetime.fromtimestamp(
+                    claims["e"], tz=timezone.utc).isoformat(),
+                "url": f"{args.app_url}?link={link}" if args.app_url else None
+            }, indent=2))
+            return 0
+
+        claims, error = signed_links.verify_link(args.link)
+        if claims is None:
+            print(error, file=sys.stderr)
+            return 1
+        revoked = with_mgr_token(
+            lambda token: signed_links.link_revoked(claims, token))
+    print(json.dumps(dict(claims, revoked=revoked), indent=2))
+    if revoked is None:
+        print("Could not read the config table to check if the link "
+              "was withdrawn", file=sys.stderr)
+    return 1 if revoked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+'''The session portal calls are made with, and the errors they raise.
+
+PortalSession applies the worker's traffic control to every call:
+rate limiting, backoff when throttled and a circuit breaker.
+'''
+import logging
+import os
+import random
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import (ConnectTimeoutError, MaxRetryError,
+                                ReadTimeoutError)
+from urllib3.util.retry import Retry
+
+from request_tracing import (DeadlineExceededError, deadline_timeout,
+                             record_portal_call, remaining_time)
+
+# ArcGIS error codes for invalid/expired tokens
+INVALID_TOKEN_CODES = (498, 499)
+
+# Keep-alive connections kept per portal host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+# Hard cap on concurrent connections per host, 0 for no cap
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "0"))
+# Retries for failed connections and idempotent requests
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+
+# Requests per second a worker sends to each class of portal endpoint,
+# 0 for no limit. Off by default: ArcGIS publishes no fixed limits and
+# throttled calls are backed off and retried anyway. A user's own
+# sign-in code exchange is never limited here
+RATE_LIMITS = {
+    "auth": float(os.getenv("RATE_LIMIT_AUTH", "0")),
+    "query": float(os.getenv("RATE_LIMIT_QUERY", "0")),
+    "write": float(os.getenv("RATE_LIMIT_WRITE", "0")),
+    "admin": float(os.getenv("RATE_LIMIT_ADMIN", "0")),
+    # Anonymous checks as users type, kept apart so they can't hold
+    # up signups
+    "username": float(os.getenv("RATE_LIMIT_USERNAME", "10")),
+}
+# Longest a call waits for the rate limiter before failing
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+# Retries for a call the portal throttled (HTTP or error code 429)
+THROTTLE_RETRIES = int(os.getenv("THROTTLE_RETRIES", "3"))
+# Base and maximum seconds of exponential backoff between retries
+THROTTLE_BACKOFF_BASE = float(os.getenv("THROTTLE_BACKOFF_BASE", "0.5"))
+THROTTLE_BACKOFF_MAX = float(os.getenv("THROTTLE_BACKOFF_MAX", "8"))
+# Consecutive failures after which portal calls fail fast
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+# Seconds calls fail fast before a trial call is let through
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+
+class PortalUnavailableError(Exception):
+    '''Raised instead of calling the portal when it is throttling
+    or failing, so requests fail fast with a retry hint'''
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class InvalidTokenError(Exception):
+    '''Raised when the portal rejects a token as invalid or expired'''
+
+
+class UserTokenError(Exception):
+    '''Raised when the portal rejects the signed in user's token. Kept
+    apart from InvalidTokenError so it never drops the manager token'''
+
+
+def check_token_error(data):
+    '''Raises InvalidTokenError if a portal response
+    reports an invalid or expired token
+    :param data: parsed json response
+    :return None'''
+    error = data.get("error") if isinstance(data, dict) else None
+    if error and error.get("code") in INVALID_TOKEN_CODES:
+        raise InvalidTokenError(error.get("message", "Invalid token"))
+
+
+def token_headers(token, headers=None):
+    '''Headers that carry a token for a GET, keeping it out of the
+    url, which logs and error messages record
+    :param token: ArcGIS token
+    :param headers: other headers for the call
+    :return dict'''
+    return dict(headers or {}, **{"X-Esri-Authorization": f"Bearer {token}"})
+
+
+class AdaptiveRateLimiter:
+    '''
+    Token bucket for one class of portal endpoint. The rate is halved
+    each time the portal throttles a call and creeps back up to the
+    configured rate as calls succeed. A rate of 0 lets every call
+    through.
+    '''
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self._tokens = max(rate, 1)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        '''Takes a token, waiting up to max_wait seconds for one
+        :param max_wait: seconds
+        :return None'''
+        if self.max_rate <= 0:
+            return
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(self.rate, 1), self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_for = (1 - self._tokens) / self.rate
+            if now + wait_for > deadline:
+                raise PortalUnavailableError(
+                    f"Too many {self.name} requests to ArcGIS", wait_for)
+            time.sleep(wait_for)
+
+    def record_success(self):
+        if self.max_rate <= 0:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def record_throttle(self):
+        if self.max_rate <= 0:
+            return
+        with self._lock:
+            self.rate = max(self.max_rate * 0.05, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+
+class CircuitBreaker:
+    '''
+    Stops calling the portal after BREAKER_FAILURE_THRESHOLD
+    consecutive failures. Calls fail fast for BREAKER_COOLDOWN seconds,
+    then a single trial call decides whether to close the breaker.
+    '''
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        '''Raises PortalUnavailableError if the breaker is open'''
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise PortalUnavailableError(
+                    "ArcGIS is not responding", max(remaining, 1))
+            self._trial_running = True
+
+    def cancel_trial(self):
+        '''Lets another call be the trial if this one never reached
+        the portal'''
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Portal recovered, closing circuit breaker")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logging.error("Portal failing, opening circuit breaker")
+                self._opened_at = time.monotonic()
+
+
+def endpoint_class(method, url):
+    '''Groups portal endpoints for rate limiting
+    :param method: http method
+    :param url: request url
+    :return "user", "auth", "admin", "write", "username" or "query"'''
+    path = url.split("?")[0]
+    if path.endswith("/oauth2/token"):
+        # Each user's own code exchange, limited per user by the portal
+        return "user"
+    if path.endswith("/generateToken"):
+        return "auth"
+    if "/portaladmin/" in path or path.endswith("/portals/self/invite"):
+        return "admin"
+    if path.endswith("/checkUsernames"):
+        return "username"
+    if method.upper() == "POST" and "/community/" in path:
+        return "write"
+    return "query"
+
+
+def _throttle_delay(response):
+    '''Checks if the portal throttled a call
+    :param response: requests.Response
+    :return seconds to wait from Retry-After (0 if not given),
+        or None if the call wasn't throttled'''
+    throttled = response.status_code == 429
+    if not throttled and response.content[:12].lstrip().startswith(b'{"error"'):
+        try:
+            throttled = response.json()["error"].get("code") == 429
+        except (ValueError, KeyError, AttributeError):
+            pass
+    if not throttled:
+        return None
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0
+
+
+def _timed_out(error):
+    '''Checks if a failed call timed out, including a read timeout
+    that urllib3 retried and requests reports as a ConnectionError
+    :param error: requests.RequestException
+    :return bool'''
+    if isinstance(error, requests.Timeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(reason, MaxRetryError) and isinstance(
+        reason.reason, (ReadTimeoutError, ConnectTimeoutError))
+
+
+class DeadlineRetry(Retry):
+    '''
+    Retry that gives up on a failed connection or read while a request
+    has a deadline and no time is left, and never retries a read then:
+    each try gets the whole time left, so a retried read would run
+    past the deadline.
+    '''
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        remaining = remaining_time()
+        if error is not None and remaining is not None and (
+                remaining <= 0 or self._is_read_error(error)):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool,
+                                 _stacktrace)
+
+
+class PortalSession(requests.Session):
+    '''
+    Session that applies the worker's traffic control to every portal
+    call: a rate limiter per endpoint class, exponential backoff with
+    jitter when throttled (honouring Retry-After), and a circuit breaker
+    that fails fast once the portal is clearly degraded.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.limiters = {name: AdaptiveRateLimiter(name, rate)
+                         for name, rate in RATE_LIMITS.items()}
+        self.limiters["user"] = AdaptiveRateLimiter("user", 0)
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD,
+                                      BREAKER_COOLDOWN)
+
+    def request(self, method, url, *args, **kwargs):
+        limiter = self.limiters[endpoint_class(method, url)]
+        self.breaker.before_call()
+        for attempt in range(THROTTLE_RETRIES + 1):
+            remaining = remaining_time()
+            max_wait = RATE_LIMIT_MAX_WAIT if remaining is None \
+                else min(RATE_LIMIT_MAX_WAIT, remaining)
+            try:
+                limiter.acquire(max_wait)
+                if "timeout" in kwargs:
+                    kwargs["timeout"] = deadline_timeout(kwargs["timeout"])
+                # A call whose timeout was cut by the deadline times
+                # out because the deadline is reached
+                cut = remaining is not None and "timeout" in kwargs \
+                    and remaining_time() <= max(kwargs["timeout"])
+            except (PortalUnavailableError, DeadlineExceededError):
+                self.breaker.cancel_trial()
+                if max_wait < RATE_LIMIT_MAX_WAIT:
+                    raise DeadlineExceededError() from None
+                raise
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                if _timed_out(e) and cut:
+                    # Cut short by our deadline, not the portal's fault
+                    self.breaker.cancel_trial()
+                    raise DeadlineExceededError() from None
+                self.breaker.record_failure()
+                raise
+
+            retry_after = _throttle_delay(response)
+            if retry_after is None:
+                record_portal_call(response, attempt)
+                limiter.record_success()
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return response
+
+            limiter.record_throttle()
+            backoff = min(THROTTLE_BACKOFF_MAX,
+                          THROTTLE_BACKOFF_BASE * 2 ** attempt)
+            delay = max(retry_after, backoff * random.uniform(0.5, 1))
+            if attempt == THROTTLE_RETRIES or delay > THROTTLE_BACKOFF_MAX:
+                break
+            remaining = remaining_time()
+            if remaining is not None and delay >= remaining:
+                self.breaker.cancel_trial()
+                raise DeadlineExceededError()
+            logging.warning("Portal throttled %s call, retrying in %.2fs",
+                            limiter.name, delay)
+            time.sleep(delay)
+
+        self.breaker.record_failure()
+        raise PortalUnavailableError("ArcGIS is throttling requests",
+                                     max(retry_after, THROTTLE_BACKOFF_BASE))
+
+
+def create_http_session():
+    '''Creates the pooled keep-alive session shared by every
+    portal call a worker makes to one tenant
+    :return PortalSession'''
+    session = PortalSession()
+    # Never carry cookies from one user's calls into another's
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    # Connection errors are retried for every method as the request
+    # never reached the portal, other failures only for GETs
+    retry = DeadlineRetry(total=HTTP_RETRIES,
+                          connect=HTTP_RETRIES,
+                          read=HTTP_RETRIES,
+                          status=HTTP_RETRIES,
+                          backoff_factor=0.3,
+                          status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset({"GET"}),
+                          raise_on_status=False)
+    capped = HTTP_MAX_CONNECTIONS_PER_HOST > 0
+    adapter = HTTPAdapter(
+        pool_maxsize=HTTP_MAX_CONNECTIONS_PER_HOST if capped else HTTP_POOL_SIZE,
+        pool_block=capped,
+        max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,216 @@
+'''Sampling profiler for a share of the onboarding requests.'''
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+import requests
+
+from request_tracing import current_trace
+
+# Profile 1 in every N check-permissions and signup requests, 0 for off
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Milliseconds between stack samples of a profiled request
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Local directory, or a blob container url with a SAS token, that
+# profiles are written to
+PROFILE_PATH = os.getenv("PROFILE_PATH", "/tmp/onboarding-profiles")
+
+
+class SamplingProfiler:
+    '''
+    Wall clock sampling profiler for one request. A background thread
+    records the stacks of the threads working on the request every
+    interval: the handler's thread and fan-out threads while they run
+    its calls. Time spent waiting on the portal shows up as stacks in
+    requests and the socket code.
+    '''
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        # (thread name, stack from root to leaf) in sample order
+        self.samples = []
+        self._threads = Counter()
+        self._names = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True,
+                                         name="profiler")
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self.add_thread()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._sampler.join()
+        self.remove_thread()
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        return False
+
+    def add_thread(self):
+        '''Samples the calling thread until remove_thread'''
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] += 1
+            self._names[ident] = threading.current_thread().name
+
+    def remove_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = [(ident, self._names[ident])
+                           for ident in self._threads]
+            for ident, thread_name in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples.append((thread_name, _frame_stack(frame)))
+
+    def collapsed(self):
+        '''Folds the samples into collapsed stack lines, one per
+        distinct stack, as read by flamegraph.pl and speedscope
+        :return str'''
+        counts = Counter(self.samples)
+        return "".join(f"{';'.join((thread_name,) + stack)} {count}\n"
+                       for (thread_name, stack), count
+                       in sorted(counts.items()))
+
+    def speedscope(self):
+        '''Builds a speedscope file with a sampled profile per thread
+        :return dict'''
+        frames = {}
+        by_thread = {}
+        for thread_name, stack in self.samples:
+            by_thread.setdefault(thread_name, []).append(
+                [frames.setdefault(frame, len(frames)) for frame in stack])
+        interval_ms = self.interval * 1000
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "arcgis-self-service-onboarding",
+            "shared": {"frames": [{"name": frame} for frame in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": thread_name,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": len(samples) * interval_ms,
+                "samples": samples,
+                "weights": [interval_ms] * len(samples)
+            } for thread_name, samples in by_thread.items()]
+        }
+
+
+def _frame_stack(frame):
+    '''Names the functions of a stack, from the root to frame
+    :return tuple of "function (file:line)" strings'''
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} "
+                     f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+@contextmanager
+def profiling_thread():
+    '''Includes the calling thread in the running request's profile'''
+    trace = current_trace.get()
+    profiler = trace.profiler if trace is not None else None
+    if profiler is None:
+        yield
+        return
+    profiler.add_thread()
+    try:
+        yield
+    finally:
+        profiler.remove_thread()
+
+
+def profiled(handler):
+    '''Profiles 1 in PROFILE_SAMPLE_RATE requests to a handler and,
+    while profiling is on, adds a Server-Timing header with the
+    request's stages to every response. Goes inside _traced'''
+    if PROFILE_SAMPLE_RATE <= 0:
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(req):
+        trace = current_trace.get()
+        if random.randrange(PROFILE_SAMPLE_RATE):
+            response = handler(req)
+        else:
+            profile_id = f"{trace.route}-{time.strftime('%Y%m%dT%H%M%S')}" \
+                f"-{os.urandom(4).hex()}"
+            trace.profiler = SamplingProfiler(profile_id,
+                                              PROFILE_INTERVAL_MS / 1000)
+            with trace.profiler:
+                response = handler(req)
+            response.headers["X-Profile-Id"] = profile_id
+            threading.Thread(target=_save_profile, args=(trace.profiler,),
+                             daemon=True).start()
+        response.headers["Server-Timing"] = _server_timing(trace)
+        return response
+    return wrapper
+
+
+def _server_timing(trace):
+    '''Builds a Server-Timing header from the request's top level
+    stages and its total time so far
+    :param trace: RequestTrace
+    :return str'''
+    metrics = [f"{stage['name'].replace(' ', '-')};dur={stage['duration_ms']}"
+               for stage in sorted(trace.stages,
+                                   key=lambda stage: stage["start_ms"])
+               if stage["parent"] is None]
+    metrics.append(f"total;dur={trace.elapsed_ms():.1f}")
+    return ", ".join(metrics)
+
+
+def _save_profile(profiler):
+    '''Writes a profile as <id>.collapsed.txt and <id>.speedscope.json
+    to PROFILE_PATH, a local directory or a blob container url
+    :param profiler: finished SamplingProfiler
+    :return None'''
+    files = {
+        f"{profiler.name}.collapsed.txt": profiler.collapsed().encode(),
+        f"{profiler.name}.speedscope.json":
+            json.dumps(profiler.speedscope()).encode()
+    }
+    try:
+        if PROFILE_PATH.startswith("https://"):
+            container, _, sas = PROFILE_PATH.partition("?")
+            for name, content in files.items():
+                # Not a portal call, so not through tenants.http
+                requests.put(f"{container.rstrip('/')}/{name}?{sas}",
+                             data=content, timeout=30,
+                             headers={"x-ms-blob-type": "BlockBlob"}
+                             ).raise_for_status()
+        else:
+            os.makedirs(PROFILE_PATH, exist_ok=True)
+            for name, content in files.items():
+                with open(os.path.join(PROFILE_PATH, name), "wb") as f:
+                    f.write(content)
+        logging.info("Saved profile %s (%.0fms, %s samples)", profiler.name,
+                     profiler.duration_ms, len(profiler.samples))
+    except Exception:
+        logging.warning("Could not save profile %s: %s", profiler.name,
+                        traceback.format_exc())
@@ -0,0 +1,216 @@
+'''Per-request tracing and deadlines.
+
+Each request gets a RequestTrace whose stages are recorded by
+instrumented helpers, and a deadline that portal calls and waits
+are cut to.
+'''
+import contextvars
+import functools
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+import metrics_sinks
+
+# The trace of the request being handled and the stage currently running
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+# time.monotonic() by which the request being handled must answer
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class RequestTrace:
+    '''
+    Timings for one request. Each instrumented helper adds a stage with
+    its wall time, status, portal calls, retries and response bytes.
+    When the request finishes a summary, including the critical path,
+    is sent to the metrics sink.
+    '''
+
+    def __init__(self, route):
+        self.route = route
+        self.tenant = None
+        self.profiler = None
+        self.status_code = None
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._token = current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_trace.reset(self._token)
+        self.duration_ms = self.elapsed_ms()
+        try:
+            metrics_sinks.emit(self.summary())
+        except Exception:
+            logging.warning("Could not emit request metrics: %s",
+                            traceback.format_exc())
+        return False
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    def add_stage(self, stage):
+        with self._lock:
+            self.stages.append(stage)
+
+    def summary(self):
+        '''Builds the per-request summary sent to the metrics sink
+        :return dict'''
+        return {
+            "route": self.route,
+            "tenant": self.tenant,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 1),
+            "status_code": self.status_code,
+            "portal_calls": sum(stage["calls"] for stage in self.stages),
+            "stages": sorted(self.stages, key=lambda stage: stage["start_ms"]),
+            "critical_path": self.critical_path()
+        }
+
+    def critical_path(self):
+        '''Walks back from the end of the request through the top level
+        stages that were running, giving the chain that set its latency
+        :return list of stage names, in order'''
+        path = []
+        cursor = self.duration_ms
+        top_level = [stage for stage in self.stages if stage["parent"] is None]
+        while True:
+            finished = [stage for stage in top_level
+                        if stage["start_ms"] + stage["duration_ms"] <= cursor + 0.5
+                        and stage["name"] not in path]
+            if not finished:
+                return path[::-1]
+            last = max(finished,
+                       key=lambda stage: stage["start_ms"] + stage["duration_ms"])
+            path.append(last["name"])
+            cursor = last["start_ms"]
+
+
+class DeadlineExceededError(Exception):
+    '''Raised when a request runs out of time, naming the stage
+    that was running'''
+
+    def __init__(self, stage=None):
+        if stage is None:
+            current = current_stage.get()
+            stage = current["name"] if current else "request"
+        super().__init__(f"Ran out of time during {stage}")
+        self.stage = stage
+
+
+@contextmanager
+def deadline(seconds):
+    '''Sets the deadline for the work done within the block
+    :param seconds: time budget, None for no deadline'''
+    if seconds is None:
+        yield
+        return
+    token = current_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining_time():
+    '''Seconds left before the current request's deadline
+    :return float, or None if there is no deadline'''
+    ends_at = current_deadline.get()
+    return None if ends_at is None else ends_at - time.monotonic()
+
+
+def deadline_timeout(timeout):
+    '''Cuts a portal call's timeout to the time left for the request
+    :param timeout: seconds, or (connect, read) seconds
+    :return timeout for requests'''
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceededError()
+    connect, read = timeout if isinstance(timeout, tuple) \
+        else (timeout, timeout)
+    return (min(connect, remaining), min(read, remaining))
+
+
+def wait_for(future):
+    '''Waits for another invocation's result within the deadline
+    :param future: Future
+    :return result of the future'''
+    try:
+        return future.result(timeout=remaining_time())
+    except FutureTimeoutError:
+        raise DeadlineExceededError() from None
+
+
+@contextmanager
+def deadline_lock(lock, stage=None):
+    '''Holds a lock, waiting for it no longer than the time left
+    :param lock: threading.Lock
+    :param stage: stage reported if the time runs out, the running
+        stage if not given
+    :raises DeadlineExceededError: if the lock didn't come free in time'''
+    remaining = remaining_time()
+    if not lock.acquire(timeout=-1 if remaining is None
+                        else max(0, remaining)):
+        raise DeadlineExceededError(stage)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def instrumented(stage_name):
+    '''Records calls to a helper as a stage of the current request
+    :param stage_name: name reported for the stage
+    :return decorator'''
+    def decorator(func_):
+        @functools.wraps(func_)
+        def wrapper(*args, **kwargs):
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceededError(stage_name)
+            trace = current_trace.get()
+            if trace is None:
+                return func_(*args, **kwargs)
+
+            parent = current_stage.get()
+            stage = {"name": stage_name,
+                     "parent": parent["name"] if parent else None,
+                     "start_ms": round(trace.elapsed_ms(), 1),
+                     "duration_ms": None, "status": "ok",
+                     "calls": 0, "retries": 0, "bytes": 0}
+            token = current_stage.set(stage)
+            start = time.perf_counter()
+            try:
+                return func_(*args, **kwargs)
+            except BaseException as e:
+                stage["status"] = type(e).__name__
+                raise
+            finally:
+                stage["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                current_stage.reset(token)
+                trace.add_stage(stage)
+        return wrapper
+    return decorator
+
+
+def record_portal_call(response, retries):
+    '''Adds a portal call to the running stage
+    :param response: requests.Response
+    :param retries: retries made for the call'''
+    stage = current_stage.get()
+    if stage is None:
+        return
+    history = getattr(getattr(response.raw, "retries", None), "history", ())
+    stage["calls"] += 1
+    stage["retries"] += retries + len(history or ())
+    stage["bytes"] += len(response.content)
@@ -0,0 +1,105 @@
+'''Signed onboarding links, which carry their config record's
+details so they work without reading the config table.'''
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+import tenants
+from config_store import get_config_store, normalise_globalid
+from portal_session import PortalUnavailableError
+from request_tracing import instrumented
+
+# Comma separated keys for signed onboarding links. The first signs
+# new links and any of them verifies, so keys can be rotated. Signed
+# links are turned off when unset
+LINK_SIGNING_KEYS = [key.strip() for key in
+                     os.getenv("LINK_SIGNING_KEYS", "").split(",")
+                     if key.strip()]
+
+
+def sign_link(claims, key=None):
+    '''Makes a signed onboarding link token: v1.<claims>.<signature>,
+    with the claims as base64url JSON and a truncated HMAC-SHA256
+    :param claims: dict with c (config GlobalID), i (link id),
+        g (group id), r (redirect uri), l (licence), o (role),
+        e (expiry, epoch seconds) and t (tenant, if not the default)
+    :param key: signing key, the first of LINK_SIGNING_KEYS if not given
+    :return str'''
+    key = key or LINK_SIGNING_KEYS[0]
+    payload = b64url_encode(json.dumps(claims, separators=(",", ":"))
+                            .encode())
+    return f"v1.{payload}.{_link_signature(payload, key)}"
+
+
+def verify_link(link):
+    '''Checks a signed onboarding link's signature and expiry.
+    Local only, no portal calls
+    :param link: link token
+    :return (claims dict, None), or (None, error message)'''
+    if not LINK_SIGNING_KEYS:
+        return None, "Signed links are not enabled."
+    try:
+        version, payload, signature = link.split(".")
+    except (AttributeError, ValueError):
+        return None, "This link is not valid."
+    if version != "v1" or not any(
+            hmac.compare_digest(signature, _link_signature(payload, key))
+            for key in LINK_SIGNING_KEYS):
+        return None, "This link is not valid."
+    try:
+        claims = json.loads(_b64url_decode(payload))
+    except ValueError:
+        return None, "This link is not valid."
+    # Links name their tenant, except for the default tenant
+    if claims.get("t", tenants.DEFAULT_TENANT) != tenants.current().name:
+        return None, "This link is not valid."
+    if claims.get("e", 0) < time.time():
+        return None, ("This link has expired, "
+                      "please ask the event organiser for a new one.")
+    return claims, None
+
+
+def _link_signature(payload, key):
+    digest = hmac.new(key.encode(), f"v1.{payload}".encode(),
+                      hashlib.sha256).digest()
+    # 128 bits keeps the QR code small
+    return b64url_encode(digest[:16])
+
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+@instrumented("link revocation")
+def link_revoked(claims, token):
+    '''Checks a signed link against the config table: it is revoked
+    if its record has been deleted, or the record's LINK_REVOKED_FIELD
+    lists the link id or *
+    :param claims: verified link claims
+    :param token: A valid ArcGIS token, used if the table isn't loaded
+        or doesn't have the link's record
+    :return bool, or None if the config table can't be read'''
+    tenant = tenants.current()
+    store = get_config_store(tenant.portal, tenant.config_layer_id,
+                             tenant.redirect_uri)
+    try:
+        revoked = store.revoked_links(token, claims.get("c"))
+    except PortalUnavailableError:
+        revoked = None
+    if revoked is None:
+        # The signature is still good, and surviving a config outage
+        # is what signed links are for
+        logging.warning("Config table unavailable, accepting signed link "
+                        "%s without checking if it was withdrawn", claims["i"])
+        return None
+    record = normalise_globalid(claims.get("c"))
+    return record not in revoked or \
+        bool({"*", claims.get("i")} & revoked[record])
@@ -0,0 +1,150 @@
+'''Stores for the signups queued when SIGNUP_ASYNC is on.'''
+import json
+import os
+import threading
+import time
+from contextlib import closing
+
+# Where queued signups are kept, "memory" or "sqlite:<path>"
+SIGNUP_JOB_STORE = os.getenv("SIGNUP_JOB_STORE", "memory")
+# Seconds finished signup jobs can still be looked up
+SIGNUP_JOB_TTL = int(os.getenv("SIGNUP_JOB_TTL", "3600"))
+
+
+class MemoryJobStore:
+    '''
+    Signup job queue and status held in this worker's memory.
+    Suits a single instance and local testing.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, job_id, payload):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, v in self._jobs.items()
+                        if v["updated"] + self.ttl < now]:
+                del self._jobs[key]
+            self._jobs[job_id] = {"status": "queued", "payload": payload,
+                                  "result": None, "status_code": None,
+                                  "updated": now}
+
+    def claim(self, job_id):
+        '''Marks a queued job as running
+        :param job_id: id of the job
+        :return payload, or None if the job isn't queued'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                return None
+            job["status"] = "running"
+            job["updated"] = time.time()
+            return job["payload"]
+
+    def complete(self, job_id, result, status_code):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=_job_status(status_code), payload=None,
+                           result=result, status_code=status_code,
+                           updated=time.time())
+
+    def get(self, job_id):
+        '''Gets a job's status, without its payload
+        :return dict or None'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {"job_id": job_id, "status": job["status"],
+                    "status_code": job["status_code"], "result": job["result"]}
+
+
+class SqliteJobStore:
+    '''
+    Signup job queue and status in a SQLite file, so several worker
+    processes can share it when testing locally.
+    '''
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with closing(self._connect()) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS signup_jobs (
+                id TEXT PRIMARY KEY, status TEXT, payload TEXT,
+                result TEXT, status_code INTEGER,
+                created REAL, updated REAL)""")
+
+    def _connect(self):
+        # Only imported when configured, to keep cold starts short
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def enqueue(self, job_id, payload):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM signup_jobs WHERE updated < ? "
+                         "AND status NOT IN ('queued', 'running')",
+                         (now - self.ttl,))
+            conn.execute("INSERT INTO signup_jobs VALUES "
+                         "(?, 'queued', ?, NULL, NULL, ?, ?)",
+                         (job_id, json.dumps(payload), now, now))
+
+    def claim(self, job_id):
+        '''Marks a queued job as running
+        :param job_id: id of the job
+        :return payload, or None if the job isn't queued'''
+        with closing(self._connect()) as conn:
+            # Take the write lock before reading, so only one process
+            # sees the job queued and moves it to running
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT payload FROM signup_jobs "
+                                   "WHERE id = ? AND status = 'queued'",
+                                   (job_id,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE signup_jobs SET status = 'running', "
+                                 "updated = ? WHERE id = ?",
+                                 (time.time(), job_id))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return json.loads(row[0]) if row else None
+
+    def complete(self, job_id, result, status_code):
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE signup_jobs SET status = ?, payload = NULL, "
+                         "result = ?, status_code = ?, updated = ? "
+                         "WHERE id = ?",
+                         (_job_status(status_code), json.dumps(result),
+                          status_code, time.time(), job_id))
+
+    def get(self, job_id):
+        '''Gets a job's status, without its payload
+        :return dict or None'''
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT status, status_code, result "
+                               "FROM signup_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"job_id": job_id, "status": row[0], "status_code": row[1],
+                "result": json.loads(row[2]) if row[2] else None}
+
+
+def _job_status(status_code):
+    return "succeeded" if status_code == 200 else "failed"
+
+
+def create_job_store():
+    '''Creates the signup job store named by SIGNUP_JOB_STORE,
+    either "memory" or "sqlite:<path>"
+    :return MemoryJobStore or SqliteJobStore'''
+    if SIGNUP_JOB_STORE.startswith("sqlite:"):
+        return SqliteJobStore(SIGNUP_JOB_STORE[len("sqlite:"):],
+                              SIGNUP_JOB_TTL)
+    return MemoryJobStore(SIGNUP_JOB_TTL)
@@ -0,0 +1,271 @@
+'''The portals the API onboards users into, and the connection pool,
+threads and cache of the one being served.'''
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from caches import (CACHE_BACKEND, CACHE_MAX_ENTRIES, KeyedLocks,
+                    MemoryCache, create_cache)
+from portal_session import PortalUnavailableError, create_http_session
+from request_tracing import current_trace, deadline, remaining_time
+
+PORTAL = os.getenv("PORTAL_URL")
+MGR_USER = os.getenv("MGR_USER")
+MGR_PWORD = os.getenv("MGR_PWORD")
+CONFIG_LAYER_ID = os.getenv("CONFIG_LAYER_ID")
+CLIENT_ID = os.getenv("CLIENT_ID")
+REDIRECT_URI = os.getenv("CALLBACK_URL")
+
+# Portals served besides the one above, as JSON mapping each tenant
+# name to {"portal_url", "mgr_user", "mgr_pword_setting",
+# "config_layer_id", "client_id", "callback_url", "max_concurrency"}.
+# mgr_pword_setting names the app setting holding the password
+TENANTS = os.getenv("TENANTS", "")
+# Name of the tenant configured by PORTAL_URL, MGR_USER and so on,
+# used by requests that don't name one
+DEFAULT_TENANT = "default"
+# Requests each tenant handles at once, 0 for no limit. Unset, each
+# tenant can use half of WORKER_THREADS when several are configured
+TENANT_MAX_CONCURRENCY = os.getenv("TENANT_MAX_CONCURRENCY", "")
+# Threads the Python worker runs requests on, sized as the worker does
+WORKER_THREADS = int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")
+                     or min(32, (os.cpu_count() or 1) + 4))
+# Seconds a request waits for a free slot before answering 503
+TENANT_QUEUE_WAIT = float(os.getenv("TENANT_QUEUE_WAIT", "2"))
+
+# Threads shared by requests for running independent portal calls at once
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "16"))
+# Signups a worker provisions at the same time
+SIGNUP_WORKERS = int(os.getenv("SIGNUP_WORKERS", "4"))
+# Most username checks held by each tenant's in-memory username cache,
+# kept apart from CACHE_MAX_ENTRIES so typing can't evict the rest
+USERNAME_CACHE_MAX_ENTRIES = int(os.getenv("USERNAME_CACHE_MAX_ENTRIES",
+                                           "5000"))
+# Seconds a background refresh or warm-up has, so a slow portal can't
+# hold up the requests waiting on it
+DEADLINE_BACKGROUND = float(os.getenv("DEADLINE_BACKGROUND", "10"))
+
+# The tenant the request being handled is for, see use
+_current_tenant = contextvars.ContextVar("current_tenant", default=None)
+
+# The default tenant's cache, and every tenant's when it is shared.
+# Code reads the current tenant's through cache
+_default_cache = create_cache(CACHE_BACKEND)
+
+
+class UnknownTenantError(Exception):
+    '''Raised when a request names a tenant that isn't configured'''
+
+
+class InvalidTenantError(ValueError):
+    '''Raised when a request's tenant isn't a tenant name at all'''
+
+
+class Tenant:
+    '''
+    A portal the API onboards users into, with its own manager account,
+    OAuth client and config table.
+
+    Each tenant has its own connection pool, rate limiters, circuit
+    breaker, fan-out and signup threads, and unless the cache is shared
+    its own cache, so a burst or outage on one portal doesn't slow the
+    others. max_concurrency caps the requests it handles at once so a
+    burst can't hold every worker thread.
+    '''
+
+    def __init__(self, name, portal, mgr_user, mgr_pword, config_layer_id,
+                 client_id, redirect_uri, max_concurrency=0, cache=None):
+        self.name = name
+        self.portal = portal
+        self.mgr_user = mgr_user
+        self.mgr_pword = mgr_pword
+        self.config_layer_id = config_layer_id
+        self.client_id = client_id
+        self.redirect_uri = redirect_uri
+        self.max_concurrency = max_concurrency
+        self.http = create_http_session()
+        # Threads only start when first used
+        self.fanout = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS,
+                                         thread_name_prefix=f"fanout-{name}")
+        self.signup_workers = ThreadPoolExecutor(
+            max_workers=SIGNUP_WORKERS, thread_name_prefix=f"signup-{name}")
+        # Keys in a shared cache already include the portal
+        self.cache = cache or (_default_cache if _default_cache.shared
+                               else MemoryCache(CACHE_MAX_ENTRIES))
+        # Username checks come from anonymous callers, so in memory
+        # they get their own cache and can't evict the manager token
+        self.username_cache = self.cache if self.cache.shared \
+            else MemoryCache(USERNAME_CACHE_MAX_ENTRIES)
+        self._slots = threading.BoundedSemaphore(max_concurrency) \
+            if max_concurrency > 0 else None
+
+    @contextmanager
+    def slot(self):
+        '''Holds one of the tenant's request slots, waiting up to
+        TENANT_QUEUE_WAIT seconds (or the time left) for one
+        :raises PortalUnavailableError: if none came free'''
+        if self._slots is None:
+            yield
+            return
+        remaining = remaining_time()
+        wait = TENANT_QUEUE_WAIT if remaining is None \
+            else max(0, min(TENANT_QUEUE_WAIT, remaining))
+        if not self._slots.acquire(timeout=wait):
+            logging.warning("Tenant %s is at its limit of %s requests",
+                            self.name, self.max_concurrency)
+            raise PortalUnavailableError(
+                f"Too many requests for {self.name}", TENANT_QUEUE_WAIT)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+class _TenantAttribute:
+    '''Forwards to an attribute of the current tenant, so http and
+    cache always reach the tenant being served'''
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current(), self._name), attr)
+
+
+def _load_tenants():
+    '''Builds the default tenant from PORTAL_URL and friends and the
+    others from TENANTS
+    :return dict of name -> Tenant'''
+    others = json.loads(TENANTS) if TENANTS else {}
+    if TENANT_MAX_CONCURRENCY:
+        max_concurrency = int(TENANT_MAX_CONCURRENCY)
+    elif len(others) + bool(PORTAL) > 1:
+        # Leave half the threads for the other tenants
+        max_concurrency = max(1, WORKER_THREADS // 2)
+    else:
+        max_concurrency = 0
+
+    tenants = {}
+    if PORTAL:
+        tenants[DEFAULT_TENANT] = Tenant(
+            DEFAULT_TENANT, PORTAL, MGR_USER, MGR_PWORD, CONFIG_LAYER_ID,
+            CLIENT_ID, REDIRECT_URI, max_concurrency, cache=_default_cache)
+    for name, settings in others.items():
+        tenants[name] = Tenant(
+            name, settings["portal_url"].rstrip("/"), settings["mgr_user"],
+            os.getenv(settings["mgr_pword_setting"]),
+            settings["config_layer_id"], settings["client_id"],
+            settings.get("callback_url", REDIRECT_URI),
+            int(settings.get("max_concurrency", max_concurrency)))
+    return tenants
+
+
+def current():
+    '''Gets the tenant being served, the default tenant outside a
+    request
+    :return Tenant'''
+    tenant = _current_tenant.get() or configured.get(DEFAULT_TENANT)
+    if tenant is None:
+        raise UnknownTenantError("No tenant is configured")
+    return tenant
+
+
+@contextmanager
+def use(name=None):
+    '''Serves the block for a tenant, holding one of its request slots
+    :param name: tenant name, the default tenant if not given
+    :return Tenant
+    :raises InvalidTenantError, UnknownTenantError'''
+    if name is not None and not isinstance(name, str):
+        raise InvalidTenantError("The tenant must be a name")
+    tenant = configured.get(name or DEFAULT_TENANT)
+    if tenant is None:
+        raise UnknownTenantError(f"Unknown tenant {name}")
+    trace = current_trace.get()
+    if trace is not None:
+        trace.tenant = tenant.name
+    token = _current_tenant.set(tenant)
+    try:
+        with tenant.slot():
+            yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def start_background(target, tenant=None):
+    '''Runs target in a daemon thread for a tenant, the current one if
+    not given, outside the request's trace, with DEADLINE_BACKGROUND
+    as its deadline'''
+    tenant = tenant or current()
+
+    def run():
+        _current_tenant.set(tenant)
+        with deadline(DEADLINE_BACKGROUND):
+            target()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def cached(key, ttl, load, stale_ttl=0):
+    '''Returns the value cached under key, calling load() when it is
+    missing. For stale_ttl seconds after ttl the old value is still
+    returned while one background call to load() refreshes it
+    :param key: cache key
+    :param ttl: seconds the value is fresh
+    :param load: function returning the value
+    :param stale_ttl: seconds an expired value may still be served
+    :return value'''
+    entry = cache.get(key)
+    if entry is not None:
+        if entry["fresh_until"] <= time.time():
+            _refresh_cached(key, ttl, load, stale_ttl)
+        return entry["value"]
+
+    # One load per key at a time, e.g. a request arriving mid warm-up
+    # waits for the warm-up's call
+    with cache_load_locks.hold(key):
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["value"]
+        return _load_cached(key, ttl, load, stale_ttl)
+
+
+def _load_cached(key, ttl, load, stale_ttl):
+    value = load()
+    cache.set(key, {"value": value, "fresh_until": time.time() + ttl},
+              ttl + stale_ttl)
+    return value
+
+
+def _refresh_cached(key, ttl, load, stale_ttl):
+    '''Reloads a stale value in the background unless a load of
+    the key is already running'''
+    release = cache_load_locks.try_acquire(key)
+    if release is None:
+        return
+
+    def refresh():
+        try:
+            _load_cached(key, ttl, load, stale_ttl)
+        except Exception:
+            logging.warning("Could not refresh %s: %s", key,
+                            traceback.format_exc())
+        finally:
+            release()
+
+    start_background(refresh)
+
+
+# Tenants by name
+configured = _load_tenants()
+http = _TenantAttribute("http")
+cache = _TenantAttribute("cache")
+username_cache = _TenantAttribute("username_cache")
+# One load per cache key at a time, see cached
+cache_load_locks = KeyedLocks()
@@ -0,0 +1,433 @@
+'''A local stand-in for the ArcGIS REST API.
+
+Serves just enough of the sharing and portaladmin APIs for the
+onboarding functions to run end to end: OAuth and manager tokens, the
+config item and table, portals/self, community/self, group membership,
+invites and user creation. Each endpoint can be given a latency, an
+error rate and a 429 throttle rate, and every call is counted.
+
+The portal is served under a path prefix. ArcGIS Online is detected
+from "arcgis.com" in PORTAL_URL, so a prefix of /arcgis.com makes the
+API take its ArcGIS Online code paths.
+
+Sign-in codes name the user: "<username>" is a user in the manager's
+org, "<username>@<org id>" is a user from another org.
+
+Usage:
+    python fake_portal.py --port 8765 --latency 50 \\
+        --latency createUser=300 --throttle-rate 0.01
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MGR_USER = "onboarding_mgr"
+MGR_TOKEN = "fake-manager-token"
+ORG_ID = "FakeOrg"
+CONFIG_ITEM_ID = "fakeconfigitem"
+GROUP_ID = "fakegroup"
+GLOBALID = "{00000000-0000-0000-0000-000000000001}"
+
+# Endpoint name, method and path pattern, matched after the prefix
+ENDPOINTS = (
+    ("oauth2/token", "POST", r"/sharing/rest/oauth2/token"),
+    ("generateToken", "POST", r"/sharing/rest/generateToken"),
+    ("content/items", "GET", r"/sharing/rest/content/items/(?P<item>[^/]+)"),
+    ("layer", "GET", r"/fake/FeatureServer/0"),
+    ("query", "POST", r"/fake/FeatureServer/0/query"),
+    ("portals/self", "GET", r"/sharing/rest/portals/self"),
+    ("portals/self/invite", "POST", r"/sharing/rest/portals/self/invite"),
+    ("community/self", "GET", r"/sharing/rest/community/self"),
+    ("checkUsernames", "POST", r"/sharing/rest/community/checkUsernames"),
+    ("group userList", "GET",
+     r"/sharing/rest/community/groups/(?P<group>[^/]+)/userList"),
+    ("group users", "GET",
+     r"/sharing/rest/community/groups/(?P<group>[^/]+)/users"),
+    ("invite", "POST",
+     r"/sharing/rest/community/groups/(?P<group>[^/]+)/invite"),
+    ("addUsers", "POST",
+     r"/sharing/rest/community/groups/(?P<group>[^/]+)/addUsers"),
+    ("invitations", "GET",
+     r"/sharing/rest/community/users/(?P<user>[^/]+)/invitations"),
+    ("accept", "POST",
+     r"/sharing/rest/community/users/(?P<user>[^/]+)/invitations/(?P<invite>[^/]+)/accept"),
+    ("createUser", "POST", r"/portaladmin/security/users/createUser"),
+)
+
+_PATTERNS = [(name, method, re.compile(f"(?P<prefix>.*?){pattern}$"))
+             for name, method, pattern in ENDPOINTS]
+
+
+class FakePortal:
+    '''
+    State and behaviour of the fake portal. Tables of per-endpoint
+    settings are keyed by endpoint name, with "default" for the rest.
+    '''
+
+    def __init__(self, latency=None, error_rate=None, throttle_rate=None,
+                 retry_after=0, seed=None, invitation_delay=0):
+        '''
+        :param latency: endpoint -> milliseconds added to each call
+        :param error_rate: endpoint -> share of calls answered with
+            an ArcGIS error
+        :param throttle_rate: endpoint -> share of calls answered 429
+        :param retry_after: Retry-After seconds sent with a 429
+        :param seed: random seed for repeatable fault injection
+        :param invitation_delay: milliseconds before a new group
+            invitation is listed, like a portal's eventual consistency
+        '''
+        self.latency = dict(latency or {})
+        self.error_rate = dict(error_rate or {})
+        self.throttle_rate = dict(throttle_rate or {})
+        self.retry_after = retry_after
+        self.invitation_delay = invitation_delay
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.config_rows = [{
+            "OBJECTID": 1,
+            "GlobalID": GLOBALID,
+            "group_id": GROUP_ID,
+            "redirect_uri": "https://app.example.com",
+            "user_license_id": "viewerUT",
+            "user_role_id": "iAAAAAAAAAAAAAAA",
+            "EditDate": 1700000000000
+        }]
+        # Epoch ms of the table's last edit, deletes included
+        self.last_edit_date = 1700000000000
+        # username -> org id
+        self.users = {MGR_USER: ORG_ID}
+        self.group_members = {GROUP_ID: {MGR_USER}}
+        # username -> {invite id: (group id, created epoch ms)}
+        self.invitations = {}
+        # Paths of calls that sent a token in the url
+        self.token_urls = []
+
+    def edit_config_row(self, row):
+        '''Adds a config row, or replaces the one with its OBJECTID,
+        stamping it and the table with a new edit date
+        :param row: dict of attributes, including OBJECTID'''
+        with self._lock:
+            row = dict(row, EditDate=self._next_edit_date())
+            self.config_rows = [old for old in self.config_rows
+                                if old["OBJECTID"] != row["OBJECTID"]]
+            self.config_rows.append(row)
+
+    def delete_config_row(self, object_id):
+        '''Deletes a config row, which moves the table's last edit
+        date like a real layer does
+        :param object_id: OBJECTID of the row'''
+        with self._lock:
+            self.config_rows = [row for row in self.config_rows
+                                if row["OBJECTID"] != object_id]
+            self._next_edit_date()
+
+    def _next_edit_date(self):
+        # Later than any earlier edit, even within a millisecond
+        self.last_edit_date = max(int(time.time() * 1000),
+                                  self.last_edit_date + 1)
+        return self.last_edit_date
+
+    def setting(self, table, endpoint):
+        return table.get(endpoint, table.get("default", 0))
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.token_urls.clear()
+
+    def call_counts(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def handle(self, method, path, params, base_url):
+        '''Answers one call
+        :return (http status, headers dict, body dict)'''
+        for name, endpoint_method, pattern in _PATTERNS:
+            match = pattern.match(path)
+            if match and method == endpoint_method:
+                break
+        else:
+            return 404, {}, {"error": {"code": 400,
+                                       "message": f"No fake for {method} {path}"}}
+
+        with self._lock:
+            self.calls[name] += 1
+            roll = self._random.random()
+        delay = self.setting(self.latency, name) / 1000
+        if delay:
+            time.sleep(delay)
+
+        throttle_rate = self.setting(self.throttle_rate, name)
+        if roll < throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after)}, {
+                "error": {"code": 429, "message": "Too many requests"}}
+        if roll < throttle_rate + self.setting(self.error_rate, name):
+            return 200, {}, {"error": {"code": 500,
+                                       "message": "Injected error",
+                                       "details": ["Injected error"]}}
+
+        token = params.get("token")
+        if name not in ("oauth2/token", "generateToken") and not token:
+            return 200, {}, {"error": {"code": 499, "message": "Token Required"}}
+
+        args = match.groupdict()
+        base_url += args.pop("prefix")
+        with self._lock:
+            return 200, {}, getattr(self, "_" + re.sub(r"\W", "_", name))(
+                params, token, base_url, **args)
+
+    def _user_for(self, token):
+        '''Gets the (username, org id) a user token was issued to'''
+        if token == MGR_TOKEN:
+            return MGR_USER, ORG_ID
+        _, username, org_id = token.split(":", 2)
+        return username, org_id
+
+    def _oauth2_token(self, params, token, base_url):
+        code = params.get("code") or ""
+        username, _, org_id = code.partition("@")
+        org_id = org_id or ORG_ID
+        if not username:
+            return {"error": {"code": 400, "message": "Invalid code"}}
+        self.users.setdefault(username, org_id)
+        return {"access_token": f"user:{username}:{self.users[username]}",
+                "expires_in": 1800, "username": username}
+
+    def _generateToken(self, params, token, base_url):
+        return {"token": MGR_TOKEN,
+                "expires": int((time.time() + 7200) * 1000), "ssl": True}
+
+    def _content_items(self, params, token, base_url, item):
+        if item != CONFIG_ITEM_ID:
+            return {"error": {"code": 400, "message": "Item does not exist"}}
+        return {"id": item, "url": f"{base_url}/fake/FeatureServer"}
+
+    def _layer(self, params, token, base_url):
+        return {"objectIdField": "OBJECTID",
+                "editFieldsInfo": {"editDateField": "EditDate"},
+                "editingInfo": {"lastEditDate": max(
+                    [self.last_edit_date] +
+                    [row["EditDate"] for row in self.config_rows])}}
+
+    def _query(self, params, token, base_url):
+        if params.get("returnIdsOnly") == "true":
+            return {"objectIdFieldName": "OBJECTID",
+                    "objectIds": [row["OBJECTID"] for row in self.config_rows]}
+        rows = self.config_rows
+        # Only the incremental sync's "<field> >= timestamp '<UTC>'"
+        # is understood, any other where clause returns every row
+        edited = re.fullmatch(r"(\w+) >= timestamp '([^']+)'",
+                              params.get("where") or "")
+        if edited:
+            since = datetime.strptime(edited[2], "%Y-%m-%d %H:%M:%S") \
+                .replace(tzinfo=timezone.utc).timestamp() * 1000
+            rows = [row for row in rows if row.get(edited[1], 0) >= since]
+        return {"features": [{"attributes": dict(row)} for row in rows]}
+
+    def _portals_self(self, params, token, base_url):
+        username, org_id = self._user_for(token)
+        return {"id": ORG_ID, "defaultUserCreditAssignment": -1,
+                "user": {"username": username, "orgId": org_id}}
+
+    def _community_self(self, params, token, base_url):
+        username, org_id = self._user_for(token)
+        return {"username": username, "orgId": org_id,
+                "groups": [{"id": group_id} for group_id, members
+                           in self.group_members.items()
+                           if username in members]}
+
+    def _group_userList(self, params, token, base_url, group):
+        name = (params.get("name") or "").lower()
+        members = self.group_members.get(group, set())
+        return {"users": [{"username": member} for member in sorted(members)
+                          if name in member.lower()],
+                "total": len(members), "start": 1, "num": 100,
+                "nextStart": -1}
+
+    def _group_users(self, params, token, base_url, group):
+        return {"owner": MGR_USER, "admins": [],
+                "users": sorted(self.group_members.get(group, set()))}
+
+    def _invite(self, params, token, base_url, group):
+        users = [user for user in params.get("users", "").split(",") if user]
+        for user in users:
+            self.invitations.setdefault(user, {})[uuid.uuid4().hex] = (
+                group, int(time.time() * 1000))
+        return {"success": True, "notInvited": []}
+
+    def _addUsers(self, params, token, base_url, group):
+        users = [user for user in params.get("users", "").split(",") if user]
+        # Only users in the manager's org can be added directly
+        not_added = [user for user in users if self.users.get(user) != ORG_ID]
+        self.group_members.setdefault(group, set()).update(
+            user for user in users if user not in not_added)
+        return {"notAdded": not_added}
+
+    def _invitations(self, params, token, base_url, user):
+        listed_before = time.time() * 1000 - self.invitation_delay
+        return {"userInvitations": [
+            {"id": invite_id, "groupId": group_id, "created": created}
+            for invite_id, (group_id, created)
+            in self.invitations.get(user, {}).items()
+            if created <= listed_before]}
+
+    def _accept(self, params, token, base_url, user, invite):
+        invitation = self.invitations.get(user, {}).pop(invite, None)
+        if invitation is None:
+            return {"error": {"code": 400, "message": "Invitation not found"}}
+        self.group_members.setdefault(invitation[0], set()).add(user)
+        return {"success": True}
+
+    def _portals_self_invite(self, params, token, base_url):
+        invitations = json.loads(params.get("invitationList") or "{}")
+        not_invited = []
+        for invitation in invitations.get("invitations", []):
+            username = invitation["username"]
+            if username in self.users:
+                not_invited.append(username)
+                continue
+            self.users[username] = ORG_ID
+            for group_id in (invitation.get("groups") or "").split(","):
+                if group_id:
+                    self.group_members.setdefault(group_id, set()).add(username)
+        return {"success": True, "notInvited": not_invited}
+
+    def _checkUsernames(self, params, token, base_url):
+        usernames = []
+        for username in (params.get("usernames") or "").split(","):
+            suggested, suffix = username, 1
+            while suggested in self.users:
+                suggested, suffix = f"{username}{suffix}", suffix + 1
+            usernames.append({"requested": username, "suggested": suggested})
+        return {"usernames": usernames}
+
+    def _createUser(self, params, token, base_url):
+        username = params.get("username")
+        if username in self.users:
+            return {"error": {"code": 409, "message": "User exists",
+                              "details": [f"User {username} already exists"]}}
+        self.users[username] = ORG_ID
+        return {"status": "success"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._answer("GET")
+
+    def do_POST(self):
+        self._answer("POST")
+
+    def _answer(self, method):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        if "token" in params:
+            self.server.portal.token_urls.append(url.path)
+        # Tokens sent as a header, as ArcGIS accepts them
+        authorization = self.headers.get("X-Esri-Authorization", "")
+        if authorization.startswith("Bearer "):
+            params["token"] = authorization[len("Bearer "):]
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode()))
+        base_url = f"http://{self.headers.get('Host')}"
+        status, headers, body = self.server.portal.handle(
+            method, url.path, params, base_url)
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, e.g. at its deadline
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(portal, host="127.0.0.1", port=0):
+    '''Serves a FakePortal on a background thread
+    :param portal: FakePortal
+    :param port: port to listen on, 0 for any free port
+    :return ThreadingHTTPServer, stop it with shutdown()'''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.portal = portal
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_settings(values, cast=float):
+    '''Parses repeated "<endpoint>=<value>" or "<value>" options
+    :return dict of endpoint -> value, "default" for a bare value'''
+    settings = {}
+    for value in values or ():
+        endpoint, _, setting = value.rpartition("=")
+        settings[endpoint or "default"] = cast(setting)
+    return settings
+
+
+def add_fault_arguments(parser):
+    '''Adds the latency and fault injection options to a parser'''
+    parser.add_argument("--latency", action="append", metavar="[ENDPOINT=]MS",
+                        help="milliseconds added to each call, repeatable")
+    parser.add_argument("--error-rate", action="append",
+                        metavar="[ENDPOINT=]RATE",
+                        help="share of calls answered with an ArcGIS error")
+    parser.add_argument("--throttle-rate", action="append",
+                        metavar="[ENDPOINT=]RATE",
+                        help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0,
+                        help="Retry-After seconds sent with a 429")
+    parser.add_argument("--seed", type=int,
+                        help="random seed for repeatable faults")
+    parser.add_argument("--invitation-delay", type=float, default=0,
+                        help="milliseconds before a new invitation is listed")
+
+
+def portal_from_args(args):
+    return FakePortal(latency=parse_settings(args.latency),
+                      error_rate=parse_settings(args.error_rate),
+                      throttle_rate=parse_settings(args.throttle_rate),
+                      retry_after=args.retry_after, seed=args.seed,
+                      invitation_delay=args.invitation_delay)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--online", action="store_true",
+                        help="print an ArcGIS Online style PORTAL_URL")
+    add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = serve(portal_from_args(args), args.host, args.port)
+    prefix = "/arcgis.com" if args.online else "/portal"
+    print(f"PORTAL_URL=http://{args.host}:{server.server_port}{prefix}")
+    print(f"MGR_USER={MGR_USER} CONFIG_LAYER_ID={CONFIG_ITEM_ID} "
+          f"globalid={GLOBALID}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
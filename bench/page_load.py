@@ -0,0 +1,241 @@
+'''Page load benchmark for the front end.
+
+Serves a front end the way Static Web Apps does, with the brotli/gzip
+variants and the headers in its staticwebapp.config.json, and loads
+each page in headless Chromium over an emulated event Wi-Fi connection.
+Reports the bytes transferred, the number of requests and the time
+until the page is interactive (every Calcite component on it rendered),
+for a first visit and a repeat visit with a warm browser cache.
+
+Needs playwright: pip install playwright && playwright install chromium
+
+Usage:
+    python page_load.py --runs 5 --output pages.json
+    cd ../web && npm install && npm run build && cd ../bench
+    python page_load.py --root ../web/dist --compare pages.json
+'''
+import argparse
+import fnmatch
+import json
+import mimetypes
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import run_bench
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "web")
+PAGES = {
+    "index": "/index.html?id=00000000-0000-0000-0000-000000000001",
+    "signup": "/signup.html?id=00000000-0000-0000-0000-000000000001",
+    "callback": "/callback.html?code=bench"
+}
+# Records when every Calcite component on the page has rendered
+INTERACTIVE_SCRIPT = '''
+(() => {
+  const check = () => {
+    const components = [...document.querySelectorAll("*")]
+      .filter(el => el.localName.startsWith("calcite-"));
+    if (document.readyState !== "loading" && components.every(
+        el => customElements.get(el.localName) && el.shadowRoot)) {
+      window.__interactiveAt = performance.now();
+    } else {
+      requestAnimationFrame(check);
+    }
+  };
+  requestAnimationFrame(check);
+})();
+'''
+
+
+def serve(root):
+    '''Serves root like Static Web Apps: precompressed variants when the
+    browser accepts them, route headers from staticwebapp.config.json,
+    and a 404 for the API
+    :return ThreadingHTTPServer, serving in a daemon thread'''
+    config_path = os.path.join(root, "staticwebapp.config.json")
+    routes = []
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            routes = json.load(f).get("routes", [])
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path.startswith("/api/"):
+                self._send(404, b'{"message": "No API in the benchmark"}',
+                           {"Content-Type": "application/json"})
+                return
+            path = "/index.html" if path == "/" else path
+            file = os.path.normpath(os.path.join(root, path.lstrip("/")))
+            if not file.startswith(os.path.abspath(root)) \
+                    or not os.path.isfile(file):
+                self._send(404, b"Not found", {"Content-Type": "text/plain"})
+                return
+
+            headers = {"Content-Type": mimetypes.guess_type(file)[0]
+                       or "application/octet-stream",
+                       "Vary": "Accept-Encoding"}
+            # First matching route wins, as in Static Web Apps
+            for route in routes:
+                if fnmatch.fnmatch(path, route["route"]):
+                    headers.update(route.get("headers", {}))
+                    break
+            accepted = self.headers.get("Accept-Encoding", "")
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if encoding in accepted and os.path.isfile(file + suffix):
+                    file += suffix
+                    headers["Content-Encoding"] = encoding
+                    break
+            with open(file, "rb") as f:
+                self._send(200, f.read(), headers)
+
+        def _send(self, status, body, headers):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_page(page, url, network):
+    '''Loads a page and measures it
+    :param page: playwright Page, with network emulation applied
+    :param url: page url
+    :param network: dict counting bytes and requests, reset here
+    :return dict of measurements'''
+    network.update(bytes=0, requests=0)
+    page.goto(url, wait_until="load")
+    page.wait_for_function("window.__interactiveAt !== undefined",
+                           timeout=60000)
+    timing = page.evaluate('''() => {
+        const nav = performance.getEntriesByType("navigation")[0];
+        return {interactive: window.__interactiveAt,
+                dcl: nav.domContentLoadedEventEnd, load: nav.loadEventEnd};
+    }''')
+    return {
+        "bytes": network["bytes"],
+        "requests": network["requests"],
+        "interactive_ms": timing["interactive"],
+        "dom_content_loaded_ms": timing["dcl"],
+        "load_ms": timing["load"]
+    }
+
+
+def run_page(browser, base_url, path, args):
+    '''Measures first and repeat visits to a page over args.runs runs
+    :return dict of visit -> median measurements'''
+    visits = {"first_visit": [], "repeat_visit": []}
+    for _ in range(args.runs):
+        # A new context each run, so the first visit has a cold cache
+        context = browser.new_context()
+        page = context.new_page()
+        page.add_init_script(INTERACTIVE_SCRIPT)
+        network = {}
+        cdp = context.new_cdp_session(page)
+        cdp.send("Network.enable")
+        cdp.send("Network.emulateNetworkConditions", {
+            "offline": False,
+            "latency": args.rtt,
+            "downloadThroughput": args.download_kbps * 1000 / 8,
+            "uploadThroughput": args.upload_kbps * 1000 / 8
+        })
+        cdp.on("Network.requestWillBeSent", lambda event: network.update(
+            requests=network["requests"] + 1))
+        cdp.on("Network.loadingFinished", lambda event: network.update(
+            bytes=network["bytes"] + int(event["encodedDataLength"])))
+
+        visits["first_visit"].append(load_page(page, base_url + path,
+                                               network))
+        visits["repeat_visit"].append(load_page(page, base_url + path,
+                                                network))
+        context.close()
+    return {visit: {key: round(statistics.median(run[key] for run in runs), 1)
+                    for key in runs[0]}
+            for visit, runs in visits.items()}
+
+
+def compare(baseline, results):
+    '''Prints the change from a baseline run for each page'''
+    for name, current in results["pages"].items():
+        before = baseline.get("pages", {}).get(name)
+        if before is None:
+            continue
+        print(f"{name} vs {(baseline.get('commit') or 'baseline')[:12]}:")
+        for visit in ("first_visit", "repeat_visit"):
+            for key in ("bytes", "requests", "interactive_ms"):
+                old, new = before[visit][key], current[visit][key]
+                change = (new - old) / old * 100 if old else 0
+                print(f"  {visit} {key:<15} {old:>10} -> {new:<10} "
+                      f"({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=WEB_DIR,
+                        help="front end to serve, e.g. ../web/dist for "
+                             "the build output")
+    parser.add_argument("--page", choices=tuple(PAGES) + ("all",),
+                        default="all")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="fresh browser contexts per page")
+    parser.add_argument("--rtt", type=float, default=150,
+                        help="emulated round trip time in milliseconds")
+    parser.add_argument("--download-kbps", type=float, default=1600)
+    parser.add_argument("--upload-kbps", type=float, default=750)
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="results JSON of an earlier run")
+    args = parser.parse_args(argv)
+
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        raise SystemExit("page_load.py needs playwright: pip install "
+                         "playwright && playwright install chromium")
+    if not os.path.isdir(args.root):
+        raise SystemExit(f"{args.root} not found, for web/dist run "
+                         "npm run build in web/")
+
+    server = serve(args.root)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    pages = PAGES if args.page == "all" else {args.page: PAGES[args.page]}
+    results = {
+        "commit": run_bench.git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "root": os.path.relpath(args.root),
+        "network": {"rtt_ms": args.rtt, "download_kbps": args.download_kbps,
+                    "upload_kbps": args.upload_kbps},
+        "pages": {}
+    }
+    try:
+        with sync_playwright() as playwright:
+            browser = playwright.chromium.launch()
+            for name, path in pages.items():
+                results["pages"][name] = run_page(browser, base_url,
+                                                  path, args)
+            browser.close()
+    finally:
+        server.shutdown()
+
+    print(json.dumps(results["pages"], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+'''Load test for the onboarding API against a fake portal.
+
+Starts a FakePortal, points the function app at it and calls the
+check-permissions and signup handlers in-process at the given
+concurrency. Reports p50/p95/p99 latency, throughput, status codes and
+portal calls per onboarding, and saves the results as JSON so runs on
+different commits can be compared.
+
+Usage:
+    python run_bench.py --requests 500 --concurrency 50 \\
+        --latency 50 --output results.json
+    python run_bench.py --compare baseline.json --output results.json
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_portal
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "api")
+SCENARIOS = ("check-permissions", "signup")
+TUNING_PREFIXES = ("RATE_LIMIT", "THROTTLE_", "BREAKER_", "GROUP_BATCH_",
+                   "HTTP_", "FANOUT_", "CONFIG_CACHE_", "CONFIG_MISS_",
+                   "IDENTITY_", "SIGNUP_")
+
+
+def load_app(portal_url):
+    '''Imports the function app configured for the fake portal'''
+    os.environ.update({
+        "PORTAL_URL": portal_url,
+        "MGR_USER": fake_portal.MGR_USER,
+        "MGR_PWORD": "fake-password",
+        "CONFIG_LAYER_ID": fake_portal.CONFIG_ITEM_ID,
+        "CLIENT_ID": "fake-client-id",
+        "CALLBACK_URL": "https://app.example.com/callback.html",
+        "SIGNUP_ASYNC": "false"
+    })
+    os.environ.setdefault("METRICS_SINK", "none")
+    sys.path.insert(0, API_DIR)
+    import azure.functions as func
+    import function_app
+    return func, function_app
+
+
+def make_request(func, scenario, i, run_id, cross_org_ratio):
+    '''Builds the i-th request of a scenario'''
+    username = f"bench_{scenario.split('-')[0]}_{run_id}_{i}"
+    if scenario == "check-permissions":
+        code = username
+        # Spread the cross-org users evenly through the run
+        if int((i + 1) * cross_org_ratio) > int(i * cross_org_ratio):
+            code += "@OtherOrg"
+        body = {"code": code, "verifier": "v",
+                "globalid": fake_portal.GLOBALID}
+    else:
+        body = {"username": username, "password": "Passw0rd!",
+                "given_name": "Bench", "family_name": str(i),
+                "email": f"{username}@example.com",
+                "globalid": fake_portal.GLOBALID}
+    return func.HttpRequest("POST", f"/api/{scenario}",
+                            body=json.dumps(body).encode(), headers={})
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(func, app, portal, scenario, args, run_id):
+    '''Runs warm-up then measured requests for one scenario
+    :return dict of results'''
+    handler = {"check-permissions": app.add_existing_user,
+               "signup": app.user_signup}[scenario]
+
+    def call(i):
+        request = make_request(func, scenario, i, run_id,
+                               args.cross_org_ratio)
+        start = time.perf_counter()
+        response = handler(request)
+        return time.perf_counter() - start, response.status_code
+
+    for i in range(args.warmup):
+        call(-1 - i)
+
+    portal.reset_counts()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in results]
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    calls = portal.call_counts()
+    return {
+        "requests": len(results),
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "mean": round(statistics.mean(latencies), 1),
+            "max": round(max(latencies), 1)
+        },
+        "portal_calls_per_onboarding": round(
+            sum(calls.values()) / len(results), 2),
+        "portal_calls": calls
+    }
+
+
+def compare(baseline, results):
+    '''Prints the change from a baseline run for each scenario'''
+    for scenario, current in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if before is None:
+            continue
+        print(f"{scenario} vs {baseline.get('commit', 'baseline')[:12]}:")
+        pairs = [(f"latency {pct}", before["latency_ms"][pct],
+                  current["latency_ms"][pct]) for pct in ("p50", "p95", "p99")]
+        pairs.append(("throughput", before["throughput_rps"],
+                      current["throughput_rps"]))
+        pairs.append(("calls/onboarding",
+                      before["portal_calls_per_onboarding"],
+                      current["portal_calls_per_onboarding"]))
+        for name, old, new in pairs:
+            change = (new - old) / old * 100 if old else 0
+            print(f"  {name:<18} {old:>10} -> {new:<10} ({change:+.1f}%)")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=API_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",),
+                        default="all")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="requests made before measuring")
+    parser.add_argument("--cross-org-ratio", type=float, default=0.5,
+                        help="share of check-permissions users from "
+                             "another org, who need an invite")
+    parser.add_argument("--online", action="store_true",
+                        help="take the ArcGIS Online code paths")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="results JSON of an earlier run")
+    fake_portal.add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    portal = fake_portal.portal_from_args(args)
+    server = fake_portal.serve(portal)
+    prefix = "/arcgis.com" if args.online else "/portal"
+    portal_url = f"http://127.0.0.1:{server.server_port}{prefix}"
+    func, app = load_app(portal_url)
+
+    run_id = int(time.time())
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "platform": "online" if args.online else "enterprise",
+        # Tuning variables set for the run, as they change the results
+        "settings": {name: value for name, value in os.environ.items()
+                     if name.startswith(TUNING_PREFIXES)},
+        "portal": {"latency": portal.latency,
+                   "error_rate": portal.error_rate,
+                   "throttle_rate": portal.throttle_rate},
+        "scenarios": {}
+    }
+    try:
+        for scenario in scenarios:
+            results["scenarios"][scenario] = run_scenario(
+                func, app, portal, scenario, args, run_id)
+    finally:
+        server.shutdown()
+
+    print(json.dumps(results["scenarios"], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
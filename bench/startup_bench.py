@@ -0,0 +1,107 @@
+'''Cold start benchmark for the onboarding API.
+
+Starts a fresh Python process per run, as a new Functions worker would,
+and times importing function_app, the first check-permissions request
+and a second, warm, request against a fake portal. Each run is made
+with warm-up on start off and on, and with a call to the warmup route
+before the first request, as index.html makes while the user signs in.
+
+Usage:
+    python startup_bench.py --runs 5 --latency 50 --output startup.json
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import fake_portal
+import run_bench
+
+VARIANTS = {
+    "cold": {"WARMUP_ON_START": "false"},
+    "warm_on_start": {"WARMUP_ON_START": "true"},
+    "warmup_route": {"WARMUP_ON_START": "false", "BENCH_CALL_WARMUP": "1"},
+}
+
+
+def child(request_delay):
+    '''Runs in the fresh process and prints its timings as JSON'''
+    start = time.perf_counter()
+    func, app = run_bench.load_app(os.environ["PORTAL_URL"])
+    timings = {"import_ms": (time.perf_counter() - start) * 1000}
+
+    if os.environ.get("BENCH_CALL_WARMUP"):
+        start = time.perf_counter()
+        app.warmup(func.HttpRequest("GET", "/api/warmup", body=b""))
+        timings["warmup_ms"] = (time.perf_counter() - start) * 1000
+    time.sleep(request_delay / 1000)
+
+    for name, i in (("first_request_ms", 0), ("warm_request_ms", 1)):
+        request = run_bench.make_request(func, "check-permissions", i,
+                                         os.getpid(), 0)
+        start = time.perf_counter()
+        response = app.add_existing_user(request)
+        timings[name] = (time.perf_counter() - start) * 1000
+        timings[name.replace("_ms", "_status")] = response.status_code
+    print(json.dumps(timings))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5,
+                        help="fresh processes per variant")
+    parser.add_argument("--request-delay", type=float, default=0,
+                        help="milliseconds between import and the first "
+                             "request")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    fake_portal.add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.request_delay)
+        return
+
+    portal = fake_portal.FakePortal(
+        latency=fake_portal.parse_settings(args.latency),
+        seed=args.seed)
+    server = fake_portal.serve(portal)
+    portal_url = f"http://127.0.0.1:{server.server_port}/portal"
+
+    results = {"commit": run_bench.git_commit(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                          time.gmtime()),
+               "portal": {"latency": portal.latency},
+               "request_delay_ms": args.request_delay,
+               "variants": {}}
+    try:
+        for variant, env in VARIANTS.items():
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child",
+                     "--request-delay", str(args.request_delay)],
+                    env=dict(os.environ, PORTAL_URL=portal_url,
+                             METRICS_SINK="none", **env),
+                    capture_output=True, text=True, check=True).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+            results["variants"][variant] = {
+                key: round(statistics.median(run[key] for run in runs), 1)
+                for key in runs[0] if key.endswith("_ms")}
+            results["variants"][variant]["statuses"] = sorted(
+                {run["first_request_status"] for run in runs})
+    finally:
+        server.shutdown()
+
+    print(json.dumps(results["variants"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+'''Fixtures for the API tests. The function app and its modules read
+their settings when imported, so the app is imported here, before the
+tests, pointed at a fake portal (bench/fake_portal.py) served on a
+local port.'''
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bench"))
+
+import fake_portal
+import run_bench
+
+SETTINGS = {
+    "WARMUP_ON_START": "false",
+    "LINK_SIGNING_KEYS": "test-key",
+    # Injected errors must not open the breaker for later tests
+    "BREAKER_FAILURE_THRESHOLD": "1000"
+}
+
+_portal = fake_portal.FakePortal()
+_server = fake_portal.serve(_portal)
+PORTAL_URL = f"http://127.0.0.1:{_server.server_port}/portal"
+os.environ.update(SETTINGS)
+_, function_app = run_bench.load_app(PORTAL_URL)
+
+
+def pytest_unconfigure(config):
+    _server.shutdown()
+
+
+@pytest.fixture
+def app():
+    '''The function_app module'''
+    return function_app
+
+
+@pytest.fixture
+def portal():
+    '''The fake portal with its call counts reset. Faults and config
+    rows added by the test are cleared afterwards'''
+    portal = _portal
+    object_ids = {row["OBJECTID"] for row in portal.config_rows}
+    portal.reset_counts()
+    yield portal
+    portal.latency.clear()
+    portal.error_rate.clear()
+    portal.throttle_rate.clear()
+    for row in list(portal.config_rows):
+        if row["OBJECTID"] not in object_ids:
+            portal.delete_config_row(row["OBJECTID"])
+
+
+@pytest.fixture
+def portal_url():
+    return PORTAL_URL
+
+
+@pytest.fixture
+def unique():
+    '''A name no other test uses, as the portal and caches keep state'''
+    return f"t{uuid.uuid4().hex[:10]}"
+
+
+@pytest.fixture
+def post():
+    '''Calls a handler with a JSON body
+    :return function(handler, body) returning (status, body dict)'''
+    import azure.functions as func
+
+    def post(handler, body):
+        response = handler(func.HttpRequest(
+            "POST", "/api/test", body=json.dumps(body).encode(), headers={}))
+        return response.status_code, json.loads(response.get_body())
+    return post
+
+
+@pytest.fixture
+def mgr_token():
+    from manager_token import with_mgr_token
+    return with_mgr_token(lambda token: token)
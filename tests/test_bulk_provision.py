@@ -0,0 +1,87 @@
+'''The bulk provisioning CLI against the fake portal'''
+import csv
+
+import fake_portal
+
+import bulk_provision
+import config_store
+import tenants
+
+
+def run(tmp_path, usernames, *args):
+    '''Provisions a roster of usernames, with a row missing its
+    password and a repeated row after them
+    :param args: other command line arguments
+    :return (exit code, report rows)'''
+    roster, report = tmp_path / "roster.csv", tmp_path / "report.csv"
+    with open(roster, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("username", "password", "given_name",
+                         "family_name", "email"))
+        for username in usernames:
+            writer.writerow((username, "Passw0rd!", "Bulk", "User",
+                             f"{username}@example.com"))
+        writer.writerow(("nopassword", "", "Bulk", "User",
+                         "nopassword@example.com"))
+        writer.writerow((usernames[0], "Passw0rd!", "Bulk", "User",
+                         f"{usernames[0]}@example.com"))
+
+    code = bulk_provision.main([*args, str(roster), "--globalid",
+                                fake_portal.GLOBALID, "--report",
+                                str(report)])
+    with open(report, newline="") as f:
+        return code, list(csv.DictReader(f))
+
+
+def test_enterprise_roster_is_added_in_one_call(app, mgr_token, portal,
+                                                unique, tmp_path):
+    usernames = [f"{unique}_{i}" for i in range(3)]
+
+    code, rows = run(tmp_path, usernames)
+
+    assert code == 1
+    assert [row["username"] for row in rows] == \
+        usernames + ["nopassword", usernames[0]]
+    assert [row["added_to_group"] for row in rows] == \
+        ["True"] * 3 + ["False"] * 2
+    assert rows[3]["message"] == "Missing password"
+    assert rows[4]["message"] == "Duplicate username in roster"
+    assert set(usernames) <= portal.group_members[fake_portal.GROUP_ID]
+    calls = portal.call_counts()
+    assert calls["createUser"] == 3
+    assert calls["addUsers"] == 1
+    assert "group userList" not in calls
+
+
+def test_online_roster_is_not_added_again(app, mgr_token, portal, unique,
+                                          tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "_is_arcgis_online", lambda portal_url: True)
+    usernames = [f"{unique}_{i}" for i in range(3)]
+
+    code, rows = run(tmp_path, usernames)
+
+    assert [row["added_to_group"] for row in rows[:3]] == ["True"] * 3
+    assert set(usernames) <= portal.group_members[fake_portal.GROUP_ID]
+    calls = portal.call_counts()
+    assert calls["portals/self/invite"] == 1
+    assert "addUsers" not in calls
+    assert "group userList" not in calls
+
+
+def test_roster_is_provisioned_into_the_named_tenant(app, portal, portal_url,
+                                                     unique, tmp_path,
+                                                     monkeypatch):
+    other = tenants.Tenant("other", portal_url.replace("/portal", "/other"),
+                           fake_portal.MGR_USER, "fake-password",
+                           fake_portal.CONFIG_ITEM_ID, "other-client-id",
+                           "https://other.example.com")
+    monkeypatch.setitem(tenants.configured, "other", other)
+    monkeypatch.setattr(config_store, "_config_stores", {})
+    usernames = [f"{unique}_{i}" for i in range(3)]
+
+    code, rows = run(tmp_path, usernames, "--tenant", "other")
+
+    assert [row["added_to_group"] for row in rows[:3]] == ["True"] * 3
+    # The other tenant's config table, not the default tenant's
+    assert list(config_store._config_stores) == [
+        (other.portal, fake_portal.CONFIG_ITEM_ID)]
@@ -0,0 +1,111 @@
+'''Cache backends and per-key locks'''
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import caches
+
+API = os.path.dirname(caches.__file__)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return caches.SqliteCache(str(tmp_path / "cache.db"))
+    return caches.MemoryCache(10)
+
+
+def test_entry_expires_after_its_ttl(cache):
+    cache.set("token", {"value": 1}, 0.2)
+    assert cache.get("token") == {"value": 1}
+
+    time.sleep(0.3)
+
+    assert cache.get("token") is None
+
+
+def test_sqlite_caches_on_one_file_share_entries(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first, second = caches.SqliteCache(path), caches.SqliteCache(path)
+
+    first.set("token", "abc", 60)
+    assert second.get("token") == "abc"
+
+    second.delete("token")
+    assert first.get("token") is None
+
+
+def test_sqlite_cache_is_shared_with_another_process(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = caches.SqliteCache(path)
+
+    subprocess.run([sys.executable, "-c",
+                    "import sys, caches; "
+                    "caches.SqliteCache(sys.argv[1]).set('token', 'abc', 60)",
+                    path],
+                   check=True, env=dict(os.environ, PYTHONPATH=API))
+
+    assert cache.get("token") == "abc"
+
+
+def test_memory_cache_drops_the_least_recently_used_entry():
+    cache = caches.MemoryCache(2)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    cache.get("a")
+
+    cache.set("c", 3, 60)
+
+    assert [cache.get(key) for key in "abc"] == [1, None, 3]
+
+
+def run_holding(locks, keys, hold=0.05):
+    '''Holds each key's lock from a thread of its own
+    :return most threads that held the same key at once'''
+    holding = {}
+    most = {}
+    counter_lock = threading.Lock()
+
+    def worker(key):
+        with locks.hold(key):
+            with counter_lock:
+                holding[key] = holding.get(key, 0) + 1
+                most[key] = max(most.get(key, 0), holding[key])
+            time.sleep(hold)
+            with counter_lock:
+                holding[key] -= 1
+
+    threads = [threading.Thread(target=worker, args=(key,)) for key in keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return most
+
+
+def test_keyed_locks_serialise_callers_of_one_key():
+    locks = caches.KeyedLocks()
+
+    start = time.monotonic()
+    most = run_holding(locks, ["a"] * 4 + ["b"] * 4)
+    elapsed = time.monotonic() - start
+
+    assert most == {"a": 1, "b": 1}
+    # The two keys were held at the same time
+    assert elapsed < 0.35
+    # No lock is kept once nobody holds or waits for it
+    assert len(locks) == 0
+
+
+def test_keyed_lock_try_acquire_fails_while_held():
+    locks = caches.KeyedLocks()
+    release = locks.try_acquire("a")
+
+    assert locks.try_acquire("a") is None
+    assert locks.try_acquire("b") is not None
+    release()
+    assert locks.try_acquire("a") is not None
@@ -0,0 +1,125 @@
+'''SingleFlight and GroupBatcher, alone and through the handlers'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_portal
+import pytest
+
+from coalescing import GroupBatcher, SingleFlight
+
+
+def test_single_flight_runs_concurrent_calls_once():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"message": "done"}, 200
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(flights.do, "key", call)
+        started.wait(5)
+        followers = [pool.submit(flights.do, "key", call) for _ in range(3)]
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert len(calls) == 1
+    assert results == [({"message": "done"}, 200)] * 4
+
+
+def test_single_flight_shares_errors_and_keeps_no_result():
+    flights = SingleFlight(result_ttl=60)
+
+    def fail():
+        raise RuntimeError("portal down")
+
+    with pytest.raises(RuntimeError):
+        flights.do("key", fail)
+    assert flights.do("key", lambda: ({}, 200)) == ({}, 200)
+
+
+def test_single_flight_answers_retries_from_recent_result():
+    flights = SingleFlight(result_ttl=60)
+    calls = []
+
+    def call():
+        calls.append(1)
+        return {}, 200
+
+    flights.do("key", call)
+    flights.do("key", call)
+
+    assert len(calls) == 1
+
+
+def test_group_batcher_sends_concurrent_users_in_one_call():
+    batches = []
+
+    def send_batch(base_url, group_id, users, mgr_token, redirect_uri):
+        batches.append(list(users))
+        return {user: user != "refused" for user in users}
+
+    batcher = GroupBatcher(send_batch, window_ms=200, max_users=25)
+    users = ["a", "b", "c", "refused"]
+    with ThreadPoolExecutor(max_workers=len(users)) as pool:
+        results = list(pool.map(lambda user: batcher.submit(
+            "https://portal", "group", user, "token", "https://app"), users))
+
+    assert len(batches) == 1
+    assert sorted(batches[0]) == sorted(users)
+    assert results == [True, True, True, False]
+
+
+def test_group_batcher_closes_full_batches():
+    batches = []
+
+    def send_batch(base_url, group_id, users, mgr_token, redirect_uri):
+        batches.append(list(users))
+        return dict.fromkeys(users, True)
+
+    batcher = GroupBatcher(send_batch, window_ms=2000, max_users=2)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda user: batcher.submit(
+            "https://portal", "group", user, "token", "https://app"),
+            ["a", "b", "c", "d"]))
+
+    assert results == [True] * 4
+    assert sorted(len(batch) for batch in batches) == [2, 2]
+
+
+def test_reposted_code_is_exchanged_once(app, portal, post, unique):
+    portal.latency["oauth2/token"] = 100
+    body = {"code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID}
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(
+            lambda _: post(app.add_existing_user, body), range(4)))
+
+    assert [status for status, _ in results] == [200] * 4
+    assert portal.call_counts()["oauth2/token"] == 1
+
+
+def test_concurrent_members_are_added_in_one_call(app, portal, post, unique):
+    bodies = [{"code": f"{unique}_{i}", "verifier": "v",
+               "globalid": fake_portal.GLOBALID} for i in range(5)]
+
+    with ThreadPoolExecutor(max_workers=len(bodies)) as pool:
+        results = list(pool.map(
+            lambda body: post(app.add_existing_user, body), bodies))
+
+    assert [status for status, _ in results] == [200] * 5
+    assert portal.call_counts()["addUsers"] < len(bodies)
+    assert {f"{unique}_{i}" for i in range(5)} <= \
+        portal.group_members[fake_portal.GROUP_ID]
+
+
+def test_missing_code_never_shares_a_flight(app, portal, post):
+    status, result = post(app.add_existing_user,
+                          {"verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 400
+    assert result["message"] == "Missing code"
+    assert portal.call_counts() == {}
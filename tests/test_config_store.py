@@ -0,0 +1,142 @@
+'''ConfigStore's incremental sync against the fake config table'''
+import logging
+
+import fake_portal
+import pytest
+
+import tenants
+from caches import SqliteCache
+from config_store import ConfigStore, normalise_globalid
+from test_signup import signup_body
+
+
+def config_row(object_id, **attributes):
+    return dict({
+        "OBJECTID": object_id,
+        "GlobalID": f"{{00000000-0000-0000-0000-{object_id:012d}}}",
+        "group_id": fake_portal.GROUP_ID,
+        "redirect_uri": "https://app.example.com",
+        "user_license_id": "viewerUT",
+        "user_role_id": "iAAAAAAAAAAAAAAA"
+    }, **attributes)
+
+
+@pytest.fixture
+def store(portal, portal_url, mgr_token):
+    '''A store of its own, loaded from the fake table, which also has
+    rows edited long before the last edit'''
+    for object_id in (150, 151, 152):
+        portal.config_rows.append(config_row(object_id,
+                                             EditDate=1600000000000))
+    store = ConfigStore(portal_url, fake_portal.CONFIG_ITEM_ID,
+                        "https://app.example.com")
+    store.sync(mgr_token)
+    portal.reset_counts()
+    return store
+
+
+def fetched_rows(store, monkeypatch):
+    '''Records the GlobalIDs of the rows each sync query returns'''
+    fetched = []
+    query_rows = store._query_rows
+
+    def record(*args, **kwargs):
+        rows, oids = query_rows(*args, **kwargs)
+        fetched.extend(rows)
+        return rows, oids
+    monkeypatch.setattr(store, "_query_rows", record)
+    return fetched
+
+
+def test_unchanged_table_is_not_queried(store, portal, mgr_token):
+    store.sync(mgr_token, max_age=0)
+
+    assert portal.call_counts() == {"layer": 1}
+
+
+def test_sync_queries_only_edited_rows(store, portal, mgr_token,
+                                       monkeypatch):
+    fetched = fetched_rows(store, monkeypatch)
+    portal.edit_config_row(config_row(101))
+
+    store.sync(mgr_token, max_age=0)
+
+    # Rows edited in the second of the last sync are fetched again too
+    assert normalise_globalid(config_row(101)["GlobalID"]) in fetched
+    assert not {normalise_globalid(config_row(object_id)["GlobalID"])
+                for object_id in (150, 151, 152)} & set(fetched)
+    assert store.get(config_row(101)["GlobalID"], mgr_token)["OBJECTID"] == 101
+    assert store.get(config_row(150)["GlobalID"], mgr_token)["OBJECTID"] == 150
+
+
+def test_sync_applies_edits_to_known_rows(store, portal, mgr_token):
+    portal.edit_config_row(config_row(102))
+    store.sync(mgr_token, max_age=0)
+
+    portal.edit_config_row(config_row(102, redirect_uri="https://new.example.com"))
+    store.sync(mgr_token, max_age=0)
+
+    assert store.get(config_row(102)["GlobalID"], mgr_token)["redirect_uri"] \
+        == "https://new.example.com"
+
+
+def test_sync_evicts_deleted_rows(store, portal, mgr_token, caplog,
+                                  monkeypatch):
+    portal.edit_config_row(config_row(103))
+    store.sync(mgr_token, max_age=0)
+
+    portal.delete_config_row(103)
+    with caplog.at_level(logging.INFO):
+        store.sync(mgr_token, max_age=0)
+
+    assert "1 removed" in caplog.text
+    # No miss reload, the sync alone must have dropped it
+    monkeypatch.setattr(store, "_miss_reload_allowed", lambda: False)
+    assert store.get(config_row(103)["GlobalID"], mgr_token) == {}
+
+
+def test_failed_first_load_leaves_store_unloaded(portal, portal_url,
+                                                 mgr_token):
+    portal.error_rate["query"] = 1
+    store = ConfigStore(portal_url, fake_portal.CONFIG_ITEM_ID,
+                        "https://app.example.com")
+
+    assert store.revoked_links(mgr_token) is None
+
+
+def test_record_added_just_after_a_sync_is_found(store, portal, mgr_token):
+    store.sync(mgr_token, max_age=0)
+    portal.edit_config_row(config_row(104))
+
+    # Syncs don't hold back the reload for an unknown GlobalID
+    assert store.get(config_row(104)["GlobalID"], mgr_token)["OBJECTID"] \
+        == 104
+
+
+def test_record_added_just_after_adopting_rows_is_found(portal, portal_url,
+                                                        mgr_token, tmp_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(tenants.current(), "cache",
+                        SqliteCache(str(tmp_path / "cache.db")))
+    first, second = (ConfigStore(portal_url, fake_portal.CONFIG_ITEM_ID,
+                                 "https://app.example.com")
+                     for _ in range(2))
+    first.sync(mgr_token)
+    # Takes the rows the first store published
+    second.sync(mgr_token)
+    assert second._loaded_at == first._loaded_at
+    portal.edit_config_row(config_row(105))
+
+    assert second.get(config_row(105)["GlobalID"], mgr_token)["OBJECTID"] \
+        == 105
+
+
+@pytest.mark.parametrize("route", ["add_existing_user", "user_signup"])
+def test_unknown_globalid_is_not_found(app, portal, post, unique, route):
+    body = dict(signup_body(unique), code=unique, verifier="v",
+                globalid=config_row(106)["GlobalID"])
+
+    status, result = post(getattr(app, route), body)
+
+    assert status == 404, result
+    assert result["message"].startswith("Unknown link")
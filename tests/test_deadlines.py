@@ -0,0 +1,22 @@
+'''Route deadlines against a slow fake portal'''
+import time
+
+import fake_portal
+
+
+def test_slow_portal_answers_504_within_the_deadline(app, mgr_token, portal,
+                                                     post, unique,
+                                                     monkeypatch):
+    monkeypatch.setitem(app.ROUTE_DEADLINES, "check-permissions", 1.5)
+    portal.latency["community/self"] = 4000
+
+    start = time.monotonic()
+    status, result = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+    elapsed = time.monotonic() - start
+
+    assert status == 504, result
+    assert result["stage"] == "identity"
+    assert elapsed < 2
+    # Read timeouts aren't retried while a deadline is running
+    assert portal.call_counts()["community/self"] == 1
@@ -0,0 +1,50 @@
+'''Users from another org join the group by invitation'''
+import fake_portal
+
+
+def check_in(app, post, code):
+    return post(app.add_existing_user, {"code": code, "verifier": "v",
+                                        "globalid": fake_portal.GLOBALID})
+
+
+def test_retry_accepts_the_invitation_without_inviting_again(app, mgr_token,
+                                                             portal, post,
+                                                             unique):
+    code = f"{unique}@OtherOrg"
+    portal.error_rate["accept"] = 1
+    status, _ = check_in(app, post, code)
+    assert status == 500
+    assert len(portal.invitations[unique]) == 1
+
+    portal.error_rate.clear()
+    portal.reset_counts()
+    status, result = check_in(app, post, code)
+
+    assert status == 200, result
+    counts = portal.call_counts()
+    assert "invite" not in counts
+    # The invitation id was remembered, so isn't looked up again
+    assert "invitations" not in counts
+    assert counts["accept"] == 1
+    assert unique in portal.group_members[fake_portal.GROUP_ID]
+    assert portal.invitations[unique] == {}
+
+
+def test_retry_finds_an_invitation_listed_late(app, mgr_token, portal, post,
+                                               unique, monkeypatch):
+    code = f"{unique}@OtherOrg"
+    monkeypatch.setattr(app, "INVITATION_LOOKUP_RETRIES", 0)
+    monkeypatch.setattr(portal, "invitation_delay", 60000)
+    status, _ = check_in(app, post, code)
+    assert status == 500
+
+    monkeypatch.setattr(portal, "invitation_delay", 0)
+    portal.reset_counts()
+    status, result = check_in(app, post, code)
+
+    assert status == 200, result
+    counts = portal.call_counts()
+    assert "invite" not in counts
+    assert counts["invitations"] == 1
+    assert counts["accept"] == 1
+    assert unique in portal.group_members[fake_portal.GROUP_ID]
@@ -0,0 +1,88 @@
+'''Signup job stores and asynchronous signups'''
+import json
+import sqlite3
+import threading
+
+import pytest
+
+import tenants
+from signup_jobs import MemoryJobStore, SqliteJobStore
+from test_signup import signup_body
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def job_store(request, app, tmp_path):
+    if request.param == "sqlite":
+        return SqliteJobStore(str(tmp_path / "jobs.db"), ttl=60)
+    return MemoryJobStore(ttl=60)
+
+
+def test_job_is_claimed_once(job_store):
+    job_store.enqueue("job1", {"username": "someone"})
+
+    assert job_store.claim("job1") == {"username": "someone"}
+    assert job_store.claim("job1") is None
+    assert job_store.get("job1")["status"] == "running"
+
+
+def test_finished_job_keeps_its_result_only(job_store):
+    job_store.enqueue("job1", {"username": "someone"})
+    job_store.claim("job1")
+
+    job_store.complete("job1", {"message": "User added to group"}, 200)
+
+    assert job_store.get("job1") == {
+        "job_id": "job1", "status": "succeeded", "status_code": 200,
+        "result": {"message": "User added to group"}}
+
+
+def test_sqlite_job_is_claimed_once_across_connections(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    SqliteJobStore(path, ttl=60).enqueue("job1", {"username": "someone"})
+    # A store each, as separate worker processes would have
+    stores = [SqliteJobStore(path, ttl=60) for _ in range(8)]
+    start = threading.Barrier(len(stores))
+    claims = []
+
+    def claim(store):
+        start.wait()
+        claims.append(store.claim("job1"))
+
+    threads = [threading.Thread(target=claim, args=(store,))
+               for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert claims.count({"username": "someone"}) == 1
+    assert claims.count(None) == len(stores) - 1
+
+
+def test_unknown_job_is_not_found(job_store):
+    assert job_store.get("missing") is None
+    assert job_store.claim("missing") is None
+
+
+def test_async_signup_never_stores_the_password(app, portal, post, unique,
+                                                monkeypatch, tmp_path):
+    path = str(tmp_path / "jobs.db")
+    monkeypatch.setattr(app, "SIGNUP_ASYNC", True)
+    monkeypatch.setattr(app, "_signup_jobs", SqliteJobStore(path, 60))
+    # Hold the job in the queue until the store has been looked at
+    queued = []
+    monkeypatch.setattr(tenants.current().signup_workers, "submit",
+                        lambda run, job_id: queued.append(job_id))
+    body = signup_body(unique)
+
+    status, result = post(app.user_signup, body)
+    with sqlite3.connect(path) as conn:
+        payload, = conn.execute("SELECT payload FROM signup_jobs").fetchone()
+    app._process_signup_job(queued[0])
+
+    assert status == 202, result
+    assert json.loads(payload)["username"] == unique
+    assert body["password"] not in payload
+    assert app._signup_jobs.get(result["job_id"])["status"] == "succeeded"
+    assert unique in portal.users
+    assert result["job_id"] not in app._signup_passwords
@@ -0,0 +1,124 @@
+'''Signed onboarding links: signing, verifying and revoking'''
+import time
+
+import fake_portal
+import pytest
+
+import config_store
+import signed_links
+import tenants
+from test_config_store import config_row
+
+
+def claims(object_id=1, **changes):
+    return dict({"c": config_row(object_id)["GlobalID"].strip("{}"),
+                 "i": "link1", "g": fake_portal.GROUP_ID,
+                 "r": "https://app.example.com", "l": None, "o": None,
+                 "e": time.time() + 600}, **changes)
+
+
+def test_signed_link_verifies():
+    link = signed_links.sign_link(claims())
+
+    verified, error = signed_links.verify_link(link)
+
+    assert error is None
+    assert verified["g"] == fake_portal.GROUP_ID
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda link: link[:-2] + ("AA" if not link.endswith("AA") else "BB"),
+    lambda link: link.replace("v1.", "v2.", 1),
+    lambda link: "not-a-link"
+])
+def test_tampered_link_is_refused(tamper):
+    link = tamper(signed_links.sign_link(claims()))
+
+    verified, error = signed_links.verify_link(link)
+
+    assert verified is None
+    assert error == "This link is not valid."
+
+
+def test_expired_link_is_refused():
+    link = signed_links.sign_link(claims(e=time.time() - 1))
+
+    verified, error = signed_links.verify_link(link)
+
+    assert verified is None
+    assert "expired" in error
+
+
+def test_link_signed_with_an_older_key_still_verifies(monkeypatch):
+    link = signed_links.sign_link(claims(), key="test-key")
+    monkeypatch.setattr(signed_links, "LINK_SIGNING_KEYS",
+                        ["new-key", "test-key"])
+
+    assert signed_links.verify_link(link)[1] is None
+
+
+def test_link_to_another_tenant_is_refused():
+    link = signed_links.sign_link(claims(t="other"))
+
+    assert signed_links.verify_link(link) == (None, "This link is not valid.")
+
+
+def check_in(app, post, unique, link):
+    return post(app.add_existing_user, {"code": unique, "verifier": "v",
+                                        "link": link})
+
+
+def test_link_to_deleted_record_is_revoked(app, portal, post, unique,
+                                           mgr_token):
+    portal.edit_config_row(config_row(201))
+    tenant = tenants.current()
+    store = config_store.get_config_store(
+        tenant.portal, tenant.config_layer_id, tenant.redirect_uri)
+    store.sync(mgr_token, max_age=0)
+    link = signed_links.sign_link(claims(201))
+    assert check_in(app, post, unique + "a", link)[0] == 200
+
+    portal.delete_config_row(201)
+    store.sync(mgr_token, max_age=0)
+    status, result = check_in(app, post, unique + "b", link)
+
+    assert status == 403
+    assert "withdrawn" in result["message"]
+
+
+def test_link_id_listed_as_revoked_is_refused(app, portal, post, unique,
+                                              mgr_token):
+    portal.edit_config_row(config_row(202, revoked_links="other, link1"))
+    tenant = tenants.current()
+    config_store.get_config_store(
+        tenant.portal, tenant.config_layer_id,
+        tenant.redirect_uri).sync(mgr_token, max_age=0)
+
+    link = signed_links.sign_link(claims(202))
+    assert check_in(app, post, unique, link)[0] == 403
+
+
+def test_link_to_record_added_after_the_last_sync_works(app, portal, post,
+                                                      unique, monkeypatch):
+    # A worker of its own, which loads the table on its first check in
+    monkeypatch.setattr(config_store, "_config_stores", {})
+    assert check_in(app, post, unique + "a",
+                    signed_links.sign_link(claims()))[0] == 200
+
+    portal.edit_config_row(config_row(203))
+    status, result = check_in(app, post, unique + "b",
+                              signed_links.sign_link(claims(203)))
+
+    assert status == 200, result
+
+
+def test_link_works_while_config_table_is_unavailable(app, portal, post,
+                                                      unique, monkeypatch):
+    # A worker that has never read the table, during an outage
+    monkeypatch.setattr(config_store, "_config_stores", {})
+    portal.error_rate.update({"layer": 1, "query": 1})
+
+    status, result = check_in(app, post, unique,
+                              signed_links.sign_link(claims()))
+
+    assert status == 200, result
@@ -0,0 +1,58 @@
+'''Per-request metrics, recorded with the in-memory sink'''
+import fake_portal
+import pytest
+
+import metrics_sinks
+
+
+@pytest.fixture
+def sink():
+    sink = metrics_sinks.InMemoryMetricsSink()
+    previous = metrics_sinks.set_metrics_sink(sink)
+    yield sink
+    metrics_sinks.set_metrics_sink(previous)
+
+
+def test_check_permissions_records_its_stages(app, mgr_token, portal, post,
+                                              unique, sink):
+    portal.latency["community/self"] = 300
+
+    status, result = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 200, result
+    [summary] = sink.summaries
+    assert summary["route"] == "check-permissions"
+    assert summary["status_code"] == 200
+    stages = {stage["name"]: stage for stage in summary["stages"]}
+    assert {"user token", "config", "identity"} <= set(stages)
+    # Identity runs beside the config read, and being slower
+    # sets the latency
+    assert stages["identity"]["duration_ms"] >= 300
+    assert "identity" in summary["critical_path"]
+    assert summary["duration_ms"] >= stages["identity"]["duration_ms"]
+    for stage in stages.values():
+        assert stage["status"] == "ok"
+        assert stage["retries"] == 0
+    assert stages["user token"]["calls"] == 1
+    counts = portal.call_counts()
+    assert stages["identity"]["calls"] == (counts["community/self"]
+                                           + counts.get("portals/self", 0))
+    assert stages["identity"]["bytes"] > 0
+    assert summary["portal_calls"] == sum(
+        stage["calls"] for stage in summary["stages"])
+
+
+def test_failed_stage_records_its_error(app, mgr_token, portal, post, unique,
+                                        sink, monkeypatch):
+    monkeypatch.setitem(app.ROUTE_DEADLINES, "check-permissions", 0.5)
+    portal.latency["community/self"] = 2000
+
+    status, _ = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 504
+    [summary] = sink.summaries
+    assert summary["status_code"] == 504
+    stages = {stage["name"]: stage for stage in summary["stages"]}
+    assert stages["identity"]["status"] == "DeadlineExceededError"
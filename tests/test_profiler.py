@@ -0,0 +1,41 @@
+'''The sampling profiler, with every request profiled'''
+import json
+import time
+
+import azure.functions as func
+import fake_portal
+
+import request_profiler
+
+
+def test_profiled_request_writes_its_profile(app, portal, unique, tmp_path,
+                                             monkeypatch):
+    monkeypatch.setattr(request_profiler, "PROFILE_SAMPLE_RATE", 1)
+    monkeypatch.setattr(request_profiler, "PROFILE_PATH", str(tmp_path))
+    portal.latency["community/self"] = 50
+    # The handlers were wrapped when imported, with profiling off
+    traced = app.add_existing_user._function.get_user_function()
+    handler = app._traced("check-permissions")(
+        request_profiler.profiled(traced.__wrapped__))
+
+    response = handler(func.HttpRequest("POST", "/api/check-permissions",
+                                        body=json.dumps({
+                                            "code": unique, "verifier": "v",
+                                            "globalid": fake_portal.GLOBALID
+                                        }).encode(), headers={}))
+
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert profile_id.startswith("check-permissions-")
+    assert "total;dur=" in response.headers["Server-Timing"]
+    collapsed = tmp_path / f"{profile_id}.collapsed.txt"
+    speedscope = tmp_path / f"{profile_id}.speedscope.json"
+    # Saved by a background thread once the response is made
+    for _ in range(100):
+        if collapsed.exists() and speedscope.exists():
+            break
+        time.sleep(0.05)
+    assert "add_existing_user" in collapsed.read_text()
+    profile = json.loads(speedscope.read_text())
+    assert profile["name"] == profile_id
+    assert profile["profiles"][0]["samples"]
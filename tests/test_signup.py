@@ -0,0 +1,83 @@
+'''Signup against the fake portal, with and without SIGNUP_VERIFY'''
+import fake_portal
+import tenants
+
+
+def signup_body(username):
+    return {"username": username, "password": "Passw0rd!",
+            "given_name": "Test", "family_name": "User",
+            "email": f"{username}@example.com",
+            "globalid": fake_portal.GLOBALID}
+
+
+def test_enterprise_signup_skips_membership_check(app, portal, post, unique):
+    status, result = post(app.user_signup, signup_body(unique))
+
+    assert status == 200, result
+    assert unique in portal.group_members[fake_portal.GROUP_ID]
+    calls = portal.call_counts()
+    assert calls["createUser"] == 1
+    assert calls["addUsers"] == 1
+    assert "group userList" not in calls
+    assert "group users" not in calls
+
+
+def test_verify_checks_skipped_membership(app, portal, post, unique,
+                                          monkeypatch):
+    monkeypatch.setattr(app, "SIGNUP_VERIFY", True)
+
+    status, result = post(app.user_signup, signup_body(unique))
+
+    assert status == 200, result
+    assert portal.call_counts()["group userList"] == 1
+    assert unique in portal.group_members[fake_portal.GROUP_ID]
+
+
+def test_verify_repairs_a_wrong_shortcut(app, portal, portal_url, unique,
+                                         caplog):
+    # Created and already a member, though the shortcut says it can't be
+    portal.users[unique] = fake_portal.ORG_ID
+    portal.group_members[fake_portal.GROUP_ID].add(unique)
+    pipeline = app.SignupPipeline(portal_url, fake_portal.GROUP_ID,
+                                  "https://app.example.com", online=False,
+                                  verify=True)
+    pipeline.facts = {pipeline.CREATED, pipeline.NOT_IN_GROUP}
+
+    message, status = pipeline.add_to_group(unique)
+
+    assert status == 200, message
+    assert pipeline.IN_GROUP in pipeline.facts
+    assert "addUsers" not in portal.call_counts()
+    assert "Signup shortcut for" in caplog.text
+
+
+def test_taken_username_is_refused_without_portal_calls(app, portal, post,
+                                                        unique):
+    assert post(app.user_signup, signup_body(unique))[0] == 200
+    portal.reset_counts()
+
+    status, result = post(app.user_signup, signup_body(unique))
+
+    assert status == 409, result
+    assert portal.call_counts() == {}
+
+
+def test_missing_username_is_refused(app, portal, post):
+    body = signup_body("unused")
+    del body["username"]
+
+    status, result = post(app.user_signup, body)
+
+    assert status == 400
+    assert result["message"] == "Missing username"
+    assert portal.call_counts() == {}
+
+
+def test_username_checks_hold_no_locks_or_main_cache_entries(
+        app, portal, unique):
+    for i in range(10):
+        assert app._check_username(f"{unique}_{i}")["available"]
+
+    assert len(tenants.cache_load_locks) == 0
+    assert all(not key.startswith("username:")
+               for key in tenants.current().cache._entries)
@@ -0,0 +1,62 @@
+'''Tenants keep their caches, tokens and request slots apart'''
+import fake_portal
+import pytest
+
+import tenants
+from manager_token import with_mgr_token
+from portal_session import PortalUnavailableError
+
+
+@pytest.fixture
+def two_tenants(portal_url, monkeypatch):
+    '''Tenants "a" and "b" on separate fake portals, one request each'''
+    pair = []
+    for name in ("a", "b"):
+        tenant = tenants.Tenant(
+            name, portal_url.replace("/portal", f"/{name}"),
+            fake_portal.MGR_USER, "fake-password",
+            fake_portal.CONFIG_ITEM_ID, f"{name}-client-id",
+            "https://app.example.com", max_concurrency=1)
+        monkeypatch.setitem(tenants.configured, name, tenant)
+        pair.append(tenant)
+    monkeypatch.setattr(tenants, "TENANT_QUEUE_WAIT", 0)
+    return pair
+
+
+def test_tenants_share_no_pools_or_caches(two_tenants):
+    a, b = two_tenants
+
+    assert a.http is not b.http
+    assert a.cache is not b.cache
+    assert a.username_cache is not b.username_cache
+    assert a.fanout is not b.fanout
+
+
+def test_tenants_share_no_cached_entries(two_tenants):
+    with tenants.use("a"):
+        tenants.cache.set("key", "a", 60)
+        tenants.username_cache.set("username:taken", "a", 60)
+
+    with tenants.use("b"):
+        assert tenants.cache.get("key") is None
+        assert tenants.username_cache.get("username:taken") is None
+
+
+def test_tenants_get_their_own_manager_token(two_tenants, portal):
+    with tenants.use("a"):
+        with_mgr_token(lambda token: token)
+        with_mgr_token(lambda token: token)
+    assert portal.call_counts()["generateToken"] == 1
+
+    with tenants.use("b"):
+        with_mgr_token(lambda token: token)
+    assert portal.call_counts()["generateToken"] == 2
+
+
+def test_busy_tenant_leaves_the_other_its_slots(two_tenants):
+    with tenants.use("a"):
+        with pytest.raises(PortalUnavailableError):
+            with tenants.use("a"):
+                pass
+        with tenants.use("b") as tenant:
+            assert tenant.name == "b"
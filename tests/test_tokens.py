@@ -0,0 +1,62 @@
+'''Tokens: the manager's is replaced when rejected, a user's is not,
+and neither is sent in a url or an error message'''
+import json
+
+import fake_portal
+import tenants
+from manager_token import with_mgr_token
+from portal_session import InvalidTokenError
+
+
+def test_rejected_user_token_keeps_the_manager_token(app, mgr_token, portal,
+                                                     post, unique,
+                                                     monkeypatch):
+    # mgr_token comes first, so the token is cached before counting
+    monkeypatch.setattr(portal, "_community_self", lambda *args: {
+        "error": {"code": 498, "message": "Invalid token."}})
+
+    status, result = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 401, result
+    assert "generateToken" not in portal.call_counts()
+
+
+def test_rejected_manager_token_is_replaced(portal, mgr_token):
+    calls = []
+
+    def call(token):
+        calls.append(token)
+        if len(calls) == 1:
+            raise InvalidTokenError("Invalid token.")
+        return token
+
+    assert with_mgr_token(call) == fake_portal.MGR_TOKEN
+    assert portal.call_counts()["generateToken"] == 1
+
+
+def test_portal_calls_send_no_token_in_the_url(app, portal, post, unique):
+    status, result = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 200, result
+    assert portal.token_urls == []
+
+
+def test_unexpected_error_hides_the_manager_token(app, portal, portal_url,
+                                                  post, unique, monkeypatch):
+    handle = portal.handle
+
+    def fail_portals_self(method, path, params, base_url):
+        if path.endswith("/portals/self"):
+            return 500, {}, {}
+        return handle(method, path, params, base_url)
+    monkeypatch.setattr(portal, "handle", fail_portals_self)
+    tenants.cache.delete(f"portal-info:{portal_url}")
+
+    status, result = post(app.add_existing_user, {
+        "code": unique, "verifier": "v", "globalid": fake_portal.GLOBALID})
+
+    assert status == 500
+    assert result["message"].startswith("An unexpected error occurred")
+    assert fake_portal.MGR_TOKEN not in json.dumps(result)
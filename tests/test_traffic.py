@@ -0,0 +1,80 @@
+'''The per-endpoint rate limiter and the circuit breaker'''
+import time
+
+import pytest
+
+from portal_session import (AdaptiveRateLimiter, CircuitBreaker,
+                            PortalUnavailableError, endpoint_class)
+
+
+def test_limiter_without_a_rate_never_waits():
+    limiter = AdaptiveRateLimiter("query", 0)
+
+    for _ in range(1000):
+        limiter.acquire(max_wait=0)
+    limiter.record_throttle()
+
+    assert limiter.rate == 0
+
+
+def test_limiter_refuses_calls_over_its_rate():
+    limiter = AdaptiveRateLimiter("write", 5)
+
+    for _ in range(5):
+        limiter.acquire(max_wait=0)
+    with pytest.raises(PortalUnavailableError):
+        limiter.acquire(max_wait=0)
+
+
+def test_limiter_backs_off_when_throttled_and_recovers():
+    limiter = AdaptiveRateLimiter("write", 10)
+
+    limiter.record_throttle()
+    assert limiter.rate == 5
+    for _ in range(20):
+        limiter.record_success()
+    assert limiter.rate == 10
+
+
+def test_user_code_exchange_is_never_limited():
+    assert endpoint_class(
+        "POST", "https://portal/sharing/rest/oauth2/token") == "user"
+    assert endpoint_class(
+        "POST", "https://portal/sharing/rest/community/checkUsernames") \
+        == "username"
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(threshold=3, cooldown=60)
+
+    for _ in range(2):
+        breaker.record_failure()
+        breaker.before_call()
+    breaker.record_failure()
+
+    with pytest.raises(PortalUnavailableError):
+        breaker.before_call()
+
+
+def test_breaker_lets_one_trial_through_after_cooldown():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    breaker.before_call()
+    with pytest.raises(PortalUnavailableError):
+        breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+
+
+def test_breaker_reopens_when_the_trial_fails():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    breaker.before_call()
+    breaker.record_failure()
+
+    with pytest.raises(PortalUnavailableError):
+        breaker.before_call()
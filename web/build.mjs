@@ -0,0 +1,159 @@
+// Builds the pages in web/ into web/dist. The pages in web/ load Calcite
+// from the CDN and work as they are; the build makes them faster.
+//
+// - Swaps each page's CDN Calcite tags for a self-hosted bundle. It
+//   bundles the Calcite components the pages use, found by scanning
+//   them for <calcite-*> tags, into one minified, content-hashed
+//   module, with the pinned Calcite version's stylesheet beside it.
+// - Inlines the CSS each page needs to first render and loads the
+//   rest of the stylesheet without blocking.
+// - Writes brotli and gzip variants of every text file.
+//
+// Files under /assets never change once built, so
+// staticwebapp.config.json lets browsers cache them for a year.
+//
+// Usage: npm ci && npm run build, as the deployment workflows do
+import { build } from "esbuild";
+import Beasties from "beasties";
+import fs from "node:fs/promises";
+import path from "node:path";
+import { fileURLToPath } from "node:url";
+import { brotliCompressSync, constants, gzipSync } from "node:zlib";
+
+const root = path.dirname(fileURLToPath(import.meta.url));
+const dist = path.join(root, "dist");
+const calcite = path.join(root, "node_modules", "@esri", "calcite-components");
+const pages = ["index.html", "signup.html", "callback.html"];
+const compressible = new Set([".html", ".js", ".css", ".json", ".svg"]);
+// The CDN tags in the pages, which the build replaces
+const cdnScript = /src="https:\/\/js\.arcgis\.com\/calcite-components\/([^/"]+)\/calcite\.esm\.js"/;
+const cdnStylesheet = /href="https:\/\/js\.arcgis\.com\/calcite-components\/([^/"]+)\/calcite\.css"/;
+
+async function main() {
+  const { version } = JSON.parse(
+    await fs.readFile(path.join(calcite, "package.json"), "utf8"));
+  const sources = Object.fromEntries(await Promise.all(pages.map(
+    async (page) => [page, await fs.readFile(path.join(root, page), "utf8")])));
+
+  await fs.rm(dist, { recursive: true, force: true });
+  await fs.mkdir(dist, { recursive: true });
+
+  // Icons are fetched by name at runtime, so they can't be hashed.
+  // Keep them under the Calcite version instead
+  const assetBase = `/assets/calcite-${version}/`;
+  await fs.cp(path.join(calcite, "dist", "calcite", "assets"),
+              path.join(dist, assetBase, "assets"), { recursive: true });
+
+  const components = usedComponents(Object.values(sources));
+  const bundle = await bundleCalcite(components, assetBase);
+  console.log(`Calcite ${version}: ${components.join(", ")}`);
+
+  const beasties = new Beasties({
+    path: dist,
+    publicPath: "/",
+    preload: "swap",
+    pruneSource: false,
+    logLevel: "warn"
+  });
+  for (const [page, html] of Object.entries(sources)) {
+    // The pages must ask for the version being bundled, so the built
+    // and unbuilt pages look the same
+    for (const tag of [cdnScript, cdnStylesheet]) {
+      const match = html.match(tag);
+      if (!match || match[1] !== version) {
+        throw new Error(`${page} must load Calcite ${version} from the CDN ` +
+                        `(found ${match ? match[1] : "no tag"})`);
+      }
+    }
+    const linked = html
+      .replace(cdnScript, `src="${bundle.js}"`)
+      .replace(cdnStylesheet, `href="${bundle.css}"`);
+    await fs.writeFile(path.join(dist, page), await beasties.process(linked));
+  }
+
+  await fs.copyFile(path.join(root, "staticwebapp.config.json"),
+                    path.join(dist, "staticwebapp.config.json"));
+  await compressAll(dist);
+}
+
+function usedComponents(htmlPages) {
+  const tags = new Set();
+  for (const html of htmlPages) {
+    for (const [, tag] of html.matchAll(/<(calcite-[a-z-]+)/g)) {
+      tags.add(tag);
+    }
+  }
+  return [...tags].sort();
+}
+
+async function bundleCalcite(components, assetBase) {
+  // Importing each component's defineCustomElement (which also defines
+  // the components it renders) lets esbuild drop all the others
+  const entry = path.join(root, "node_modules", ".cache", "calcite.js");
+  await fs.mkdir(path.dirname(entry), { recursive: true });
+  await fs.writeFile(entry, [
+    'import { setAssetPath } from "@esri/calcite-components/dist/components/index.js";',
+    ...components.map((tag, i) =>
+      `import { defineCustomElement as define${i} } from "@esri/calcite-components/dist/components/${tag}.js";`),
+    `setAssetPath(new URL(${JSON.stringify(assetBase)}, window.location.href).href);`,
+    ...components.map((_, i) => `define${i}();`)
+  ].join("\n"));
+
+  const result = await build({
+    entryPoints: [
+      { in: entry, out: "calcite" },
+      { in: path.join(calcite, "dist", "calcite", "calcite.css"), out: "calcite" }
+    ],
+    outdir: path.join(dist, "assets"),
+    entryNames: "[name]-[hash]",
+    assetNames: "[name]-[hash]",
+    loader: { ".woff": "file", ".woff2": "file", ".ttf": "file", ".svg": "file" },
+    bundle: true,
+    format: "esm",
+    target: "es2020",
+    minify: true,
+    treeShaking: true,
+    legalComments: "linked",
+    metafile: true
+  });
+
+  const outputs = Object.keys(result.metafile.outputs)
+    .map((file) => "/" + path.relative(dist, file).split(path.sep).join("/"));
+  return {
+    js: outputs.find((file) => /\/calcite-\w+\.js$/.test(file)),
+    css: outputs.find((file) => /\/calcite-\w+\.css$/.test(file))
+  };
+}
+
+async function compressAll(dir) {
+  let raw = 0, brotli = 0, gzip = 0;
+  for (const entry of await fs.readdir(dir, { recursive: true, withFileTypes: true })) {
+    const file = path.join(entry.parentPath ?? entry.path, entry.name);
+    if (!entry.isFile() || !compressible.has(path.extname(file))) {
+      continue;
+    }
+    const content = await fs.readFile(file);
+    const br = brotliCompressSync(content, {
+      params: {
+        [constants.BROTLI_PARAM_QUALITY]: constants.BROTLI_MAX_QUALITY,
+        [constants.BROTLI_PARAM_SIZE_HINT]: content.length
+      }
+    });
+    const gz = gzipSync(content, { level: 9 });
+    await fs.writeFile(file + ".br", br);
+    await fs.writeFile(file + ".gz", gz);
+    raw += content.length;
+    brotli += br.length;
+    gzip += gz.length;
+  }
+  console.log(`Text assets: ${kb(raw)} raw, ${kb(gzip)} gzip, ${kb(brotli)} brotli`);
+}
+
+function kb(bytes) {
+  return `${(bytes / 1024).toFixed(1)} KiB`;
+}
+
+main().catch((error) => {
+  console.error(error);
+  process.exit(1);
+});